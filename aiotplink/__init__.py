@@ -1,3 +1,17 @@
-from .devices import GetDevice, TPDevice, TPSmartDevice, TPLight, TPWhiteLight, TPColourLight
-from .discover import TPLinkDiscovery
+from .devices import GetDevice, TPDevice, TPSmartDevice, TPLight, TPWhiteLight, TPColourLight, TPStrip, TPOutlet
+from .discover import TPLinkDiscovery, TPLinkHybridDiscovery, discover, AsyncRegistrar, RegistrarEvent
 from .commands import *
+from .responses import TPRecord, SysInfo, RealtimeEmeter, LightState, DayStats, MonthStats, ScanResult, DownloadState, RuleList
+from .fleet import TPFleet
+from .inventory import TPInventory, InventoryRegistrar
+from .events import EventBus, FLEET_BUS, DROP_OLDEST, COALESCE
+from .polling import AdaptivePoll, PollBudget
+from .scene import Scene
+from .effects import Effect, Fade, ColourLoop, Breathe, Candle, EffectRunner
+from .rules import RuleSync, SyncResult, schedule_rule, count_down_rule, anti_theft_rule, diff_rules
+from .rollout import FirmwareRollout, ProgressPoller
+from .fwserver import FirmwareServer
+from .shaper import TrafficShaper, TRAFFIC_SHAPER
+from .energy import EnergyAggregator, meter_key, rollup, rollup_columns
+from .export import Exporter, Point, Sink, LineProtocolFile, CSVFile, HTTPLineProtocol
+from .capture import CAPTURE, WireCapture, ReplayServer, read_capture
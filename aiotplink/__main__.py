@@ -39,7 +39,12 @@ class devices():
         if "mac" in info and info["mac"].lower() not in self.devices:
             self.devices[info["mac"].lower()] = aiot.GetDevice(addr,info,hb=10)
         else:
-            self.devices[info["mac"].lower()].addr = addr
+            self.devices[info["mac"].lower()].addr = addr[0]
+
+    def update(self, info, addr):
+        """The device was seen at a new address"""
+        if "mac" in info and info["mac"].lower() in self.devices:
+            self.devices[info["mac"].lower()].addr = addr[0]
 
     def unregister(self,mac):
         if mac.lower() in self.devices:
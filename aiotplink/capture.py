@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we record the raw traffic with the devices, and play it back.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import logging, socket, time
+from collections import namedtuple, OrderedDict
+from struct import pack, unpack, calcsize
+
+# A capture file is MAGIC, the wall clock time of the start as a double, then records:
+#    time since the start (double) | kind | flags | connection id | IPv4 | port | length | data
+# data is exactly what went on the wire, still encrypted, chunked as it was sent or received.
+MAGIC = b"TPLCAP1\n"
+START = ">d"
+RECORD = ">dBBI4sHI"
+RECORD_SIZE = calcsize(RECORD)
+BUFFERING = 1 << 16
+PIPELINEWAIT = 0.05 # secs the replay waits for more pipelined frames, when a recorded request had more
+
+OPEN = 1
+DATA = 2
+CLOSE = 3
+
+OUT = 0 # From us to the device
+IN = 1
+UDP = 2 # flags bit, datagram rather than TCP
+
+Record = namedtuple("Record", ["time", "kind", "direction", "udp", "conn", "peer", "data"])
+
+
+class WireCapture(object):
+    """Record the raw frames exchanged with the devices.
+
+    Inactive until start(), then TPProtocol connections and discovery
+    datagrams are written, with their timing, to a compact binary file.
+    Records are buffered, stop() flushes them.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.start_time = None
+        self.next_conn = 1
+        self.records = 0
+
+    @property
+    def active(self):
+        return self.file is not None
+
+    def start(self, path):
+        self.stop()
+        self.file = open(path, "wb", buffering=BUFFERING)
+        self.start_time = time.monotonic()
+        self.file.write(MAGIC + pack(START, time.time()))
+        self.next_conn = 1
+        self.records = 0
+
+    def stop(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _write(self, kind, direction, conn, peer, data=b""):
+        try:
+            ip = socket.inet_aton(peer[0]) if peer else bytes(4)
+            port = peer[1] if peer else 0
+        except OSError:
+            ip, port = bytes(4), 0 # Not IPv4, keep the frames anyway
+        self.file.write(pack(RECORD, time.monotonic() - self.start_time, kind, direction, conn,
+                             ip, port, len(data)) + data)
+        self.records += 1
+
+    def tcp_open(self, transport):
+        """A connection was made, return its id, None when not capturing"""
+        if not self.file:
+            return None
+        conn = self.next_conn
+        self.next_conn += 1
+        self._write(OPEN, OUT, conn, transport.get_extra_info("peername"))
+        return conn
+
+    def tcp(self, conn, direction, data):
+        if self.file and conn is not None:
+            self._write(DATA, direction, conn, None, data)
+
+    def tcp_close(self, conn):
+        if self.file and conn is not None:
+            self._write(CLOSE, OUT, conn, None)
+
+    def udp(self, direction, peer, data):
+        if self.file:
+            self._write(DATA, direction | UDP, 0, peer, data)
+
+# What TPProtocol and discovery record to. CAPTURE.start(path) to record.
+CAPTURE = WireCapture()
+
+
+def read_capture(path):
+    """Yield the Records of a capture file. TCP data and close records get
+    the peer of their connection."""
+    peers = {}
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        f.read(calcsize(START))
+        while True:
+            head = f.read(RECORD_SIZE)
+            if len(head) < RECORD_SIZE:
+                break
+            when, kind, flags, conn, ip, port, length = unpack(RECORD, head)
+            data = f.read(length)
+            peer = (socket.inet_ntoa(ip), port)
+            if flags & UDP:
+                conn = None
+            elif kind == OPEN:
+                peers[conn] = peer
+            else:
+                peer = peers.get(conn)
+            yield Record(when, kind, flags & IN, bool(flags & UDP), conn, peer, data)
+
+
+class _Conversation(object):
+    """One recorded TCP connection: its first request and what followed"""
+
+    def __init__(self, start):
+        self.start = start
+        self.events = [] # (time, direction, data)
+        self.request = b""
+
+    def add(self, when, direction, data):
+        if direction == OUT and not self.request:
+            self.request = data
+        self.events.append((when, direction, data))
+
+
+class ReplayServer(object):
+    """Play a capture back, standing in for the devices.
+
+    Each recorded device gets a local TCP port, see addr_for. A connection to
+    it is answered with the next recorded conversation of that device, the one
+    with the same request if there is one. The replies are sent in the same
+    chunks, after the same delays, divided by speed. With speed 0 there are no
+    delays. A device that never answered still does not, the client times out.
+
+    Discovery requests sent to udp_addr get the recorded replies of the
+    recorded requests in turn, with their timing. Discovery sends to port
+    9999, give that udp_port for discovery to reach the replay.
+    """
+
+    def __init__(self, path, speed=1.0, host="127.0.0.1", udp_port=0):
+        self.path = path
+        self.speed = speed
+        self.host = host
+        self.udp_port = udp_port
+        self.conversations = OrderedDict() # peer -> [_Conversation]
+        self.datagrams = [] # [(request time, [(delay, data)])]
+        self.next = {}
+        self.servers = {}
+        self.addrs = {}
+        self.udp_transport = None
+        self.udp_addr = None
+        self.served = 0
+        self._tasks = set()
+        self._load()
+
+    def _load(self):
+        conns = {}
+        burst = None
+        for rec in read_capture(self.path):
+            if rec.udp:
+                if rec.direction == OUT:
+                    burst = (rec.time, [])
+                    self.datagrams.append(burst)
+                elif burst is not None:
+                    burst[1].append((rec.time - burst[0], rec.data))
+            elif rec.kind == OPEN:
+                conns[rec.conn] = _Conversation(rec.time)
+                self.conversations.setdefault(rec.peer, []).append(conns[rec.conn])
+            elif rec.kind == DATA and rec.conn in conns:
+                conns[rec.conn].add(rec.time, rec.direction, rec.data)
+            elif rec.kind == CLOSE:
+                conns.pop(rec.conn, None)
+
+    def _delay(self, secs):
+        if not self.speed:
+            return 0
+        return secs / self.speed
+
+    def addr_for(self, peer):
+        """The local address standing in for the recorded device at peer"""
+        return self.addrs[tuple(peer)]
+
+    async def _more_frames(self, peer, reader, request):
+        """A pipelined request is written at once, but read one frame at a time.
+        While a recorded request of peer starts with what was read, and is longer,
+        read the next frame if it comes soon enough."""
+        while any(len(x.request) > len(request) and x.request.startswith(request)
+                  for x in self.conversations[peer]):
+            try:
+                head = await aio.wait_for(reader.readexactly(4), PIPELINEWAIT)
+            except aio.TimeoutError:
+                break
+            request += head + await reader.readexactly(unpack(">I", head)[0])
+        return request
+
+    def _pick(self, peer, request):
+        convs = self.conversations[peer]
+        start = self.next.get(peer, 0)
+        order = list(range(start, len(convs))) + list(range(start))
+        #The same request first: a pipelined one starts with the frame of a single request
+        idx = next((i for i in order if convs[i].request == request),
+                   next((i for i in order if convs[i].request.startswith(request)), order[0]))
+        self.next[peer] = (idx + 1) % len(convs)
+        return convs[idx]
+
+    async def _serve(self, peer, reader, writer):
+        task = aio.current_task() if hasattr(aio, "current_task") else aio.Task.current_task()
+        self._tasks.add(task)
+        loop = aio.get_event_loop()
+        try:
+            sock = writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Keep the chunks apart
+            head = await reader.readexactly(4)
+            request = head + await reader.readexactly(unpack(">I", head)[0])
+            request = await self._more_frames(peer, reader, request)
+            conv = self._pick(peer, request)
+            self.served += 1
+            base, origin, first = loop.time(), None, True
+            for when, direction, data in conv.events:
+                if direction == OUT:
+                    if first:
+                        origin, first = when, False
+                        data = data[len(request):]
+                    if data:
+                        await reader.readexactly(len(data))
+                    continue
+                delay = base + self._delay(when - (origin or when)) - loop.time()
+                if delay > 0:
+                    await aio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+            await reader.read() # Wait for the client to close, as a device would
+        except (aio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.debug("Replay of {} failed: {}".format(peer, e))
+        finally:
+            writer.close()
+            self._tasks.discard(task)
+
+    def _datagram(self, data, addr):
+        if not self.datagrams:
+            return
+        idx = self.next.get("udp", 0)
+        self.next["udp"] = (idx + 1) % len(self.datagrams)
+        for delay, reply in self.datagrams[idx][1]:
+            aio.get_event_loop().call_later(self._delay(delay), self._reply, reply, addr)
+
+    def _reply(self, data, addr):
+        if self.udp_transport:
+            self.udp_transport.sendto(data, addr)
+
+    async def start(self):
+        for peer in self.conversations:
+            server = await aio.start_server(lambda r, w, peer=peer: self._serve(peer, r, w), self.host, 0)
+            self.servers[peer] = server
+            self.addrs[peer] = server.sockets[0].getsockname()[:2]
+        if self.datagrams:
+            loop = aio.get_event_loop()
+            self.udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: _ReplayDatagram(self), local_addr=(self.host, self.udp_port))
+            self.udp_addr = self.udp_transport.get_extra_info("sockname")[:2]
+        return self
+
+    async def stop(self):
+        for server in self.servers.values():
+            server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        for server in self.servers.values():
+            await server.wait_closed()
+        self.servers = {}
+        if self.udp_transport:
+            self.udp_transport.close()
+            self.udp_transport = None
+
+
+class _ReplayDatagram(aio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server._datagram(data, addr)
@@ -22,12 +22,15 @@
 # WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
 # IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 
+import asyncio as aio
 import datetime as dt
 import json, logging, re
 
+from collections import namedtuple
 from enum import IntEnum
-from struct import pack,unpack
+from struct import pack,unpack,pack_into
 from urllib.parse import urlparse
+from .responses import TPRecord, SysInfo, RealtimeEmeter, LightState, DayStats, MonthStats, ScanResult, DownloadState, RuleList
 
 class TPLException(Exception):
     pass
@@ -36,13 +39,22 @@ class TPLCodec(object):
 
     @staticmethod
     def encrypt(string):
-        key = 171
-        result = pack('>I', len(string))
+        result, key = TPLCodec.encrypt_from(string)
+        return pack('>I', len(string)) + result
+
+    @staticmethod
+    def encrypt_from(string, key=171):
+        """Encrypt without length header, starting from the given key.
+
+        Return the encrypted bytes and the key to continue from.
+        """
+        result = bytearray(len(string))
+        idx = 0
         for i in string:
-            a = key ^ ord(i)
-            key = a
-            result += bytes([a])
-        return result
+            key = key ^ ord(i)
+            result[idx] = key
+            idx += 1
+        return bytes(result), key
 
     @staticmethod
     def decrypt(string):
@@ -56,22 +68,145 @@ class TPLCodec(object):
         #assert length == len(result[4:])
         return result
 
-class BasicCommand(object):
+class CommandSchema(object):
+    """The class-level description of a command: where it lives in the request,
+    how to translate the reply keys and values, which reply keys to ignore and
+    how to validate a value. It is built once, when the command class is created.
+    """
+
+    __slots__ = ("cls", "path", "translation", "vtranslation", "ignore", "validator", "record")
+
+    def __init__(self, cls, path, translation, vtranslation, ignore, validator, record=TPRecord):
+        self.cls = cls
+        self.path = path
+        self.translation = translation
+        self.vtranslation = vtranslation
+        self.ignore = ignore
+        self.validator = validator
+        self.record = record
+
+    def with_root(self, root):
+        """The same schema, under a different top-level module"""
+        return CommandSchema(self.cls, (root,) + self.path[1:], self.translation,
+                             self.vtranslation, self.ignore, self.validator, self.record)
+
+
+class CommandMeta(type):
+    """Build the schema of each command class from its declarations.
+
+    A class may declare:
+        path: keys appended to the path of its parent class
+        translation, vtranslation: merged with those of its parent class
+        ignore: replaces the list of ignored keys of its parent class
+        light_root: top-level module used when the command targets a light
+    and may set "record" to the typed record class of its replies.
+    Command classes get empty __slots__ unless they declare their own, so
+    instances only hold their values.
+    """
+
+    DECLARATIONS = ["path", "translation", "vtranslation", "ignore"]
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault("__slots__", ())
+        #Declarations go to the schema, they must not hide the instance properties
+        declared = {}
+        for key in mcs.DECLARATIONS:
+            if key in namespace and not isinstance(namespace[key], property):
+                declared[key] = namespace.pop(key)
+        cls = super().__new__(mcs, name, bases, namespace)
+        parent = getattr(cls, "schema", None)
+        if parent:
+            path = parent.path
+            translation = dict(parent.translation)
+            vtranslation = dict(parent.vtranslation)
+            ignore = parent.ignore
+        else:
+            path = ()
+            translation = {}
+            vtranslation = {}
+            ignore = frozenset(["err_code"])
+        path = path + tuple(declared.get("path", ()))
+        translation.update(declared.get("translation", {}))
+        vtranslation.update(declared.get("vtranslation", {}))
+        if "ignore" in declared:
+            ignore = frozenset(declared["ignore"])
+        cls.schema = CommandSchema(cls, path, translation, vtranslation, ignore, cls._verify_value,
+                                   getattr(cls, "record", TPRecord))
+        if getattr(cls, "light_root", None) and path:
+            cls.light_schema = cls.schema.with_root(cls.light_root)
+        else:
+            cls.light_schema = cls.schema
+        return cls
+
+
+DECODE_THRESHOLD = 4096 #Replies larger than this are decoded off the event loop
+
+def decode(data):
+    """Decrypt and parse a reply payload, without its length header."""
+    return json.loads(TPLCodec.decrypt(data))
+
+class DecodePolicy(object):
+    """Decide where replies are decoded.
+
+    Small replies are decoded inline. Replies larger than threshold bytes are
+    decoded in executor, None meaning the event loop default thread pool. A
+    concurrent.futures.ProcessPoolExecutor can be used for heavy loads, decode
+    is a module-level function so it can be sent to other processes.
+    """
+
+    def __init__(self, threshold=DECODE_THRESHOLD, executor=None):
+        self.threshold = threshold
+        self.executor = executor
+
+    def decode(self, data, handler, onerror):
+        """Decode data, then call handler with the result, or onerror with the exception"""
+        if self.threshold is None or len(data) <= self.threshold:
+            try:
+                resp = decode(data)
+            except Exception as e:
+                onerror(e)
+                return
+            handler(resp)
+            return
+
+        def done(fut):
+            if fut.cancelled():
+                return
+            if fut.exception():
+                onerror(fut.exception())
+            else:
+                handler(fut.result())
+
+        aio.get_event_loop().run_in_executor(self.executor, decode, data).add_done_callback(done)
+
+# The policy used by devices and discovery, replace it to change it everywhere.
+DECODE_POLICY = DecodePolicy()
+
+class BasicCommand(object, metaclass=CommandMeta):
     """TP-Link commands are simply dictionaries of dictionaries.
 
-    Here we have a simple structure to build commands
+    Here we have a simple structure to build commands. What a command is lives
+    in the class schema, an instance only holds its parts, a list of
+    (schema, value) pairs. Adding commands concatenates their parts.
 
+    Commands for the outlets of a power strip carry a context, the list of
+    the child ids they apply to, see for_children.
     """
 
+    __slots__ = ("parts", "context")
+
     description = None
 
-    def __init__(self):
-        self.cmd = [[]]
-        self.val = [{}]
-        self.cmdlist=[self.__class__]
-        self.translation={}
-        self.vtranslation={}
-        self.ignore = ["err_code"]
+    def __init__(self, val=None, is_light=False):
+        if val is None:
+            val = {}
+        self.parts = [(self.light_schema if is_light else self.schema, val)]
+        self.context = None
+
+    def for_children(self, child_ids):
+        """Address the command to some children (outlets) of the device"""
+        self.context = {"child_ids": list(child_ids)}
+        return self
 
     def __repr__(self):
         return str(self.value)
@@ -79,31 +214,80 @@ class BasicCommand(object):
     def _verify_value(self,val):
         return val
 
+    def _merge_value(self, val, keys):
+        """Validate a dictionary value and merge it into the current one"""
+        cname = self.__class__.__name__[:-3]
+        if not isinstance(val,dict):
+            raise ValueError("%s command value must be a dictionary %s"% (cname, self.val[-1]))
+        if not set(keys).issuperset(set(val.keys())):
+            raise ValueError("%s command value must be a dictionary %s"% (cname, self.val[-1]))
+        resu = dict(self.val[-1])
+        resu.update(val)
+        return resu
+
+    @property
+    def cmd(self):
+        return [list(schema.path) for schema, val in self.parts]
+
+    @property
+    def val(self):
+        return [val for schema, val in self.parts]
+
+    @property
+    def cmdlist(self):
+        return [schema.cls for schema, val in self.parts]
+
+    @property
+    def translation(self):
+        resu = {}
+        for schema, val in self.parts:
+            resu.update(schema.translation)
+        return resu
+
+    @property
+    def vtranslation(self):
+        resu = {}
+        for schema, val in self.parts:
+            resu.update(schema.vtranslation)
+        return resu
+
+    @property
+    def ignore(self):
+        resu = set()
+        for schema, val in self.parts:
+            resu |= schema.ignore
+        return resu
+
     @property
     def value(self):
+        return self._build_value(self.val)
+
+    def _build_value(self, vals):
         resu={}
-        for lok,val in zip(self.cmd,self.val):
-            thisval = val
-            for k in lok[::-1]:
-                thisval = {k:thisval}
-            resu.update(thisval)
+        if self.context:
+            resu["context"] = self.context
+        for (schema, x), val in zip(self.parts, vals):
+            thisval = resu
+            for k in schema.path[:-1]:
+                thisval = thisval.setdefault(k, {})
+            if schema.path:
+                thisval[schema.path[-1]] = val
         return resu
 
     def translate(self, key):
-        if key in self.translation:
-            return self.translation[key]
-        return key
+        return self.translation.get(key, key)
 
     def vtranslate(self, key, val):
-        if key in self.vtranslation:
-            return self.vtranslation[key][val]
+        vtranslation = self.vtranslation
+        if key in vtranslation:
+            return vtranslation[key][val]
         return val
 
     @value.setter
     def value(self,val):
         """ Here setting a value replaces the Last value
         """
-        self.val = self.val[:-1] + [self._verify_value(val)]
+        self.parts[-1] = (self.parts[-1][0], self._verify_value(val))
 
 
     def response(self,data,noskip=False,ignore=False):
@@ -112,24 +296,42 @@ class BasicCommand(object):
             sidx=0
         else:
             sidx=4
-        resp = json.loads(TPLCodec.decrypt(data[sidx:]))
-        fullresp = {}
-        for cmd in self.cmd:
+        return self.process(json.loads(TPLCodec.decrypt(data[sidx:])), ignore)
+
+    def records(self,data,noskip=False,ignore=False):
+        """Process received data into one typed record per part"""
+        if noskip:
+            sidx=0
+        else:
+            sidx=4
+        return self.parse(json.loads(TPLCodec.decrypt(data[sidx:])), ignore)
+
+    def parse(self, resp, ignore=False):
+        """Split a decoded reply into one record per part. Fields are only
+        decoded when they are read."""
+        resu = []
+        for schema, val in self.parts:
             thisresp =resp
-            for key in cmd:
+            for key in schema.path:
                 if key in thisresp:
                     thisresp=thisresp[key]
                 else:
                     break
 
-            if "err_code" in thisresp and thisresp["err_code"] != 0:
-                if not ignore:
-                    raise TPLException("Got error %d for command %s" % (thisresp["err_code"],key))
-                else:
-                    fullresp[cmd[0]] = ("err_msg" in thisresp and thisresp["err_msg"]) or thisresp["err_code"]
-            for skey in thisresp:
-                if skey not in self.ignore:
-                    fullresp[self.translate(skey)] = self.vtranslate(skey, thisresp[skey])
+            if "err_code" in thisresp and thisresp["err_code"] != 0 and not ignore:
+                raise TPLException("Got error %d for command %s" % (thisresp["err_code"],key))
+            resu.append(schema.record(thisresp, schema))
+        return resu
+
+    def process(self, resp, ignore=False):
+        """Flatten a decoded reply, using the schema of each part. As it always
+        has, a key ignored by one part is ignored in all of them."""
+        fullresp = {}
+        ignored = self.ignore
+        for rec in self.parse(resp, ignore):
+            if rec.err_code:
+                fullresp[rec._schema.path[0]] = rec.err_msg or rec.err_code
+            fullresp.update(rec.as_dict(ignored))
         return fullresp
 
     @property
@@ -142,68 +344,113 @@ class BasicCommand(object):
         return super().__class__
 
     def __add__(self, other):
-        """Simply add cmd and value
+        """Simply add the parts of other. The class schemas are shared, not copied.
+        Both commands must be for the same children, if any.
         """
-        #if self.pclass == other.pclass:
-            #raise TPLException("Only different commands can be added (%s and %s)"%(self.pclass,other.pclass))
-
-        self.cmd += other.cmd
-        self.val += other.val
-        self.cmdlist += other.cmdlist
-        self.translation.update(other.translation)
-        self.ignore += other.ignore
+        if other.context and self.context and other.context != self.context:
+            raise TPLException("Cannot merge commands for different children")
+        self.context = self.context or other.context
+        self.parts += other.parts
         return self
 
     def __iadd__(self,other):
         return self.__add__(other)
 
 
-    #def __sub__(self, other):
-        #""" Remove all instances in Other from self
-        #"""
-        #goon = True
-        #while goon:
-            #idx = 0
-            #remove = -1
-            #for acmd in self.cmd:
-                #if acmd in other.cmd:
-                    #remove = idx
-                    #break
-                #idx +=1
+TEMPLATE_MARKER = "\x00TPLVAL\x00"
+
+class BoundCommand(object):
+    """What a CommandTemplate returns, it can be sent like any command"""
+
+    __slots__ = ("command", "template")
+
+    def __init__(self, command, template):
+        self.command = command
+        self.template = template
+
+    def response(self, data, noskip=False, ignore=False):
+        return self.template.cmd.response(data, noskip, ignore)
+
+    def records(self, data, noskip=False, ignore=False):
+        return self.template.cmd.records(data, noskip, ignore)
 
-            #if remove > -1:
-                #self.cmd = self.cmd[:remove]+self.cmd[remove+1:]
-                #self.val = self.val[:remove]+self.val[remove+1:]
-                #self.cmdlist = self.cmdlist[:remove]+self.cmdlist[remove+1:]
-            #else:
-                #goon = False
+    def process(self, resp, ignore=False):
+        return self.template.cmd.process(resp, ignore)
 
+class CommandTemplate(object):
+    """A command with one variable value, encrypted incrementally.
 
+    The TP-Link cipher only depends on the previous encrypted byte, so the
+    encrypted JSON up to the variable value never changes. It is encrypted once,
+    together with the key at that point, and each call only encrypts the value
+    and the end of the JSON text, then patches the length header.
+
+    The variable is the value of the last subcommand of cmd, or, if key is set,
+    the entry key of that value. validator, if given, is applied to the value
+    before encoding.
+    """
+
+    def __init__(self, cmd, key=None, validator=None):
+        self.cmd = cmd
+        self.key = key
+        self.validator = validator
+        vals = list(cmd.val)
+        if key is None:
+            vals[-1] = TEMPLATE_MARKER
+        else:
+            vals[-1] = dict(vals[-1])
+            vals[-1][key] = TEMPLATE_MARKER
+        text = json.dumps(cmd._build_value(vals))
+        parts = text.split(json.dumps(TEMPLATE_MARKER))
+        if len(parts) != 2:
+            raise TPLException("Cannot build a template for %s" % cmd.__class__.__name__)
+        prefix, self.suffix = parts
+        encprefix, self.key_state = TPLCodec.encrypt_from(prefix)
+        self._head = bytearray(4) + encprefix
+
+    def encode(self, val):
+        """Return the bytes to send down the wire for this value"""
+        if self.validator:
+            val = self.validator(val)
+        tail, key = TPLCodec.encrypt_from(json.dumps(val) + self.suffix, self.key_state)
+        result = bytearray(self._head)
+        pack_into('>I', result, 0, len(result) - 4 + len(tail))
+        result += tail
+        return bytes(result)
+
+    def __call__(self, val):
+        return BoundCommand(self.encode(val), self)
+
+_templates = {}
+
+def get_template(cmdclass, key=None):
+    """Return a shared template for a command class that can be built without arguments.
+    The class _verify_value validates the value."""
+    if (cmdclass, key) not in _templates:
+        proto = cmdclass()
+        validator = proto._verify_value if key is None else None
+        _templates[(cmdclass, key)] = CommandTemplate(proto, key, validator)
+    return _templates[(cmdclass, key)]
 
 class SysCmd(BasicCommand):
 
     description = None
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("system")
-        self.translation["led_off"]="led"
-        self.translation["relay_state"]="state"
-        self.translation["alias"]="name"
-        self.translation["hw_ver"]="hardware version"
-        self.translation["sw_ver"]="software version"
-        self.translation["icon_hash"]="icon hash"
-        self.vtranslation["relay_state"]={0:"off",1:"on"}
-        self.vtranslation["led_off"]={1:"off",0:"on"}
-        self.ignore=["feature","oemId","fwId","hwId","dev_name","latitude_i","longitude_i","ctrl_protocols","preferred_state"]
+    path = ("system",)
+    translation = {"led_off": "led",
+                   "relay_state": "state",
+                   "alias": "name",
+                   "hw_ver": "hardware version",
+                   "sw_ver": "software version",
+                   "icon_hash": "icon hash"}
+    vtranslation = {"relay_state": {0:"off",1:"on"},
+                    "led_off": {1:"off",0:"on"}}
+    ignore = ["feature","oemId","fwId","hwId","dev_name","latitude_i","longitude_i","ctrl_protocols","preferred_state"]
 
 class InfoCmd(SysCmd):
 
     description = "Get device info."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_sysinfo")
+    path = ("get_sysinfo",)
+    record = SysInfo
 
     def _verify_value(self,val):
         raise ValueError("Info command should not have a value")
@@ -211,12 +458,10 @@ class InfoCmd(SysCmd):
 class RebootCmd(SysCmd):
 
     description = "Reboot device."
+    path = ("reboot", "delay")
 
     def __init__(self, delay = 1):
-        super().__init__()
-        self.cmd[0].append("reboot")
-        self.cmd[0].append("delay")
-        self.val[0] = delay
+        super().__init__(delay)
 
     def _verify_value(self,val):
         if not isinstance(val,int):
@@ -226,12 +471,10 @@ class RebootCmd(SysCmd):
 class ResetCmd(SysCmd):
 
     description = "Reset device"
+    path = ("reset", "delay")
 
     def __init__(self, delay = 1):
-        super().__init__()
-        self.cmd[0].append("reset")
-        self.cmd[0].append("delay")
-        self.val[0] = delay
+        super().__init__(delay)
 
     def _verify_value(self,val):
         if not isinstance(val,int):
@@ -241,12 +484,10 @@ class ResetCmd(SysCmd):
 class SetCmd(SysCmd):
 
     description = "Set device state (On/Off)."
+    path = ("set_relay_state", "state")
 
     def __init__(self,val=0):
-        super().__init__()
-        self.cmd[0].append("set_relay_state")
-        self.cmd[0].append("state")
-        self.val[0] = self._verify_value(val)
+        super().__init__(self._verify_value(val))
 
     def _verify_value(self,val):
         if isinstance(val,str):
@@ -266,12 +507,10 @@ class SetCmd(SysCmd):
 class SetLedCmd(SysCmd):
 
     description = "Set device LED (On/Off)."
+    path = ("set_led_off", "off")
 
     def __init__(self,val=0):
-        super().__init__()
-        self.cmd[0].append("set_led_off")
-        self.cmd[0].append("off")
-        self.val[0] = self._verify_value(val)
+        super().__init__(self._verify_value(val))
 
     def _verify_value(self,val):
         if isinstance(val,str):
@@ -291,12 +530,10 @@ class SetLedCmd(SysCmd):
 class SetNameCmd(SysCmd):
 
     description = "Set device friendly name."
+    path = ("set_dev_alias", "alias")
 
     def __init__(self,val="TP-Link Device"):
-        super().__init__()
-        self.cmd[0].append("set_dev_alias")
-        self.cmd[0].append("alias")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
         if not isinstance(val,str):
@@ -307,12 +544,10 @@ class SetNameCmd(SysCmd):
 class SetMacCmd(SysCmd):
 
     description = "Set device MAC address"
+    path = ("set_mac_addr", "mac")
 
     def __init__(self,val="00:00:00:00:00:00"):
-        super().__init__()
-        self.cmd[0].append("set_mac_addr")
-        self.cmd[0].append("mac")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
         regex = r"(?:[0-9A-F]{2}[:]){5}(?:[0-9A-F]{2})"
@@ -324,30 +559,19 @@ class SetMacCmd(SysCmd):
 class SetLocationCmd(SysCmd):
 
     description = "Set device GEO location."
+    path = ("set_dev_location",)
 
     def __init__(self,val={"latitude": 48.8614 , "longitude": 2.3933}):
-        super().__init__()
-        self.cmd[0].append("set_dev_location")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("SetLocation command value must be a dictionary %s"% self.val[0])
-        if not set(['latitude', 'longitude']).issuperset(set(val.keys())):
-            raise ValueError("SetLocation command value must be a dictionary  %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['latitude', 'longitude'])
 
 
 class GetIconCmd(SysCmd):
 
     description = "Get device icon."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_dev_icon")
+    path = ("get_dev_icon",)
 
     def _verify_value(self,val):
         raise ValueError("GetIcon command does not need a value")
@@ -356,12 +580,10 @@ class GetIconCmd(SysCmd):
 class FWSetUrlCmd(SysCmd):
 
     description = "Set firmware download URL."
+    path = ("download_firmware", "url")
 
     def __init__(self,val="http://a.com/firmware.bin"):
-        super().__init__()
-        self.cmd[0].append("download_firmware")
-        self.cmd[0].append("url")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
         try:
@@ -377,10 +599,8 @@ class FWSetUrlCmd(SysCmd):
 class FWDownloadStateCmd(SysCmd):
 
     description = "Get firmware download progress."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_download_state")
+    path = ("get_download_state",)
+    record = DownloadState
 
     def _verify_value(self,val):
         raise ValueError("FWDownloadState command does not need a value")
@@ -389,10 +609,7 @@ class FWDownloadStateCmd(SysCmd):
 class FWFlashCmd(SysCmd):
 
     description = "Flash downloaded firmware."
-
-    def __init__(self,):
-        super().__init__()
-        self.cmd[0].append("flash_firmware")
+    path = ("flash_firmware",)
 
     def _verify_value(self,val):
         raise ValueError("FWFlash command does not need a value")
@@ -402,21 +619,17 @@ class FWFlashCmd(SysCmd):
 class WlanCmd(BasicCommand):
 
     description = None
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("netif")
+    path = ("netif",)
 
 
 class ScanCmd(WlanCmd):
 
     description = "Scan for available SSID."
+    path = ("get_scaninfo", "refresh")
+    record = ScanResult
 
     def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_scaninfo")
-        self.cmd[0].append("refresh")
-        self.val[0] = 1
+        super().__init__(1)
 
     def _verify_value(self,val):
         raise ValueError("Scan command does not need a value")
@@ -430,39 +643,25 @@ class ENCRYPT(IntEnum):
 class SetWifiCmd(WlanCmd):
 
     description = "Configure WiFi access."
+    path = ("set_stainfo",)
 
     def __init__(self,val={'ssid':'Wakanda', 'password':'Really Great P@$$w0Rd!', 'key_type': ENCRYPT.WPA2}):
-        super().__init__()
-        self.cmd[0].append("set_stainfo")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("SetWifi command value must be a dictionary %s"% self.val[0])
-        if not set(['ssid', 'password','key_type']).issuperset(set(val.keys())):
-            raise ValueError("SetWifi command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['ssid', 'password','key_type'])
 
 
 class CloudCmd(BasicCommand):
 
     description = None
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("cnCloud")
+    path = ("cnCloud",)
 
 
 class CloudInfoCmd(CloudCmd):
 
     description = "Get cloud info."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_info")
+    path = ("get_info",)
 
     def _verify_value(self,val):
         raise ValueError("CloudInfo command does not need a value")
@@ -471,10 +670,7 @@ class CloudInfoCmd(CloudCmd):
 class FWInfoCmd(CloudCmd):
 
     description = "Get available firmwares."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_intl_fw_list")
+    path = ("get_intl_fw_list",)
 
     def _verify_value(self,val):
         raise ValueError("FWInfo command does not need a value")
@@ -482,12 +678,10 @@ class FWInfoCmd(CloudCmd):
 class SetUrlCmd(CloudCmd):
 
     description = "Set cloud server."
+    path = ("set_server_url", "server")
 
     def __init__(self,val="devs.tplinkcloud.com"):
-        super().__init__()
-        self.cmd[0].append("set_server_url")
-        self.cmd[0].append("server")
-        self.val[0] = val
+        super().__init__(val)
 
     def _verify_value(self,val):
         try:
@@ -499,30 +693,19 @@ class SetUrlCmd(CloudCmd):
 class ConnectCmd(CloudCmd):
 
     description = "Login to cloud server."
+    path = ("bind",)
 
     def __init__(self,val={'username':'BruceWayne', 'password':'Really Great P@$$w0Rd!'}):
-        super().__init__()
-        self.cmd[0].append("bind")
-        self.val[0] = 1
+        super().__init__(val)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("Connect command value must be a dictionary %s"% self.val[0])
-        if not set(['username', 'password']).issuperset(set(val.keys())):
-            raise ValueError("Connect command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['username', 'password'])
 
 
 class DisconnectCmd(CloudCmd):
 
     description = "Logout from cloud server."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("unbind")
+    path = ("unbind",)
 
     def _verify_value(self,val):
         raise ValueError("Disconnect command does not need a value")
@@ -532,19 +715,13 @@ class DisconnectCmd(CloudCmd):
 class TimeCmd(BasicCommand):
 
     description = None
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("time")
+    path = ("time",)
 
 
 class GetTimeCmd(TimeCmd):
 
     description = "What time is it?"
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_time")
+    path = ("get_time",)
 
     def _verify_value(self,val):
         raise ValueError("GetTime command does not need a value")
@@ -553,10 +730,7 @@ class GetTimeCmd(TimeCmd):
 class GetTimeZoneCmd(TimeCmd):
 
     description = "Get device timezone."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_timezone")
+    path = ("get_timezone",)
 
     def _verify_value(self,val):
         raise ValueError("GetTimeZone command does not need a value")
@@ -565,43 +739,34 @@ class GetTimeZoneCmd(TimeCmd):
 class SetTimeCmd(TimeCmd):
 
     description = "Set device time/timezone."
+    path = ("set_timezone",)
 
     def __init__(self):
-        super().__init__()
-        self.cmd[0].append("set_timezone")
         now = dt.datetime.now()
-        self.val[0] = {"year":now.year,"month":now.month,"mday":now.day,"hour":now.hour,"min":now.minute,"sec":now.second,"index":42}
+        super().__init__({"year":now.year,"month":now.month,"mday":now.day,"hour":now.hour,"min":now.minute,"sec":now.second,"index":42})
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("SetTime command value must be a dictionary %s"% str(self.val[0]))
-        if not set(['year', 'month', 'mday', 'hour', 'min', 'sec', 'index']).issuperset(set(val.keys())):
-            raise ValueError("SetTime command value must be a dictionary %s"% str(self.val[0]))
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['year', 'month', 'mday', 'hour', 'min', 'sec', 'index'])
 
 # Power meter commands
 
 class MeterCmd(BasicCommand):
 
     description = None
+    path = ("emeter",)
+    light_root = "smartlife.iot.common.emeter"
 
-    def __init__(self,is_light=False):
-        super().__init__()
-        if is_light:
-            self.cmd[0].append("smartlife.iot.common.emeter")
-        else:
-            self.cmd[0].append("emeter")
+    def __init__(self, val=None, is_light=False):
+        super().__init__(val, is_light)
 
 class GetPowerCmd(MeterCmd):
 
     description = "Get current meter status."
+    path = ("get_realtime",)
+    record = RealtimeEmeter
 
     def __init__(self, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("get_realtime")
+        super().__init__(None, is_light)
 
     def _verify_value(self,val):
         raise ValueError("GetPower command does not need a value")
@@ -609,10 +774,10 @@ class GetPowerCmd(MeterCmd):
 class GetGainCmd(MeterCmd):
 
     description = "Get meter voltage/current gain."
+    path = ("get_vgain_igain",)
 
     def __init__(self, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("get_vgain_igain")
+        super().__init__(None, is_light)
 
     def _verify_value(self,val):
         raise ValueError("GetGain command does not need a value")
@@ -621,91 +786,61 @@ class GetGainCmd(MeterCmd):
 class SetGainCmd(MeterCmd):
 
     description = "Set meter voltage/current gain."
+    path = ("set_vgain_igain",)
 
     def __init__(self,val={'vgain':13462,'igain':16835}, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("set_vgain_igain")
-        self.val[0] = val
+        super().__init__(val, is_light)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("SetGain command value must be a dictionary %s"% self.val[0])
-        if not set(['vgain', 'igain']).issuperset(set(val.keys())):
-            raise ValueError("SetGain command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['vgain', 'igain'])
 
 
 class CalibrateCmd(MeterCmd):
 
     description = "Calibrate meter voltage/current gain."
+    path = ("start_calibration",)
 
     def __init__(self,val={'vtarget':13462,'itarget':16835}, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("start_calibration")
-        self.val[0] = val
+        super().__init__(val, is_light)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("Calibrate command value must be a dictionary %s"% self.val[0])
-        if not set(['vtarget', 'itarget']).issuperset(set(val.keys())):
-            raise ValueError("Calibrate command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['vtarget', 'itarget'])
 
 
 class GetStatsCmd(MeterCmd):
 
     description = "Get daily power usage."
+    path = ("get_daystat",)
+    record = DayStats
 
     def __init__(self, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("get_daystat")
-        now = dt.datetime.date()
-        self.val[0] = {"month":now.month,"year":now.year}
+        now = dt.date.today()
+        super().__init__({"month":now.month,"year":now.year}, is_light)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("GetStats command value must be a dictionary %s"% self.val[0])
-        if not set(['month', 'year']).issuperset(set(val.keys())):
-            raise ValueError("GetStats command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['month', 'year'])
 
 class GetMonthStatsCmd(MeterCmd):
 
     description = "Get monthly power usage."
+    path = ("get_monthstat",)
+    record = MonthStats
 
     def __init__(self, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("get_monthstat")
-        now = dt.datetime.date()
-        self.val[0] = {"year":now.year}
+        now = dt.date.today()
+        super().__init__({"year":now.year}, is_light)
 
     def _verify_value(self,val):
-        if not isinstance(val,dict):
-            raise ValueError("GetMonthStats command value must be a dictionary %s"% self.val[0])
-        if not set(['year']).issuperset(set(val.keys())):
-            raise ValueError("GetMonthStats command value must be a dictionary %s"% self.val[0])
-        if val == {}:
-            return self.val[0]
-        self.val.update(val)
-        return self.val
+        return self._merge_value(val, ['year'])
 
 
 class ResetStatsCmd(MeterCmd):
 
     description = "Reset power usage stats."
+    path = ("erase_emeter_stat",)
 
     def __init__(self, is_light=False):
-        super().__init__(is_light)
-        self.cmd[0].append("erase_emeter_stat")
+        super().__init__(None, is_light)
 
     def _verify_value(self,val):
         raise ValueError("ResetStats command does not need a value")
@@ -715,85 +850,80 @@ class ResetStatsCmd(MeterCmd):
 class LightCmd(BasicCommand):
 
     description = None
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("smartlife.iot.smartbulb.lightingservice")
-        self.translation["on_off"]="state"
+    path = ("smartlife.iot.smartbulb.lightingservice",)
+    translation = {"on_off": "state"}
 
 
 class GetLigthStateCmd(LightCmd):
 
     description = "Get light state information."
-
-    def __init__(self):
-        super().__init__()
-        self.cmd[0].append("get_light_state")
+    path = ("get_light_state",)
+    record = LightState
 
     def _verify_value(self,val):
         raise ValueError("GetLightState command does not need a value")
 
+
 class SetLightStateCmd(LightCmd):
 
     description = "Set light state (colour, brighness, temperature, on, off)."
+    path = ("transition_light_state",)
+
+    KEYS = ["hue", "saturation", "value", "brightness", "temperature", "state", "transition_period"]
 
-    def __init__(self, val=0):
+    def __init__(self, val=None):
         super().__init__()
-        self.cmd[0].append("transition_light_state")
-        self.val[0] = self._verify_value({"on_off": val})
+        if val is not None:
+            self.value = val
+
+    @staticmethod
+    def _check_int(val, key, low, high):
+        if isinstance(val, bool) or not isinstance(val,int) or val < low or val > high:
+            raise ValueError("SetLightState command value for %s must be an integer between %d and %d." % (key, low, high))
+        return val
 
     def _verify_value(self,val):
+        """Any combination of hue and saturation (together), brightness (or value),
+        temperature, state and transition_period (in msecs) is accepted. Colour and
+        temperature exclude each other."""
         if not isinstance(val,dict):
             raise ValueError("SetLightState command value must be a dictionary")
 
         if val == {}:
             return self.val[0]
 
-        if set(['hue', 'saturation', 'value']) == set(val.keys()):
-            thisval={"color_temp": 0}
-            if not isinstance(val["hue"],int) or val["hue"] < 0  or val["hue"] > 360:
-                raise ValueError("SetLightState command value for hue must be an integer between 0 and 360.")
-            else:
-                thisval["hue"] = val["hue"]
-
-            if not isinstance(val["saturation"],int) or val["saturation"] < 0  or val["saturation"] > 100:
-                raise ValueError("SetLightState command value for saturation must be an integer between 0 and 100.")
+        if not set(self.KEYS).issuperset(set(val.keys())) or \
+                ("hue" in val) != ("saturation" in val) or \
+                ("hue" in val and "temperature" in val) or \
+                ("value" in val and "brightness" in val):
+            raise ValueError("SetLightState command value does not contain the proper key combination")
+
+        thisval = {}
+        if "hue" in val:
+            thisval["color_temp"] = 0
+            thisval["hue"] = self._check_int(val["hue"], "hue", 0, 360)
+            thisval["saturation"] = self._check_int(val["saturation"], "saturation", 0, 100)
+
+        for key in ["value", "brightness"]:
+            if key in val:
+                thisval["brightness"] = self._check_int(val[key], key, 0, 100)
+
+        if "temperature" in val:
+            thisval["color_temp"] = self._check_int(val["temperature"], "temperature", 2500, 9000)
+
+        if "state" in val:
+            state = val["state"]
+            if isinstance(state,str) and state.lower() in ["on","off"]:
+                thisval["on_off"] = (state.lower()=="on" and 1) or 0
+            elif isinstance(state,bool) or state in [0,1]:
+                thisval["on_off"] = (state and 1) or 0
             else:
-                thisval["saturation"] = val["saturation"]
-
-            if not isinstance(val["value"],int) or val["value"] < 0  or val["value"] > 100:
-                raise ValueError("SetLightState command value for value must be an integer between 0 and 100.")
-            else:
-                thisval["brightness"] = val["value"]
-            return thisval
-
-        if set(['brightness']) == set(val.keys()):
-            if not isinstance(val["brightness"],int) or val["brightness"] < 0  or val["brightness"] > 100:
-                raise ValueError("SetLightState command value for brightness must be an integer between 0 and 100.")
-            return val
-
-        if set(['temperature']) == set(val.keys()):
-            if not isinstance(val["temperature"],int) or val["temperature"] < 2500  or val["temperature"] > 9000:
-                raise ValueError("SetLightState command value for temperature must be an integer between 2500 and 9000.")
-            return {"color_temp": val["temperature"]}
-
-
-        if set(['state']) == set(val.keys()):
-            thisval=val["state"]
-            if isinstance(thisval,str):
-                if thisval.lower() in ["on","off"]:
-                   val["on_off"] = (thisval.lower()=="on" and 1) or 0
-                else:
-                    raise ValueError("SetLightState command value for on_off must be \"on\"/1/True or \"off\"/0/False")
-
-            elif isinstance(thisval,bool):
-                val["on_off"] = (val and 1) or 0
-
-            elif not isinstance(thisval,int) or thisval not in [0,1]:
                 raise ValueError("SetLightState command value for on_off must be \"on\"/1/True or \"off\"/0/False")
-            return val
 
-        raise ValueError("SetLightState command value does not contain the proper key combination")
+        if "transition_period" in val:
+            thisval["transition_period"] = self._check_int(val["transition_period"], "transition_period", 0, 3600000)
+
+        return thisval
 
 class SetLightCmd(SetLightStateCmd):
     """ A shortcut"""
@@ -801,10 +931,7 @@ class SetLightCmd(SetLightStateCmd):
     description = "Set light state (On/Off)."
 
     def __init__(self,val=0):
-        super().__init__()
-        self.cmd[0].append("set_relay_state")
-        self.cmd[0].append("state")
-        self.val[0] = self._verify_value(val)
+        super().__init__(val)
 
     def _verify_value(self,val):
         if isinstance(val,str):
@@ -819,3 +946,231 @@ class SetLightCmd(SetLightStateCmd):
         if not isinstance(val,int) or val not in [0,1]:
             raise ValueError("Set command value must be \"on\"/1/True or \"off\"/0/False")
         return {"on_off": val}
+
+# Rules commands. Schedules, count downs and anti theft rules are stored and run
+# by the devices themselves. All three modules have the same methods.
+
+def _verify_new_rule(cname, val):
+    if not isinstance(val, dict):
+        raise ValueError("%s command value must be a dictionary" % cname)
+    if "id" in val:
+        raise ValueError("%s command value must not have an id" % cname)
+    return val
+
+def _verify_rule(cname, val):
+    if not isinstance(val, dict) or not isinstance(val.get("id"), str):
+        raise ValueError("%s command value must be a dictionary with an id" % cname)
+    return val
+
+def _verify_rule_id(cname, val):
+    if isinstance(val, str):
+        return {"id": val}
+    return _verify_rule(cname, val)
+
+def _verify_enable(cname, val):
+    if isinstance(val, bool) or val in [0, 1]:
+        return (val and 1) or 0
+    raise ValueError("%s command value must be 1/True or 0/False" % cname)
+
+
+class ScheduleCmd(BasicCommand):
+
+    description = None
+    path = ("schedule",)
+    light_root = "smartlife.iot.common.schedule"
+
+    def __init__(self, val=None, is_light=False):
+        super().__init__(val, is_light)
+
+
+class GetScheduleRulesCmd(ScheduleCmd):
+
+    description = "Get the schedule rules."
+    path = ("get_rules",)
+    record = RuleList
+
+    def _verify_value(self,val):
+        raise ValueError("GetScheduleRules command does not need a value")
+
+
+class AddScheduleRuleCmd(ScheduleCmd):
+
+    description = "Add a schedule rule."
+    path = ("add_rule",)
+
+    def _verify_value(self,val):
+        return _verify_new_rule("AddScheduleRule", val)
+
+
+class EditScheduleRuleCmd(ScheduleCmd):
+
+    description = "Change a schedule rule."
+    path = ("edit_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule("EditScheduleRule", val)
+
+
+class DeleteScheduleRuleCmd(ScheduleCmd):
+
+    description = "Delete a schedule rule."
+    path = ("delete_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule_id("DeleteScheduleRule", val)
+
+
+class DeleteAllScheduleRulesCmd(ScheduleCmd):
+
+    description = "Delete all schedule rules."
+    path = ("delete_all_rules",)
+
+    def _verify_value(self,val):
+        raise ValueError("DeleteAllScheduleRules command does not need a value")
+
+
+class EnableScheduleCmd(ScheduleCmd):
+
+    description = "Enable or disable all the schedule rules."
+    path = ("set_overall_enable", "enable")
+
+    def __init__(self, val=1, is_light=False):
+        super().__init__(_verify_enable("EnableSchedule", val), is_light)
+
+    def _verify_value(self,val):
+        return _verify_enable("EnableSchedule", val)
+
+
+class CountDownCmd(BasicCommand):
+
+    description = None
+    path = ("count_down",)
+    light_root = "smartlife.iot.common.count_down"
+
+    def __init__(self, val=None, is_light=False):
+        super().__init__(val, is_light)
+
+
+class GetCountDownRulesCmd(CountDownCmd):
+
+    description = "Get the count down rules."
+    path = ("get_rules",)
+    record = RuleList
+
+    def _verify_value(self,val):
+        raise ValueError("GetCountDownRules command does not need a value")
+
+
+class AddCountDownRuleCmd(CountDownCmd):
+
+    description = "Add a count down rule."
+    path = ("add_rule",)
+
+    def _verify_value(self,val):
+        return _verify_new_rule("AddCountDownRule", val)
+
+
+class EditCountDownRuleCmd(CountDownCmd):
+
+    description = "Change a count down rule."
+    path = ("edit_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule("EditCountDownRule", val)
+
+
+class DeleteCountDownRuleCmd(CountDownCmd):
+
+    description = "Delete a count down rule."
+    path = ("delete_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule_id("DeleteCountDownRule", val)
+
+
+class DeleteAllCountDownRulesCmd(CountDownCmd):
+
+    description = "Delete all count down rules."
+    path = ("delete_all_rules",)
+
+    def _verify_value(self,val):
+        raise ValueError("DeleteAllCountDownRules command does not need a value")
+
+
+class AntiTheftCmd(BasicCommand):
+
+    description = None
+    path = ("anti_theft",)
+    light_root = "smartlife.iot.common.anti_theft"
+
+    def __init__(self, val=None, is_light=False):
+        super().__init__(val, is_light)
+
+
+class GetAntiTheftRulesCmd(AntiTheftCmd):
+
+    description = "Get the anti theft rules."
+    path = ("get_rules",)
+    record = RuleList
+
+    def _verify_value(self,val):
+        raise ValueError("GetAntiTheftRules command does not need a value")
+
+
+class AddAntiTheftRuleCmd(AntiTheftCmd):
+
+    description = "Add an anti theft rule."
+    path = ("add_rule",)
+
+    def _verify_value(self,val):
+        return _verify_new_rule("AddAntiTheftRule", val)
+
+
+class EditAntiTheftRuleCmd(AntiTheftCmd):
+
+    description = "Change an anti theft rule."
+    path = ("edit_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule("EditAntiTheftRule", val)
+
+
+class DeleteAntiTheftRuleCmd(AntiTheftCmd):
+
+    description = "Delete an anti theft rule."
+    path = ("delete_rule",)
+
+    def _verify_value(self,val):
+        return _verify_rule_id("DeleteAntiTheftRule", val)
+
+
+class DeleteAllAntiTheftRulesCmd(AntiTheftCmd):
+
+    description = "Delete all anti theft rules."
+    path = ("delete_all_rules",)
+
+    def _verify_value(self,val):
+        raise ValueError("DeleteAllAntiTheftRules command does not need a value")
+
+
+class EnableAntiTheftCmd(AntiTheftCmd):
+
+    description = "Enable or disable all the anti theft rules."
+    path = ("set_overall_enable", "enable")
+
+    def __init__(self, val=1, is_light=False):
+        super().__init__(_verify_enable("EnableAntiTheft", val), is_light)
+
+    def _verify_value(self,val):
+        return _verify_enable("EnableAntiTheft", val)
+
+
+RuleCommands = namedtuple("RuleCommands", ["get", "add", "edit", "delete", "delete_all"])
+
+# The commands of each rules module
+RULE_MODULES = {"schedule": RuleCommands(GetScheduleRulesCmd, AddScheduleRuleCmd, EditScheduleRuleCmd,
+                                         DeleteScheduleRuleCmd, DeleteAllScheduleRulesCmd),
+                "count_down": RuleCommands(GetCountDownRulesCmd, AddCountDownRuleCmd, EditCountDownRuleCmd,
+                                           DeleteCountDownRuleCmd, DeleteAllCountDownRulesCmd),
+                "anti_theft": RuleCommands(GetAntiTheftRulesCmd, AddAntiTheftRuleCmd, EditAntiTheftRuleCmd,
+                                           DeleteAntiTheftRuleCmd, DeleteAllAntiTheftRulesCmd)}
@@ -25,9 +25,14 @@
 
 import asyncio as aio
 from . import commands
+from .events import FLEET_BUS
+from .shaper import TRAFFIC_SHAPER
+from .responses import RealtimeEmeter
+from .rules import count_down_rule
+from .capture import CAPTURE, IN, OUT
 import logging
 import socket
-from struct import pack
+from struct import pack, unpack
 
 try:
     xx =aio.create_task
@@ -35,6 +40,9 @@ except:
     aio.create_task = aio.ensure_future
 
 HBTIMEOUT = 30  #Poll the device every 30 secs by default
+HBMAXAGE = 1 #The heartbeat may reuse a status read by someone else less than HBMAXAGE secs ago
+QUERYTIMEOUT = 2
+CMDTIMEOUT = 5 #Secs to wait for a reply, a device that never answers must not hold the connection lock
 logging.getLogger('frawau.aiotplink').addHandler(logging.NullHandler())
 
 
@@ -55,32 +63,120 @@ TPLINK_PLUGS = { 'HS100' : {"led": True, "emeter": False},
                  'HS107' : {"led": True, "emeter": False},
                  'HS110' : {"led": True, "emeter": True},
                  'KP100' : {"led": False, "emeter": False},
+                 'HS300' : {"led": True, "emeter": True, "outlets": 6},
+                 'KP303' : {"led": True, "emeter": False, "outlets": 3},
+                 'KP400' : {"led": True, "emeter": False, "outlets": 2},
     }
 
 class TPProtocol(aio.Protocol):
     """The way the TP-Link protocol works, it opens a connection to the device, send a command
     wait for the response and finally closes the connection.  Here we take care of all this in an
     asyncio way. This behaviour implies that the device need to be polled for info.
+
+    Large replies may come in several chunks, they are reassembled using the length header.
+    Decoding follows commands.DECODE_POLICY. With autosend False, the command is only sent
+    when send is called, this lets us open connections ahead of time.
     """
-    def __init__(self, cmd, future):
+    def __init__(self, cmd, future, autosend=True):
         self.transport = None
         self.cmd = cmd
         self.future = future
+        self.autosend = autosend
+        self.buffer = bytearray()
+        self.complete = False
+        self.capture_id = None # Set when capture.CAPTURE records the connection
 
     def connection_made(self, transport):
         self.transport = transport
-        self.send(self.cmd.command)
+        self.capture_id = CAPTURE.tcp_open(transport)
+        if self.autosend:
+            self.send(self.cmd.command)
 
     def send(self,data):
+        CAPTURE.tcp(self.capture_id, OUT, data)
         self.transport.write(data)
 
     def data_received(self, data):
-        self.future.set_result(self.cmd.response(data))
+        CAPTURE.tcp(self.capture_id, IN, data)
+        self.buffer += data
+        if len(self.buffer) < 4:
+            return
+        length = unpack('>I', self.buffer[:4])[0]
+        if len(self.buffer) < length + 4:
+            return
+        payload = bytes(self.buffer[4:length + 4])
+        self.buffer = self.buffer[length + 4:]
+        self.complete = True
+        self.transport.close()
+        commands.DECODE_POLICY.decode(payload, self._decoded, self._failed)
+
+    def _decoded(self, resp):
+        if self.future.done():
+            return
+        try:
+            self.future.set_result(self.cmd.process(resp))
+        except Exception as e:
+            self.future.set_exception(e)
+            return
         logging.debug('We received: {}'.format(self.future.result()))
 
+    def _failed(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
     def connection_lost(self, exc):
         logging.debug('The server closed the connection.')
+        CAPTURE.tcp_close(self.capture_id)
         self.transport.close()
+        if not self.complete and not self.future.done():
+            self.future.set_exception(exc or commands.TPLException("Connection closed before a full reply"))
+
+class TPPipelineProtocol(TPProtocol):
+    """Several commands on one connection. All the frames are written at once,
+    the device answers them in order, so it costs a single round trip.
+    The future gets the list of replies."""
+
+    def __init__(self, cmds, future):
+        super().__init__(None, future)
+        self.cmds = cmds
+        self.results = [None] * len(cmds)
+        self.received = 0
+        self.decoded = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.capture_id = CAPTURE.tcp_open(transport)
+        self.send(b"".join(x.command for x in self.cmds))
+
+    def data_received(self, data):
+        CAPTURE.tcp(self.capture_id, IN, data)
+        self.buffer += data
+        while len(self.buffer) >= 4 and self.received < len(self.cmds):
+            length = unpack('>I', self.buffer[:4])[0]
+            if len(self.buffer) < length + 4:
+                return
+            payload = bytes(self.buffer[4:length + 4])
+            self.buffer = self.buffer[length + 4:]
+            idx = self.received
+            self.received += 1
+            if self.received == len(self.cmds):
+                self.complete = True
+                self.transport.close()
+            commands.DECODE_POLICY.decode(payload, lambda resp, idx=idx: self._decoded_one(idx, resp),
+                                          self._failed)
+
+    def _decoded_one(self, idx, resp):
+        if self.future.done():
+            return
+        try:
+            self.results[idx] = self.cmds[idx].process(resp)
+        except Exception as e:
+            self.future.set_exception(e)
+            return
+        self.decoded += 1
+        if self.decoded == len(self.cmds):
+            self.future.set_result(self.results)
+
 
 class TPDevice(object):
     """Define the common characteristics of TP-Link IoT devices"""
@@ -94,48 +190,114 @@ class TPDevice(object):
         self._exclusive = aio.Lock() #To make sure that we only have one connection at a time
         self.onCmd = commands.SetCmd
         self.on_change = on_change #Callback when state change is detected
+        self.event_bus = FLEET_BUS #Where change events are published
+        self.shaper = TRAFFIC_SHAPER #Limits the connections to the device subnet or access point
         self.caps = {"emeter": False}
         self.is_light = False
         self.hb = aio.ensure_future(self.heartbeat())
         self.location = None
         self.mac = None
+        self.model = None
         self.led = None
+        self.last_heartbeat = None # loop time of the last successful status query
+        self.last_status = None # What that query returned
+        self._inflight = None # The status query being run, shared by all readers
+        self.power = None
+        self.poll_policy = None # Adaptive polling, see polling.AdaptivePoll
+        self.poll_interval = None
+        self._next_poll = None
+        self.passive = False # Status also comes from discovery replies, see passive_update
         self._pending_value = {}
+        self._tasks = set() # Commands sent by the setters, until they are done
+        self._offline_sent = False # {"online": False} was reported, and not {"online": True} since
+
 
+    async def _open(self, cmd, future, autosend=True):
+        """Open a connection to the device for cmd, the reply goes to future"""
+        loop = aio.get_event_loop()
+        return await loop.create_connection(lambda: TPProtocol(cmd, future, autosend),
+                                            self.addr, self.port)
 
-    async def _send_cmd(self, cmd, callb=None):
-        async with self._exclusive:
+    async def _send_cmd(self, cmd, callb=None, timeout=CMDTIMEOUT):
+        """Send cmd and return the reply. timeout covers connecting and the reply,
+        not the wait for the connection lock and the traffic shaper."""
+        async with self._exclusive, self.shaper.slot(self.addr):
             loop = aio.get_event_loop()
+            deadline = loop.time() + timeout
             resu = loop.create_future()
-            coro = loop.create_connection(lambda: TPProtocol(cmd,resu),
-                                            self.addr, self.port)
-            t, p = await coro
+            t, p = await aio.wait_for(_opened(self._open(cmd, resu), resu), timeout)
             try:
-                await resu
+                await aio.wait_for(resu, deadline - loop.time())
                 if callb:
                     callb(resu.result())
+            except aio.TimeoutError:
+                raise
             except Exception as e:
                 logging.debug("Exception while sending: {}".format(e))
+            finally:
+                _abort(t, resu)
             return resu.result()
 
 
+    async def _send_cmds(self, cmds, timeout=CMDTIMEOUT):
+        """Send several commands on one connection, return their replies in order"""
+        async with self._exclusive, self.shaper.slot(self.addr):
+            loop = aio.get_event_loop()
+            deadline = loop.time() + timeout
+            resu = loop.create_future()
+            t, p = await aio.wait_for(_opened(loop.create_connection(lambda: TPPipelineProtocol(cmds, resu),
+                                                                     self.addr, self.port), resu), timeout)
+            try:
+                return await aio.wait_for(resu, deadline - loop.time())
+            finally:
+                _abort(t, resu)
+
+    def _command(self, cmd, callb, *keys, owner=None):
+        """Send a setter command in the background, return its task. Unless the
+        command succeeds, the values it left in _pending_value, of owner if
+        given, are dropped."""
+        pending = (owner or self)._pending_value
+        values = {x: pending.get(x) for x in keys}
+        task = aio.ensure_future(self._send_cmd(cmd, callb))
+        self._tasks.add(task)
+
+        def done(task):
+            self._tasks.discard(task)
+            for key, val in values.items():
+                #Unless a later setter replaced it
+                if key in pending and pending[key] == val:
+                    del(pending[key])
+            if not task.cancelled() and task.exception():
+                logging.debug("Command failed for {}: {}".format(self.name, task.exception()))
+
+        task.add_done_callback(done)
+        return task
+
+    def _notify(self, changes):
+        """Report state changes to the on_change callback and the event bus"""
+        if self.on_change:
+            self.on_change(changes)
+        if self.event_bus:
+            self.event_bus.publish(self, changes)
+
     def _set_state(self, val):
         if not self.online:
             raise commands.TPLException("Device is offline")
         if "state" in self._pending_value:
             self.state = self._pending_value["state"]
             del(self._pending_value["state"])
+            self._write_through({"state": self.state})
 
 
     def on(self):
         self._pending_value["state"] = "on"
-        cmd = self.onCmd("on")
-        ign = aio.create_task(self._send_cmd(cmd,self._set_state))
+        cmd = commands.get_template(self.onCmd)("on")
+        return self._command(cmd, self._set_state, "state")
 
     def off(self):
         self._pending_value["state"] = "off"
-        cmd = self.onCmd("off")
-        ign = aio.create_task(self._send_cmd(cmd,self._set_state))
+        cmd = commands.get_template(self.onCmd)("off")
+        return self._command(cmd, self._set_state, "state")
 
 
     def _set_name(self, val):
@@ -144,66 +306,211 @@ class TPDevice(object):
         if "name" in self._pending_value:
             self.name = self._pending_value["name"]
             del(self._pending_value["name"])
+            self._write_through({"name": self.name})
 
 
     def set_name(self, name):
         self._pending_value["name"] = name
-        cmd = commands.SetNameCmd(name)
-        ign = aio.create_task(self._send_cmd(cmd,self._set_name))
-
+        cmd = commands.get_template(commands.SetNameCmd)(name)
+        return self._command(cmd, self._set_name, "name")
+
+
+    def _rule_cmd(self, module, kind, val=None):
+        cmd = getattr(commands.RULE_MODULES[module], kind)(None, self.is_light)
+        if val is not None:
+            cmd.value = val
+        return cmd
+
+    async def get_rules(self, module="schedule"):
+        """The rules stored on the device for module, "schedule", "count_down" or "anti_theft"."""
+        resu = await self._send_cmd(self._rule_cmd(module, "get"))
+        return resu.get("rule_list", [])
+
+    async def add_rule(self, rule, module="schedule"):
+        """Store a rule on the device, see the rules module. Return its id."""
+        resu = await self._send_cmd(self._rule_cmd(module, "add", rule))
+        return resu.get("id")
+
+    async def edit_rule(self, rule, module="schedule"):
+        """Change a stored rule, rule must have the "id" of the rule to change"""
+        await self._send_cmd(self._rule_cmd(module, "edit", rule))
+
+    async def delete_rule(self, rule_id, module="schedule"):
+        await self._send_cmd(self._rule_cmd(module, "delete", rule_id))
+
+    async def delete_all_rules(self, module="schedule"):
+        await self._send_cmd(self._rule_cmd(module, "delete_all"))
+
+    async def count_down(self, action, delay, name="count down"):
+        """Have the device switch itself on or off in delay secs. Devices
+        only have one count down, it replaces the previous one."""
+        await self._send_cmds([self._rule_cmd("count_down", "delete_all"),
+                               self._rule_cmd("count_down", "add", count_down_rule(name, action, delay))])
+
+    def _status_cmd(self):
+        if self.is_light:
+            cmd = commands.GetLigthStateCmd()
+        else:
+            cmd = commands.InfoCmd()
+        if self.caps["emeter"]:
+            cmd += commands.GetPowerCmd()
+        return cmd
+
+    async def _fetch_status(self, timeout=QUERYTIMEOUT):
+        return await self._send_cmd(self._status_cmd(), timeout=timeout)
+
+    async def _query(self):
+        try:
+            #A device only held back by the shaper is not offline, the timeout is for its reply
+            resu = await self._fetch_status()
+            self.last_status = resu
+            self.last_heartbeat = aio.get_event_loop().time()
+            return resu
+        finally:
+            self._inflight = None
+
+    async def read(self, max_age=None):
+        """Return the device status.
+
+        If the last status is no older than max_age secs, it is returned without
+        asking the device. Otherwise the device is queried, and all the callers
+        reading at the same time share that one query.
+        """
+        if max_age is not None and self.last_status is not None and \
+                aio.get_event_loop().time() - self.last_heartbeat <= max_age:
+            return self.last_status
+        if self._inflight is None:
+            self._inflight = aio.ensure_future(self._query())
+            #All its readers may give up, e.g. on stop(), the error is theirs to report
+            self._inflight.add_done_callback(lambda x: x.cancelled() or x.exception())
+        return await aio.shield(self._inflight)
+
+    def _update_status(self, resu):
+        """Apply a status reply to the device and report what changed.
+
+        Return True if something worth polling faster for changed.
+        """
+        if self.mac is None:
+            if "mac" in resu:
+                self.mac = resu["mac"]
+            if "latitude" in resu:
+                self.location = (resu["latitude"], resu["longitude"])
+        schange={}
+
+        if "led" in resu and resu["led"] != self.led :
+            schange["led"] = resu["led"]
+            self.led = resu["led"]
+        if "state" in resu and resu["state"] != self.state :
+            schange["state"] = resu["state"]
+            self.state = resu["state"]
+        significant = bool(schange)
+        if 'current' in resu:
+            if self.poll_policy and self.poll_policy.power_changed(self.power, resu.get("power")):
+                significant = True
+            self.power = resu.get("power")
+            for key in ['current','voltage', 'power','total']:
+                try:
+                    schange[key] = resu[key]
+                except:
+                    pass
+
+        if schange:
+            self._notify(schange)
+        return significant
+
+    async def _wait_next_poll(self, changed):
+        """Sleep until the next poll. The deadline may be pushed back while we sleep."""
+        loop = aio.get_event_loop()
+        if self.poll_policy:
+            interval = self.poll_policy.next_interval(self, changed)
+        else:
+            interval = self.hbto
+        self._next_poll = loop.time() + interval
+        while self.hbto:
+            delay = self._next_poll - loop.time()
+            if delay <= 0:
+                break
+            await aio.sleep(delay)
+
+    def _write_through(self, changes):
+        """A set command succeeded. Report the new local state and, with a
+        poll policy, push the next poll back since we know the state."""
+        self._notify(changes)
+        if self.poll_policy and self._next_poll is not None:
+            self._next_poll = max(self._next_poll,
+                                  aio.get_event_loop().time() + self.poll_policy.hold_off(self))
+
+    def _passive_status(self, resu):
+        """The status of a discovery reply, in the shape read() returns"""
+        return resu
+
+    def passive_update(self, resu):
+        """A status was received without polling, e.g. a discovery reply.
+
+        resu is the flattened sysinfo, with emeter values if any.
+        """
+        resu = self._passive_status(resu)
+        self._back_online()
+        self.last_status = resu
+        self.last_heartbeat = aio.get_event_loop().time()
+        self._update_status(resu)
+
+    def _back_online(self):
+        self.online = True
+        if self._offline_sent:
+            self._offline_sent = False
+            self._notify({"online": True})
+
+    def _passive_fresh(self):
+        """In passive mode, do we have a status recent enough to skip polling?"""
+        if not self.passive or self.last_heartbeat is None:
+            return False
+        age = aio.get_event_loop().time() - self.last_heartbeat
+        return age < (self.poll_interval or self.hbto)
 
     async def heartbeat(self):
-        wassent = False
         while True:
             #logging.debug("Heartbeat for {}".format(self.name))
-            #if True:
-            if self.is_light:
-                cmd = commands.GetLigthStateCmd
-            else:
-                cmd = commands.InfoCmd()
-            if self.caps["emeter"]:
-                cmd += commands.GetPowerCmd()
+            if self._passive_fresh():
+                #Discovery keeps us up to date, no need to poll.
+                if not self.hbto:
+                    break
+                await self._wait_next_poll(False)
+                continue
+            if self.poll_policy and self.poll_policy.budget:
+                await self.poll_policy.budget.acquire()
             resu = {}
+            changed = False
             try:
-                resu = await aio.wait_for(self._send_cmd(cmd),timeout=2)
-                wassent = False
-            except:
+                resu = await self.read(HBMAXAGE)
+                self._back_online()
+            except aio.CancelledError:
+                raise
+            except Exception:
                 logging.debug("Heartbeat timeout for {}".format(self.name))
-                if self.on_change and not wassent:
+                if not self._offline_sent:
                     self.state = None
-                    self.on_change({"online":False})
-                wassent = True
+                    self._notify({"online":False})
+                    changed = True
+                self._offline_sent = True
                 self.online = False
-            if not wassent and self.mac is None:
-                if "mac" in resu:
-                    self.mac = resu["mac"]
-                if "latitude" in resu:
-                    self.location = (resu["latitude"], resu["longitude"])
-            schange={}
-
-            if "led" in resu and resu["led"] != self.led :
-                schange["led"] = resu["led"]
-                self.led = resu["led"]
-            if "state" in resu and resu["state"] != self.state :
-                schange["state"] = resu["state"]
-                self.state = resu["state"]
-            if 'current' in resu:
-                for key in ['current','voltage', 'power','total']:
-                    try:
-                        schange[key] = resu[key]
-                    except:
-                        pass
-
-            if schange and self.on_change:
-                self.on_change(schange)
-            if self.hbto:
-                await aio.sleep(self.hbto)
-
-            else:
+            if resu:
+                changed = self._update_status(resu) or changed
+            if not self.hbto:
+                break
+            await self._wait_next_poll(changed)
+            if not self.hbto:
                 break
 
     def stop(self):
+        """Stop polling, and drop the commands and the status query not done yet"""
         self.hbto = 0
+        if self.hb and not self.hb.done():
+            self.hb.cancel()
+        if self._inflight and not self._inflight.done():
+            self._inflight.cancel()
+        for task in list(self._tasks):
+            task.cancel()
 
 class TPSmartDevice(TPDevice):
 
@@ -213,13 +520,13 @@ class TPSmartDevice(TPDevice):
 
     def led_on(self):
         self._pending_value["led"] = "on"
-        cmd = commands.SetLedCmd("on")
-        ign = aio.create_task(self._send_cmd(cmd,self._set_ledstate))
+        cmd = commands.get_template(commands.SetLedCmd)("on")
+        return self._command(cmd, self._set_ledstate, "led")
 
     def led_off(self):
         self._pending_value["led"] = "off"
-        cmd = commands.SetLedCmd("off")
-        ign = aio.create_task(self._send_cmd(cmd,self._set_ledstate))
+        cmd = commands.get_template(commands.SetLedCmd)("off")
+        return self._command(cmd, self._set_ledstate, "led")
 
     def _set_ledstate(self, val):
         if not self.online:
@@ -227,6 +534,222 @@ class TPSmartDevice(TPDevice):
         if "led" in self._pending_value:
             self.led = self._pending_value["led"]
             del(self._pending_value["led"])
+            self._write_through({"led": self.led})
+
+def _onoff(val):
+    return (val and "on") or "off"
+
+async def _opened(connect, future):
+    """Await the connection. If that fails, or is cancelled, nobody will wait
+    for future, drop it so its exception is not reported as never retrieved."""
+    try:
+        return await connect
+    except BaseException:
+        future.cancel()
+        raise
+
+def _abort(transport, future):
+    """A command ended, maybe timed out or cancelled, do not leave its connection open"""
+    if not future.done():
+        future.cancel()
+    transport.close()
+
+
+class TPOutlet(object):
+    """One outlet of a power strip.
+
+    Outlets are polled together with their strip, and switching several
+    outlets at once is sent to the strip as a single request. Changes are
+    reported through the strip callback and event bus, with the outlet index.
+    """
+
+    def __init__(self, strip, index, child_id, name=None):
+        self.strip = strip
+        self.index = index
+        self.child_id = child_id
+        self.name = name
+        self.state = None
+        self.power = None
+        self.meter = {}
+        self.caps = {"emeter": strip.caps.get("outlet_emeter", False)}
+        self._pending_value = {}
+
+    @property
+    def mac(self):
+        return self.strip.mac
+
+    @property
+    def model(self):
+        return self.strip.model
+
+    @property
+    def online(self):
+        return self.strip.online
+
+    def _notify(self, changes):
+        changes = dict(changes, outlet=self.index)
+        if self.strip.on_change:
+            self.strip.on_change(changes)
+        if self.strip.event_bus:
+            self.strip.event_bus.publish(self, changes)
+
+    def _write_through(self, changes):
+        self._notify(changes)
+
+    def _update_status(self, child, meter=None):
+        """Apply this outlet entry of the strip sysinfo, and its meter reading if any"""
+        schange = {}
+        state = _onoff(child.get("state"))
+        if state != self.state:
+            schange["state"] = self.state = state
+        if child.get("alias") is not None and child["alias"] != self.name:
+            schange["name"] = self.name = child["alias"]
+        significant = bool(schange)
+        if meter:
+            if self.strip.poll_policy and self.strip.poll_policy.power_changed(self.power, meter.get("power")):
+                significant = True
+            self.power = meter.get("power")
+            self.meter = meter
+            schange.update(meter)
+        if schange:
+            self._notify(schange)
+        return significant
+
+    def on(self):
+        return self.strip._switch([self], "on")
+
+    def off(self):
+        return self.strip._switch([self], "off")
+
+    def _set_name(self, val):
+        if "name" in self._pending_value:
+            self.name = self._pending_value.pop("name")
+            self._write_through({"name": self.name})
+
+    def set_name(self, name):
+        self._pending_value["name"] = name
+        cmd = commands.SetNameCmd(name).for_children([self.child_id])
+        return self.strip._command(cmd, self._set_name, "name", owner=self)
+
+    async def read(self, max_age=None):
+        """Return the outlet status, read with the strip one."""
+        resu = await self.strip.read(max_age)
+        for child in resu.get("children", []):
+            if self.strip._child_id(child) == self.child_id:
+                status = {"name": child.get("alias"), "state": _onoff(child.get("state"))}
+                status.update(resu.get("emeters", {}).get(self.child_id, {}))
+                return status
+        return {}
+
+
+class TPStrip(TPSmartDevice):
+    """A power strip, its outlets are in "outlets" once the first status is read.
+
+    Status and, with an emeter, the reading of every outlet are fetched over a
+    single connection. Outlets switched during the same loop iteration are
+    sent to the strip in one request.
+    """
+
+    def __init__(self, name, addr, hb = HBTIMEOUT, on_change=None):
+        super().__init__(name, addr, hb, on_change)
+        self.caps["emeter"] = False # Only the outlets have a meter
+        self.caps["outlet_emeter"] = False
+        self.device_id = None
+        self.outlets = []
+        self._switching = {} # child id -> state, sent at the next loop iteration
+        self._switch_task = None
+
+    def _child_id(self, child):
+        #Older firmwares only give the outlet number
+        cid = child.get("id", "")
+        if len(cid) <= 2 and self.device_id:
+            cid = self.device_id + cid
+        return cid
+
+    def _status_cmd(self):
+        return commands.InfoCmd()
+
+    async def _fetch_status(self, timeout=QUERYTIMEOUT):
+        cmds = [self._status_cmd()]
+        if self.caps["outlet_emeter"]:
+            cmds += [commands.GetPowerCmd().for_children([x.child_id]) for x in self.outlets]
+        replies = await self._send_cmds(cmds, timeout)
+        resu = replies[0]
+        if len(replies) > 1:
+            resu["emeters"] = {}
+            for outlet, reply in zip(self.outlets, replies[1:]):
+                rec = RealtimeEmeter(reply)
+                resu["emeters"][outlet.child_id] = {"current": rec.current, "voltage": rec.voltage,
+                                                    "power": rec.power, "total": rec.total}
+        return resu
+
+    def _sync_outlets(self, children):
+        if len(children) != len(self.outlets):
+            self.outlets = [TPOutlet(self, idx, self._child_id(child), child.get("alias"))
+                            for idx, child in enumerate(children)]
+
+    def _update_status(self, resu):
+        if self.device_id is None and "deviceId" in resu:
+            self.device_id = resu["deviceId"]
+        significant = False
+        if "children" in resu:
+            self._sync_outlets(resu["children"])
+            emeters = resu.get("emeters", {})
+            for outlet, child in zip(self.outlets, resu["children"]):
+                significant = outlet._update_status(child, emeters.get(outlet.child_id)) or significant
+            resu = dict(resu)
+            resu["state"] = _onoff(any(x.state == "on" for x in self.outlets))
+        return super()._update_status(resu) or significant
+
+    def on(self):
+        if self.outlets:
+            return self._switch(self.outlets, "on")
+        return super().on()
+
+    def off(self):
+        if self.outlets:
+            return self._switch(self.outlets, "off")
+        return super().off()
+
+    def stop(self):
+        super().stop()
+        #The flush task is cancelled with the others, do not leave its batch behind
+        self._switching = {}
+        self._switch_task = None
+
+    def _switch(self, outlets, state):
+        for outlet in outlets:
+            self._switching[outlet.child_id] = state
+        if self._switch_task is None:
+            #The task only runs once the current callbacks are done, so
+            #whatever outlet is switched meanwhile is sent with it.
+            self._switch_task = aio.ensure_future(self._flush_switch())
+            self._tasks.add(self._switch_task)
+            self._switch_task.add_done_callback(self._tasks.discard)
+        return self._switch_task
+
+    async def _flush_switch(self):
+        switching, self._switching = self._switching, {}
+        self._switch_task = None
+        cmds = []
+        for state in ["on", "off"]:
+            ids = [cid for cid, val in switching.items() if val == state]
+            if ids:
+                cmds.append(commands.SetCmd(state).for_children(ids))
+        try:
+            await self._send_cmds(cmds)
+        except Exception as e:
+            logging.debug("Could not switch outlets of {}: {}".format(self.name, e))
+            return
+        for outlet in self.outlets:
+            if outlet.child_id in switching and outlet.state != switching[outlet.child_id]:
+                outlet.state = switching[outlet.child_id]
+                outlet._write_through({"state": outlet.state})
+        state = _onoff(any(x.state == "on" for x in self.outlets))
+        if state != self.state:
+            self.state = state
+            self._write_through({"state": state})
+
 
 class TPLight(TPDevice):
     """Define the light characteristics"""
@@ -237,14 +760,53 @@ class TPLight(TPDevice):
         self.is_light = True
         self.caps = {"colour": False, "temperature":(2700,5000), "emeter": False}
         self.colour = {"temperature":2700, "brightness": 100, "hue": 0, "saturation": 0}
+        self.transition_period = None # msecs the bulb takes to reach a new state, None is the bulb default
+        self.effect = None # The effect being played, see play_effect
+
+    def light_state_cmd(self, val):
+        """A SetLightStateCmd for val, with the light transition period"""
+        if self.transition_period is not None:
+            val = dict(val, transition_period=self.transition_period)
+        return commands.SetLightStateCmd(val)
+
+    def play_effect(self, effect, max_rate=None, min_rate=None):
+        """Play an effect on the light, stopping the one being played if any.
+        Return the effects.EffectRunner, its "task" ends with the effect."""
+        from .effects import EffectRunner
+        self.stop_effect()
+        kwargs = {}
+        if max_rate:
+            kwargs["max_rate"] = max_rate
+        if min_rate:
+            kwargs["min_rate"] = min_rate
+        self.effect = EffectRunner(self, effect, **kwargs)
+        self.effect.start()
+        return self.effect
+
+    def _passive_status(self, resu):
+        light = resu.get("light_state")
+        if not isinstance(light, dict):
+            return resu
+        status = {(key == "on_off" and "state") or key: val for key, val in light.items()}
+        for key in ["mac", "current", "voltage", "power", "total"]:
+            if key in resu:
+                status[key] = resu[key]
+        return status
+
+    def _update_status(self, resu):
+        #get_light_state gives on_off as 1/0, the setters use "on"/"off"
+        if "state" in resu and not isinstance(resu["state"], str):
+            resu = dict(resu, state=_onoff(resu["state"]))
+        return super()._update_status(resu)
+
+    def stop_effect(self):
+        if self.effect:
+            self.effect.stop()
+            self.effect = None
 
-    def _set_state(self, val):
-        if not self.online:
-            raise commands.TPLException("Device is offline")
-        if self._pending_state:
-            self.state = self._pending_state
-            self._pending_state = None
-
+    def stop(self):
+        self.stop_effect()
+        super().stop()
 
     def _set_brightness(self, val):
         if not self.online:
@@ -252,11 +814,12 @@ class TPLight(TPDevice):
         if "brightness" in self._pending_value:
             self.colour["brightness"] = self._pending_value["brightness"]
             del(self._pending_value["brightness"])
+            self._write_through({"brightness": self.colour["brightness"]})
 
     def set_brightness(self, val):
         self._pending_value["brightness"] = val
-        cmd = commands.SetLightStateCmd({"brightness":val})
-        ign = aio.create_task(self._send_cmd(cmd,self._set_brightness))
+        cmd = self.light_state_cmd({"brightness":val})
+        return self._command(cmd, self._set_brightness, "brightness")
 
 class TPWhiteLight(TPLight):
     """Define the light characteristics"""
@@ -272,11 +835,12 @@ class TPWhiteLight(TPLight):
             self.colour["temperature"] = self._pending_value["temperature"]
 
             del(self._pending_value["temperature"])
+            self._write_through({"temperature": self.colour["temperature"]})
 
     def set_temperature(self, val):
         self._pending_value["temperature"] = val
-        cmd = commands.SetLightStateCmd({"temperature":val})
-        ign = aio.create_task(self._send_cmd(cmd,self._set_temperature))
+        cmd = self.light_state_cmd({"temperature":val})
+        return self._command(cmd, self._set_temperature, "temperature")
 
 
 
@@ -290,36 +854,49 @@ class TPColourLight(TPWhiteLight):
     def _set_colour(self, val):
         if not self.online:
             raise commands.TPLException("Device is offline")
+        changes = {}
         for key in ["hue","saturation","brightness"]:
             if key in self._pending_value:
                 self.colour[key] = self._pending_value[key]
                 del(self._pending_value[key])
+                changes[key] = self.colour[key]
+        if changes:
+            self._write_through(changes)
 
 
     def set_colour(self, hue, saturation, value):
         self._pending_value["hue"] = hue
         self._pending_value["saturation"] = saturation
         self._pending_value["brightness"] = value
-        cmd = commands.SetLightStateCmd({"hue":hue,"":saturation,"brightness":value})
+        cmd = self.light_state_cmd({"hue":hue,"saturation":saturation,"value":value})
+        return self._command(cmd, self._set_colour, "hue", "saturation", "brightness")
 
 
 def GetDevice(addr,info,hb=HBTIMEOUT,on_change=lambda x: print(x)):
     """Based on infos returned from discovery, return a device"""
+    dev = None
     if "model" in info:
         if info["model"][:2].upper() in ["HS","KP"]:
             #A plug"
-            if TPLINK_PLUGS[info["model"][:5].upper()]["led"]:
-                return TPSmartDevice(info["name"],addr,hb,on_change)
+            if "outlets" in TPLINK_PLUGS[info["model"][:5].upper()]:
+                dev = TPStrip(info["name"],addr,hb,on_change)
+                dev.caps["outlet_emeter"] = TPLINK_PLUGS[info["model"][:5].upper()]["emeter"]
+            elif TPLINK_PLUGS[info["model"][:5].upper()]["led"]:
+                dev = TPSmartDevice(info["name"],addr,hb,on_change)
             else:
-                return TPDevice(info["name"],addr,hb,on_change)
-        elif info["model"][:2].lower() in ["LB","KL","KB"]:
+                dev = TPDevice(info["name"],addr,hb,on_change)
+        elif info["model"][:2].upper() in ["LB","KL","KB"]:
             #A Light
-            print("Light {}".format(info["model"]))
+            logging.debug("Light {}".format(info["model"]))
             if TPLINK_BULBS[info["model"][:5].upper()]["colour"]:
-                return TPColourLight(info["name"],addr,hb,on_change)
+                dev = TPColourLight(info["name"],addr,hb,on_change)
             elif TPLINK_BULBS[info["model"][:5].upper()]["temperature"]:
-                return TPWhiteLight(info["name"],addr,hb,on_change)
+                dev = TPWhiteLight(info["name"],addr,hb,on_change)
             else:
-                return TPLight(info["name"],addr,hb,on_change)
+                dev = TPLight(info["name"],addr,hb,on_change)
+    if dev:
+        dev.model = info["model"]
+        if "mac" in info:
+            dev.mac = info["mac"]
 
-    return None
+    return dev
@@ -23,14 +23,30 @@
 # IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 
 import asyncio as aio
+import heapq, logging, random
 import socket
+from collections import namedtuple, OrderedDict
+from . import commands
 from .commands import InfoCmd, GetPowerCmd
+from .shaper import TRAFFIC_SHAPER, BROADCAST
+from .capture import CAPTURE, IN, OUT
+from .polling import PollBudget
 
 DFLTPORT = 9999
 DFLTIP = '0.0.0.0'
+DFLTCOALESCE = 1.0 #Secs to wait for more replies before delivering a batch
+DFLTPROBE = 15 #Secs between unicast probes of a known device
+DFLTPROBERATE = 50 #Max unicast probes per sec
+DFLTMISSES = 3 #Unanswered probes before a device is considered gone
 
 DISCOVERY_CMD = InfoCmd() + GetPowerCmd()
 
+REGISTER = "register"
+UPDATE = "update"
+UNREGISTER = "unregister"
+
+RegistrarEvent = namedtuple("RegistrarEvent", ["kind", "mac", "info", "addr"])
+
 class DFLTRegistrar(object):
 
     def register(self, info, addr):
@@ -39,16 +55,115 @@ class DFLTRegistrar(object):
     def unregister(self, mac_addr):
         print("Unregistering %s"%mac_addr)
 
+class AsyncRegistrar(object):
+    """Registrars that want discovery events in batches.
+
+    process is called with a list of RegistrarEvent, in order, with at most one
+    event per MAC address. A new batch is not delivered before the previous one
+    has been processed. By default, the events are only logged.
+    """
+
+    async def process(self, events):
+        for event in events:
+            logging.debug("Discovery {} {} from {}".format(event.kind, event.mac, event.addr))
+
+class SyncRegistrarAdapter(AsyncRegistrar):
+    """Deliver batches to an old style registrar with register/unregister methods.
+
+    Update events are passed to the registrar "update" method, if it has one.
+    """
+
+    def __init__(self, registrar):
+        self.registrar = registrar
+
+    async def process(self, events):
+        for event in events:
+            try:
+                if event.kind == REGISTER:
+                    self.registrar.register(event.info, event.addr)
+                elif event.kind == UPDATE:
+                    if hasattr(self.registrar, "update"):
+                        self.registrar.update(event.info, event.addr)
+                else:
+                    self.registrar.unregister(event.mac)
+            except Exception as e:
+                logging.debug("Registrar failed on {} for {}: {}".format(event.kind, event.mac, e))
+
 class TPLinkDiscovery:
+    """Discover TP-Link devices with broadcasts.
 
-    def __init__(self, loop,registrar=DFLTRegistrar(), repeat=0):
+    Register, update (the device address changed) and unregister events are
+    coalesced and delivered in batches to the registrar. A batch is sent
+    coalesce seconds after its first event, or at the latest at the start of the
+    next sweep. With coalesce set to None, batches are only sent once per sweep.
+    """
+
+    def __init__(self, loop,registrar=DFLTRegistrar(), repeat=0, coalesce=DFLTCOALESCE):
         self.loop = loop
         self.registrar = registrar
+        if isinstance(registrar, AsyncRegistrar) or hasattr(registrar, "process"):
+            self._sink = registrar
+        else:
+            self._sink = SyncRegistrarAdapter(registrar)
         self.repeat = repeat
+        self.coalesce = coalesce
         self.known_devices=[]
         self.last_seen = []
+        self.addresses = {}
         self.done= aio.Future()
         self.discovery = None
+        self.transport = None
+        self._pending = OrderedDict()
+        self._flush_handle = None
+        self._delivery = None
+        self.monitored = {}
+        self.shaper = TRAFFIC_SHAPER #Paces broadcasts and probes
+
+    def monitor(self, device):
+        """Passive monitoring: every discovery reply from this device updates it
+        as a heartbeat would. The device only polls when it missed recent sweeps,
+        so "repeat" should be shorter than the device heartbeat."""
+        if device.mac:
+            self.monitored[device.mac.lower()] = device
+            device.passive = True
+
+    def unmonitor(self, mac):
+        device = self.monitored.pop(mac.lower(), None)
+        if device:
+            device.passive = False
+
+    def _add_event(self, kind, mac, info=None, addr=None):
+        """Queue an event, merging it with a queued one for the same device"""
+        prev = self._pending.pop(mac, None)
+        if prev:
+            if prev.kind == REGISTER and kind == UNREGISTER:
+                return
+            if prev.kind == REGISTER and kind == UPDATE:
+                kind = REGISTER
+            elif prev.kind == UNREGISTER and kind == REGISTER:
+                kind = UPDATE
+        self._pending[mac] = RegistrarEvent(kind, mac, info, addr)
+        if self.coalesce is not None and self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.coalesce, self.flush)
+
+    def flush(self):
+        """Deliver the queued events now"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        events = list(self._pending.values())
+        self._pending = OrderedDict()
+        self._delivery = aio.ensure_future(self._deliver(self._delivery, events))
+
+    async def _deliver(self, previous, events):
+        if previous:
+            await aio.wait([previous])
+        try:
+            await self._sink.process(events)
+        except Exception as e:
+            logging.debug("Registrar failed to process events: {}".format(e))
 
     def connection_made(self, transport):
         self.transport = transport
@@ -57,24 +172,55 @@ class TPLinkDiscovery:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.loop.call_soon(self.broadcast)
 
+    def _sendto(self, data, addr):
+        CAPTURE.udp(OUT, addr, data)
+        self.transport.sendto(data, addr)
+
     def datagram_received(self, data, addr):
-        response = DISCOVERY_CMD.response(data, noskip = True,ignore=True) #Ignore errors
+        CAPTURE.udp(IN, addr, data)
+        #Replies carry no length header. Large ones are decoded off the loop.
+        commands.DECODE_POLICY.decode(data,
+            lambda resp: self.handle_reply(DISCOVERY_CMD.process(resp, ignore=True), addr), #Ignore errors
+            lambda exc: logging.debug("Bad discovery reply from {}: {}".format(addr, exc)))
+
+    def handle_reply(self, response, addr):
         if "mac" in response:
-            if response["mac"].lower() not in self.known_devices:
-                self.known_devices.append(response["mac"].lower())
-                self.registrar.register(response,addr)
-            self.last_seen.append(response["mac"].lower())
+            mac = response["mac"].lower()
+            if mac not in self.known_devices:
+                self.known_devices.append(mac)
+                self._add_event(REGISTER, mac, response, addr)
+            elif self.addresses.get(mac, addr) != addr:
+                self._add_event(UPDATE, mac, response, addr)
+            self.addresses[mac] = addr
+            if mac not in self.last_seen:
+                self.last_seen.append(mac)
+            if mac in self.monitored:
+                try:
+                    self.monitored[mac].passive_update(response)
+                except Exception as e:
+                    logging.debug("Passive update failed for {}: {}".format(mac, e))
+
 
+    def _shaped(self):
+        """May we broadcast now? If not, try again in a sec"""
+        if self.shaper.try_send(BROADCAST):
+            return True
+        self.loop.call_later(1, self.broadcast)
+        return False
 
     def broadcast(self):
 
         if not self.done.done():
+            if not self._shaped():
+                return
             unregister = [ x for x in self.known_devices if x not in self.last_seen]
             self.known_devices = self.last_seen
             self.last_seen = []
             for x in unregister:
-                self.registrar.unregister(x)
-            self.transport.sendto(DISCOVERY_CMD.command[4:], ('255.255.255.255', 9999))
+                self.addresses.pop(x, None)
+                self._add_event(UNREGISTER, x)
+            self.flush()
+            self._sendto(DISCOVERY_CMD.command[4:], ('255.255.255.255', 9999))
             if self.repeat:
                 self.loop.call_later(self.repeat, self.broadcast)
             else:
@@ -82,6 +228,7 @@ class TPLinkDiscovery:
                 self.loop.call_later(5, self.close)
 
     def close(self):
+        self.flush()
         if not self.done.done():
             self.done.set_result(True)
         self.cleanup()
@@ -108,6 +255,165 @@ class TPLinkDiscovery:
             self.discovery.cancel()
             self.discovery = None
 
+class _StreamProtocol(aio.DatagramProtocol):
+    """Queue discovery replies for discover()"""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def datagram_received(self, data, addr):
+        CAPTURE.udp(IN, addr, data)
+        commands.DECODE_POLICY.decode(data,
+            lambda resp: self.queue.put_nowait((DISCOVERY_CMD.process(resp, ignore=True), addr)),
+            lambda exc: logging.debug("Bad discovery reply from {}: {}".format(addr, exc)))
+
+async def discover(macs=None, count=None, timeout=5, interval=1, target='255.255.255.255',
+                   listen_ip=DFLTIP, listen_port=0):
+    """Yield (info, addr) for each device, as soon as it replies.
+
+    The discovery request is sent every interval secs, to target, the broadcast
+    address by default, until timeout secs have passed. It ends early once all
+    the MAC addresses in macs, or count devices, have been seen. Each device is
+    yielded once.
+
+        async for info, addr in discover(count=1, timeout=0.5, target="192.168.1.20"):
+            print("{} is there".format(info["name"]))
+    """
+    loop = aio.get_event_loop()
+    queue = aio.Queue()
+    transport, proto = await loop.create_datagram_endpoint(
+        lambda: _StreamProtocol(queue), local_addr=(listen_ip, listen_port))
+    wanted = macs and set(x.lower() for x in macs)
+    seen = set()
+    deadline = loop.time() + timeout
+    nextsend = loop.time()
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                break
+            if now >= nextsend:
+                await TRAFFIC_SHAPER.token(target)
+                CAPTURE.udp(OUT, (target, DFLTPORT), DISCOVERY_CMD.command[4:])
+                transport.sendto(DISCOVERY_CMD.command[4:], (target, DFLTPORT))
+                nextsend = now + interval
+            try:
+                info, addr = await aio.wait_for(queue.get(), min(deadline, nextsend) - now)
+            except aio.TimeoutError:
+                continue
+            mac = info.get("mac", "").lower()
+            if not mac or mac in seen:
+                continue
+            seen.add(mac)
+            yield info, addr
+            if count and len(seen) >= count:
+                break
+            if wanted and wanted <= seen:
+                break
+    finally:
+        transport.close()
+
+class TPLinkHybridDiscovery(TPLinkDiscovery):
+    """Discovery that checks known devices with unicast probes.
+
+    Broadcasts, every "repeat" secs, are only needed to find new devices. Each
+    known device is probed on its own schedule, every probe_interval secs, and
+    no more than probe_rate probes are sent per sec. Replies are matched to
+    probes by address. A device that misses max_misses probes in a row is
+    unregistered.
+    """
+
+    TICK = 0.1
+
+    def __init__(self, loop,registrar=DFLTRegistrar(), repeat=300, coalesce=DFLTCOALESCE,
+                 probe_interval=DFLTPROBE, probe_rate=DFLTPROBERATE, max_misses=DFLTMISSES):
+        super().__init__(loop, registrar, repeat, coalesce)
+        self.probe_interval = probe_interval
+        self.probe_rate = probe_rate
+        #Fractional credit carries over from tick to tick, so low rates are kept too
+        self.probe_budget = PollBudget(probe_rate, max(1, probe_rate * self.TICK))
+        self.max_misses = max_misses
+        self.schedule = [] #heap of (when, mac)
+        self.outstanding = {} #ip -> mac for probes without a reply
+        self.misses = {}
+        self._tick_handle = None
+
+    def handle_reply(self, response, addr):
+        isnew = False
+        if "mac" in response:
+            mac = response["mac"].lower()
+            isnew = mac not in self.misses
+            self.misses[mac] = 0
+        self.outstanding.pop(addr[0], None)
+        super().handle_reply(response, addr)
+        if isnew:
+            #Spread the first probes so that devices found by the same
+            #broadcast are not all probed in the same tick.
+            when = self.loop.time() + random.uniform(0.5, 1) * self.probe_interval
+            heapq.heappush(self.schedule, (when, mac))
+
+    def broadcast(self):
+        if not self.done.done():
+            if not self._shaped():
+                return
+            self.flush()
+            self._sendto(DISCOVERY_CMD.command[4:], ('255.255.255.255', DFLTPORT))
+            if self._tick_handle is None:
+                self._tick_handle = self.loop.call_later(self.TICK, self.probe)
+            if self.repeat:
+                self.loop.call_later(self.repeat, self.broadcast)
+            else:
+                self.loop.call_later(5, self.close)
+
+    def probe(self):
+        """Send the probes that are due, within the rate limit"""
+        self._tick_handle = None
+        if self.done.done() or not self.transport:
+            return
+        now = self.loop.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            when, mac = heapq.heappop(self.schedule)
+            if mac not in self.misses:
+                continue #Already gone
+            ip = self.addresses.get(mac, (None,))[0]
+            if ip is None:
+                continue
+            if not self.probe_budget.try_acquire():
+                heapq.heappush(self.schedule, (when, mac))
+                break
+            if not self.shaper.try_send(ip):
+                heapq.heappush(self.schedule, (now + self.TICK, mac))
+                continue
+            if self.outstanding.get(ip) == mac:
+                self.misses[mac] += 1
+                if self.misses[mac] >= self.max_misses:
+                    self._gone(mac, ip)
+                    continue
+            self.outstanding[ip] = mac
+            self._sendto(DISCOVERY_CMD.command[4:], (ip, DFLTPORT))
+            heapq.heappush(self.schedule, (now + self.probe_interval, mac))
+        self._tick_handle = self.loop.call_later(self.TICK, self.probe)
+
+    def _gone(self, mac, ip):
+        del(self.misses[mac])
+        self.outstanding.pop(ip, None)
+        self.addresses.pop(mac, None)
+        if mac in self.known_devices:
+            self.known_devices.remove(mac)
+        if mac in self.last_seen:
+            self.last_seen.remove(mac)
+        self._add_event(UNREGISTER, mac)
+
+    def cleanup(self):
+        if self._tick_handle:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+        super().cleanup()
+
 if __name__ == "__main__":
     TIMEOUT = 10
     async def waitforme(future):
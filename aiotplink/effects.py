@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we play light effects, fades, colour loops, breathing, candles.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import copy, logging, math, random
+from abc import ABCMeta, abstractmethod
+from . import commands
+from .devices import TPLINK_BULBS
+
+MAXRATE = 10 # frames per sec, at most
+MINRATE = 1 # frames per sec, at least, however slow the bulb
+HEADROOM = 1.5 # a frame lasts at least that many response times
+RTTWEIGHT = 0.25 # weight of a new response time in the average
+FRAMETIMEOUT = 2
+
+
+class Effect(object, metaclass=ABCMeta):
+    """A timeline of light states.
+
+    frame(t) returns the state of the light t secs after the start, a
+    dictionary with some of "hue", "saturation", "brightness" and
+    "temperature". duration is in secs, None for an endless effect.
+
+    An effect may keep a state between frames, one light plays one effect.
+    copy() returns another one for another light.
+    """
+
+    duration = None
+
+    @abstractmethod
+    def frame(self, t):
+        pass
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def _cycles_duration(self, period, cycles):
+        if cycles is None:
+            return None
+        return period * cycles
+
+
+def _hue_between(start, end, ratio):
+    """Go round the colour wheel the short way"""
+    delta = ((end - start + 180) % 360) - 180
+    return (start + delta * ratio) % 360
+
+
+class Fade(Effect):
+    """Go from the start state to the end state in duration secs"""
+
+    def __init__(self, start, end, duration):
+        if set(start.keys()) != set(end.keys()):
+            raise ValueError("Fade start and end must have the same keys")
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    def frame(self, t):
+        ratio = min(1, max(0, t / self.duration)) if self.duration else 1
+        resu = {}
+        for key, val in self.start.items():
+            if key == "hue":
+                resu[key] = _hue_between(val, self.end[key], ratio)
+            else:
+                resu[key] = val + (self.end[key] - val) * ratio
+        return resu
+
+
+class ColourLoop(Effect):
+    """Go round the colour wheel once every period secs"""
+
+    def __init__(self, period=10, saturation=100, brightness=100, hue=0, cycles=None):
+        self.period = period
+        self.saturation = saturation
+        self.brightness = brightness
+        self.hue = hue
+        self.duration = self._cycles_duration(period, cycles)
+
+    def frame(self, t):
+        return {"hue": (self.hue + 360 * t / self.period) % 360,
+                "saturation": self.saturation,
+                "brightness": self.brightness}
+
+
+class Breathe(Effect):
+    """Brightness going smoothly between low and high, once every period secs.
+    colour, if given, is kept, e.g. {"hue": 240, "saturation": 100} or
+    {"temperature": 2700}."""
+
+    def __init__(self, low=10, high=100, period=4, colour=None, cycles=None):
+        self.low = low
+        self.high = high
+        self.period = period
+        self.colour = colour or {}
+        self.duration = self._cycles_duration(period, cycles)
+
+    def frame(self, t):
+        resu = dict(self.colour)
+        resu["brightness"] = self.low + (self.high - self.low) * (1 - math.cos(2 * math.pi * t / self.period)) / 2
+        return resu
+
+
+class Candle(Effect):
+    """A flickering warm light. The brightness wanders around brightness, by up
+    to flicker, with an occasional deeper dip."""
+
+    def __init__(self, brightness=60, flicker=25, temperature=2500, duration=None, seed=None):
+        self.brightness = brightness
+        self.flicker = flicker
+        self.temperature = temperature
+        self.duration = duration
+        self.random = random.Random(seed)
+        self.level = 0
+
+    def frame(self, t):
+        #A random walk pulled back to the middle looks more like a flame than noise
+        self.level = self.level * 0.6 + (self.random.random() - 0.5) * 0.8
+        if self.random.random() < 0.05:
+            self.level = -1
+        level = max(-1, min(1, self.level))
+        return {"brightness": self.brightness + self.flicker * level,
+                "hue": 30, "saturation": 80,
+                "temperature": self.temperature}
+
+    def copy(self):
+        #Each flame flickers on its own, still reproducibly with a seed
+        resu = super().copy()
+        resu.random = random.Random(self.random.random())
+        return resu
+
+
+class EffectRunner(object):
+    """Play an effect on a light.
+
+    A frame is computed from the timeline when it is sent, and sent only when
+    the previous one was acknowledged. The frame interval follows the measured
+    response time of the bulb, between 1/max_rate and 1/min_rate secs, and the
+    bulb is asked to transition over that interval, so it moves smoothly from
+    frame to frame. Frames whose time went by while waiting for the bulb are
+    dropped, never queued; "dropped" counts them.
+    """
+
+    def __init__(self, light, effect, max_rate=MAXRATE, min_rate=MINRATE):
+        self.light = light
+        self.effect = effect
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rtt = None
+        self.sent = 0
+        self.dropped = 0
+        self.last = None # The last frame acknowledged
+        self.task = None
+
+    def start(self, start_time=None):
+        """Start playing. Lights given the same start_time play in phase."""
+        self.task = aio.ensure_future(self.run(start_time))
+        return self.task
+
+    def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def interval(self):
+        if self.rtt is None:
+            return 1 / self.max_rate
+        return min(1 / self.min_rate, max(1 / self.max_rate, self.rtt * HEADROOM))
+
+    def _measure(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) * RTTWEIGHT
+
+    def _adapt(self, frame):
+        """Keep what the light can do, as integers in range"""
+        resu = {}
+        if self.light.caps.get("colour") and "hue" in frame:
+            resu["hue"] = int(round(frame["hue"])) % 360
+            saturation = frame.get("saturation", self.light.colour["saturation"])
+            resu["saturation"] = max(0, min(100, int(round(saturation))))
+        elif "temperature" in frame and hasattr(self.light, "set_temperature"):
+            trange = TPLINK_BULBS.get((self.light.model or "")[:5].upper(), {}).get("temperature")
+            if not isinstance(trange, tuple):
+                trange = (2500, 9000)
+            resu["temperature"] = max(trange[0], min(trange[1], int(round(frame["temperature"]))))
+        if "brightness" in frame:
+            resu["brightness"] = max(0, min(100, int(round(frame["brightness"]))))
+        return resu
+
+    async def run(self, start_time=None):
+        loop = aio.get_event_loop()
+        start = loop.time() if start_time is None else start_time
+        first = True
+        try:
+            while True:
+                t = loop.time() - start
+                final = self.effect.duration is not None and t >= self.effect.duration
+                if final:
+                    t = self.effect.duration
+                interval = self.interval()
+                frame = self._adapt(self.effect.frame(t))
+                val = dict(frame, transition_period=int(interval * 1000))
+                if first:
+                    val["state"] = "on"
+                sent_at = loop.time()
+                try:
+                    await aio.wait_for(self.light._send_cmd(commands.SetLightStateCmd(val)), FRAMETIMEOUT)
+                    self._measure(loop.time() - sent_at)
+                    self.sent += 1
+                    self.last = frame
+                    first = False
+                except aio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.debug("Effect frame for {} failed: {}".format(self.light.name, e))
+                    self._measure(FRAMETIMEOUT)
+                    self.dropped += 1
+                if final:
+                    break
+                elapsed = loop.time() - sent_at
+                if elapsed > interval:
+                    self.dropped += int(elapsed / interval) - 1
+                else:
+                    await aio.sleep(interval - elapsed)
+        finally:
+            self._record()
+        return self
+
+    def _record(self):
+        """The light keeps the state of the last frame, report it once"""
+        if self.last is None:
+            return
+        changes = {}
+        if self.light.state != "on":
+            self.light.state = "on"
+            changes["state"] = "on"
+        for key, val in self.last.items():
+            if self.light.colour.get(key) != val:
+                self.light.colour[key] = val
+                changes[key] = val
+        if changes:
+            self.light._write_through(changes)
+
+
+def play(effect, lights, max_rate=MAXRATE, min_rate=MINRATE):
+    """Play an effect on several lights, in phase. Each light plays its own copy
+    of the effect and adapts its own frame rate. Return the list of EffectRunner."""
+    start = aio.get_event_loop().time()
+    runners = []
+    for light in lights:
+        light.stop_effect()
+        light.effect = EffectRunner(light, effect.copy(), max_rate, min_rate)
+        light.effect.start(start)
+        runners.append(light.effect)
+    return runners
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we keep running power and energy totals for groups of devices.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import datetime as dt
+import logging, math, time
+from .events import FLEET_BUS
+from .responses import RealtimeEmeter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DFLTQUEUE = 65536
+
+
+def meter_key(mac, outlet=None):
+    """Devices are known by MAC address, the outlets of a strip by (MAC address, index)"""
+    mac = mac.lower()
+    return mac if outlet is None else (mac, outlet)
+
+
+class _Meter(object):
+
+    __slots__ = ("groups", "power", "total", "online")
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.power = 0.0
+        self.total = None
+        self.online = False
+
+
+class EnergyAggregator(object):
+    """Running power and energy sums for groups of devices.
+
+    A device, or a strip outlet, may belong to any number of groups, e.g. a
+    building and a tenant. Each reading only updates the sums of the groups of
+    its device, so power(group) and energy(group) cost the same whatever the
+    size of the group.
+
+    power is the current draw, in W, of the online devices of the group.
+    energy is the kWh used since the start of the day (local time), computed
+    from the increase of each device "total" counter. A device going offline
+    stops counting towards power, and whatever it used while offline is
+    counted when it comes back. A counter going down (reset or reboot) counts
+    as having started again from 0. At midnight, the day totals move to
+    "history", a list of (date, {group: kWh}).
+
+    Feed it with update()/offline(), or attach() it to an events.EventBus.
+    """
+
+    def __init__(self, daily=True):
+        self.daily = daily
+        self.meters = {}
+        self.by_mac = {} # MAC address -> meter keys, a strip going offline takes its outlets along
+        self.group_power = {}
+        self.group_energy = {}
+        self.group_size = {}
+        self.day = None
+        self.history = []
+        self.subscription = None
+        self.task = None
+
+    def assign(self, key, *groups):
+        """Put the meter key, see meter_key, in groups"""
+        self.unassign(key)
+        meter = self.meters[key] = _Meter(groups)
+        self.by_mac.setdefault(self._mac(key), set()).add(key)
+        for group in groups:
+            self.group_power.setdefault(group, 0.0)
+            self.group_energy.setdefault(group, 0.0)
+            self.group_size[group] = self.group_size.get(group, 0) + 1
+        return meter
+
+    def unassign(self, key):
+        meter = self.meters.pop(key, None)
+        if meter is None:
+            return
+        keys = self.by_mac.get(self._mac(key), set())
+        keys.discard(key)
+        if not keys:
+            self.by_mac.pop(self._mac(key), None)
+        for group in meter.groups:
+            if meter.online:
+                self.group_power[group] -= meter.power
+            self.group_size[group] -= 1
+
+    def _mac(self, key):
+        return key[0] if isinstance(key, tuple) else key
+
+    def _rollover(self, timestamp):
+        day = dt.date.fromtimestamp(timestamp)
+        if self.day is None:
+            self.day = day
+        elif day != self.day:
+            self.history.append((self.day, dict(self.group_energy)))
+            self.group_energy = {k: 0.0 for k in self.group_energy}
+            self.day = day
+
+    def update(self, key, power=None, total=None, timestamp=None):
+        """A reading, power in W, total in kWh"""
+        meter = self.meters.get(key)
+        if meter is None:
+            return
+        if self.daily:
+            self._rollover(timestamp or time.time())
+        if power is None:
+            #Without a new power, the last one counts again once back online
+            power = meter.power
+        delta = power - (meter.power if meter.online else 0.0)
+        meter.power = power
+        meter.online = True
+        if delta:
+            for group in meter.groups:
+                self.group_power[group] += delta
+        if total is not None:
+            if meter.total is None:
+                used = 0.0 # Nothing to compare with yet
+            elif total < meter.total:
+                used = total # The counter started again from 0
+            else:
+                used = total - meter.total
+            meter.total = total
+            if used:
+                for group in meter.groups:
+                    self.group_energy[group] += used
+
+    def offline(self, key):
+        meter = self.meters.get(key)
+        if meter is None or not meter.online:
+            return
+        for group in meter.groups:
+            self.group_power[group] -= meter.power
+        meter.online = False
+
+    def power(self, group):
+        return self.group_power.get(group, 0.0)
+
+    def energy(self, group):
+        return self.group_energy.get(group, 0.0)
+
+    def online(self, group):
+        """Number of devices of the group counted in power. Not O(1), for information."""
+        return sum(1 for x in self.meters.values() if x.online and group in x.groups)
+
+    def recompute(self):
+        """Recompute the power sums from scratch, to shed floating point drift"""
+        self.group_power = {k: 0.0 for k in self.group_power}
+        for meter in self.meters.values():
+            if meter.online:
+                for group in meter.groups:
+                    self.group_power[group] += meter.power
+
+    def feed(self, event):
+        """Apply an events.ChangeEvent"""
+        changes = event.changes
+        if changes.get("online") is False:
+            if "outlet" in changes:
+                self.offline(meter_key(event.mac, changes["outlet"]))
+            else:
+                for key in list(self.by_mac.get(event.mac, ())):
+                    self.offline(key)
+            return
+        reading = RealtimeEmeter(changes)
+        power, total = reading.power, reading.total
+        if power is not None or total is not None:
+            self.update(meter_key(event.mac, changes.get("outlet")), power, total, event.timestamp)
+
+    def attach(self, bus=FLEET_BUS, maxsize=DFLTQUEUE):
+        """Follow the readings published on bus"""
+        self.subscription = bus.subscribe(maxsize=maxsize)
+        self.task = aio.ensure_future(self._consume())
+        return self.task
+
+    async def _consume(self):
+        async for event in self.subscription:
+            try:
+                self.feed(event)
+            except Exception as e:
+                logging.debug("Could not aggregate {}: {}".format(event, e))
+
+    def detach(self):
+        if self.subscription:
+            self.subscription.close()
+            self.subscription = None
+
+
+def _rollup_python(times, keys, totals, interval, membership):
+    last = {}
+    resu = {}
+    for idx in sorted(range(len(times)), key=times.__getitem__):
+        key, total = keys[idx], totals[idx]
+        if key in last:
+            used = total if total < last[key] else total - last[key]
+            if used:
+                bucket = math.floor(times[idx] / interval) * interval
+                for group in membership.get(key, ()):
+                    buckets = resu.setdefault(group, {})
+                    buckets[bucket] = buckets.get(bucket, 0.0) + used
+        last[key] = total
+    return resu
+
+def _rollup_numpy(times, keys, totals, interval, membership):
+    names = sorted(set(keys), key=str)
+    index = {k: i for i, k in enumerate(names)}
+    times = np.asarray(times, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    kidx = np.fromiter((index[k] for k in keys), dtype=np.int64, count=len(keys))
+    order = np.lexsort((times, kidx))
+    times, totals, kidx = times[order], totals[order], kidx[order]
+    same = kidx[1:] == kidx[:-1]
+    delta = np.diff(totals)
+    used = np.where(delta < 0, totals[1:], delta)[same]
+    buckets = (np.floor(times[1:] / interval) * interval)[same]
+    owners = kidx[1:][same]
+    groups = sorted({g for k in names for g in membership.get(k, ())}, key=str)
+    gindex = {g: i for i, g in enumerate(groups)}
+    #One row per (meter, group) membership
+    pairs = np.array([(index[k], gindex[g]) for k in names for g in membership.get(k, ())],
+                     dtype=np.int64).reshape(-1, 2)
+    resu = {}
+    if not len(pairs) or not len(used):
+        return resu
+    ubuckets, binv = np.unique(buckets, return_inverse=True)
+    sums = np.zeros((len(groups), len(ubuckets)))
+    #Expand each reading to the groups of its meter
+    counts = np.bincount(pairs[:, 0], minlength=len(names))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+    reps = counts[owners]
+    rows = np.repeat(np.arange(len(owners)), reps)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(reps) - reps, reps)
+    gcol = pairs[starts[owners[rows]] + offsets, 1]
+    np.add.at(sums, (gcol, binv[rows]), used[rows])
+    for gi, group in enumerate(groups):
+        nz = np.nonzero(sums[gi])[0]
+        if len(nz):
+            resu[group] = {float(ubuckets[b]): float(sums[gi, b]) for b in nz}
+    return resu
+
+def rollup_columns(times, keys, totals, membership, interval=3600):
+    """rollup, for readings already split in three sequences of the same length"""
+    if not len(times):
+        return {}
+    if np is not None:
+        return _rollup_numpy(times, keys, totals, interval, membership)
+    return _rollup_python(times, keys, totals, interval, membership)
+
+def rollup(readings, membership, interval=3600):
+    """Energy used per group and per time bucket, from historical readings.
+
+    readings is a list of (timestamp, meter key, total kWh), in any order,
+    membership maps meter keys to their groups. Return
+    {group: {bucket start timestamp: kWh}}, buckets being interval secs long.
+    Energy between two readings of a meter goes to the bucket of the later one,
+    a counter going down counts as a reset. Uses numpy when it is installed.
+    """
+    if not readings:
+        return {}
+    return rollup_columns(*zip(*readings), membership, interval)
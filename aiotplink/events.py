@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we stream device state changes to any number of consumers.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import time
+from collections import namedtuple, deque, OrderedDict
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DFLTQUEUE = 256
+
+ChangeEvent = namedtuple("ChangeEvent", ["mac", "name", "device_type", "changes", "timestamp"])
+
+
+def _type_names(types):
+    """Class names to match, a class also matches its subclasses"""
+    for x in types:
+        if isinstance(x, str):
+            yield x
+        else:
+            yield x.__name__
+            for y in _type_names(x.__subclasses__()):
+                yield y
+
+
+class Subscription(object):
+    """A bounded queue of change events for one consumer. Use it with "async for".
+
+    When the queue is full, the overflow policy decides what happens:
+        DROP_OLDEST: the oldest queued event is lost.
+        COALESCE: a new event for a device that already has one queued is merged
+                  into it, otherwise the oldest queued event is lost.
+    With the COALESCE policy, at most one event per device is ever queued.
+    The number of lost or merged events is kept in "dropped".
+    """
+
+    def __init__(self, bus, macs=None, fields=None, types=None, maxsize=DFLTQUEUE, overflow=DROP_OLDEST):
+        if overflow not in [DROP_OLDEST, COALESCE]:
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        self.bus = bus
+        self.macs = macs and set(x.lower() for x in macs)
+        self.fields = fields and set(fields)
+        self.types = types and set(_type_names(types))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        if overflow == COALESCE:
+            self.queue = OrderedDict()
+        else:
+            self.queue = deque()
+        self._waiter = None
+
+    def _filter(self, event):
+        if self.macs and event.mac not in self.macs:
+            return None
+        if self.types and event.device_type not in self.types:
+            return None
+        if self.fields:
+            changes = {k: v for k, v in event.changes.items() if k in self.fields}
+            if not changes:
+                return None
+            event = event._replace(changes=changes)
+        return event
+
+    def put(self, event):
+        """Queue an event, never blocks"""
+        event = self._filter(event)
+        if event is None or self.closed:
+            return
+        if self.overflow == COALESCE:
+            if event.mac in self.queue:
+                old = self.queue[event.mac]
+                changes = dict(old.changes)
+                changes.update(event.changes)
+                self.queue[event.mac] = event._replace(changes=changes)
+                self.dropped += 1
+            else:
+                if len(self.queue) >= self.maxsize:
+                    self.queue.popitem(last=False)
+                    self.dropped += 1
+                self.queue[event.mac] = event
+        else:
+            if len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(event)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(True)
+
+    def _pop(self):
+        if self.overflow == COALESCE:
+            return self.queue.popitem(last=False)[1]
+        return self.queue.popleft()
+
+    async def get(self):
+        while not self.queue:
+            if self.closed:
+                raise StopAsyncIteration
+            self._waiter = aio.get_event_loop().create_future()
+            await self._waiter
+            self._waiter = None
+        return self._pop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        """Stop the subscription, a pending "async for" will end"""
+        self.closed = True
+        self.bus.unsubscribe(self)
+        self._wakeup()
+
+
+class EventBus(object):
+    """Fan out device state changes to subscriptions.
+
+    Publishing never blocks, each subscriber has its own bounded queue, so a
+    slow consumer cannot slow down device polling.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, macs=None, fields=None, types=None, maxsize=DFLTQUEUE, overflow=DROP_OLDEST):
+        """Subscribe to change events, optionally only for some MAC addresses,
+        some changed fields or some device types (class or class name)."""
+        sub = Subscription(self, macs, fields, types, maxsize, overflow)
+        self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub in self.subscriptions:
+            self.subscriptions.remove(sub)
+
+    def publish(self, device, changes):
+        if not self.subscriptions:
+            return
+        event = ChangeEvent((device.mac or "").lower(), device.name,
+                            device.__class__.__name__, changes, time.time())
+        for sub in self.subscriptions:
+            sub.put(event)
+
+# The bus devices publish to, unless told otherwise.
+FLEET_BUS = EventBus()
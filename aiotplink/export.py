@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we export device readings, in batches, to files and time series databases.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import csv, io, json, logging, os
+from abc import ABCMeta, abstractmethod
+from collections import namedtuple, deque
+from urllib.parse import urlsplit
+from .events import FLEET_BUS
+
+DFLTMEASUREMENT = "tplink"
+DFLTBATCH = 5000 # Points per write
+DFLTFLUSH = 5 # secs, the most a point waits in the buffer
+DFLTBUFFER = 100000 # Points held in memory before put() waits
+DFLTPENDING = 4 # Batches a sink may have waiting in memory, the next ones spill to disk
+DFLTSPILL = 64 * 1024 * 1024 # bytes of spilled batches per sink, the oldest go first
+DFLTQUEUE = 65536
+SPILLBASE = 10 ** 9 # First spill file number, the ones below are for batches put back in front
+HTTPTIMEOUT = 10
+RETRYMIN = 0.5 # secs, doubled after each failed write
+RETRYMAX = 30
+CSVFIELDS = ["state", "power", "current", "voltage", "total"]
+
+Point = namedtuple("Point", ["measurement", "tags", "fields", "timestamp"])
+
+
+def point_from_event(event, measurement=DFLTMEASUREMENT):
+    """A Point from an events.ChangeEvent, or None if it has nothing to export.
+    Only scalar values are kept, the outlet of a strip becomes a tag."""
+    tags = {"mac": event.mac, "name": event.name or "", "type": event.device_type}
+    fields = {}
+    for key, val in event.changes.items():
+        if key == "outlet":
+            tags["outlet"] = str(val)
+        elif isinstance(val, (bool, int, float, str)):
+            fields[key] = val
+    if not fields:
+        return None
+    return Point(measurement, tags, fields, int(event.timestamp * 1e9))
+
+
+def _escape(text, chars):
+    text = str(text).replace("\\", "\\\\")
+    for c in chars:
+        text = text.replace(c, "\\" + c)
+    return text
+
+def _field_value(val):
+    if isinstance(val, bool):
+        return (val and "true") or "false"
+    if isinstance(val, int):
+        return "{}i".format(val)
+    if isinstance(val, float):
+        return repr(val)
+    return '"{}"'.format(str(val).replace("\\", "\\\\").replace('"', '\\"'))
+
+def line_protocol(point):
+    """The InfluxDB line protocol for a Point, with a ns timestamp"""
+    head = _escape(point.measurement, ", ")
+    for key in sorted(point.tags):
+        if point.tags[key] != "":
+            head += ",{}={}".format(_escape(key, ",= "), _escape(point.tags[key], ",= "))
+    fields = ",".join("{}={}".format(_escape(k, ",= "), _field_value(v)) for k, v in point.fields.items())
+    return "{} {} {}".format(head, fields, point.timestamp)
+
+
+def _append(path, text, header=None):
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        if header and not f.tell():
+            f.write(header)
+        f.write(text)
+
+# File work of the sink workers, run in an executor so a slow disk does not stall the loop
+
+def _scan_spills(spill_dir):
+    """The spill files in spill_dir, oldest first, as (path, size, points), and the next free number"""
+    os.makedirs(spill_dir, exist_ok=True)
+    found = []
+    seq = SPILLBASE
+    for name in sorted(os.listdir(spill_dir)):
+        if name.endswith(".spill"):
+            path = os.path.join(spill_dir, name)
+            with open(path, encoding="utf-8") as f:
+                count = sum(1 for _ in f)
+            found.append((path, os.path.getsize(path), count))
+            seq = max(seq, int(name.split(".")[0]) + 1)
+    return found, seq
+
+def _write_spill(path, batch):
+    text = "".join(json.dumps(list(x)) + "\n" for x in batch)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return os.path.getsize(path)
+
+def _read_spill(path):
+    with open(path, encoding="utf-8") as f:
+        return [Point(*json.loads(x)) for x in f if x.strip()]
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Sink(object, metaclass=ABCMeta):
+    """Where batches go. write() gets a list of Points and raises if they
+    could not be written, they will be retried."""
+
+    @abstractmethod
+    async def write(self, points):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LineProtocolFile(Sink):
+    """Append the batches, in InfluxDB line protocol, to a file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def write(self, points):
+        text = "".join(line_protocol(x) + "\n" for x in points)
+        await aio.get_event_loop().run_in_executor(None, _append, self.path, text)
+
+
+class CSVFile(Sink):
+    """Append the batches to a CSV file, one column per tag and per field in fields"""
+
+    def __init__(self, path, fields=CSVFIELDS):
+        self.path = path
+        self.fields = list(fields)
+        self.columns = ["timestamp", "measurement", "mac", "name", "type", "outlet"] + self.fields
+
+    async def write(self, points):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(self.columns)
+        header = out.getvalue() # Written only if the file is empty
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for point in points:
+            if not any(x in point.fields for x in self.fields):
+                continue
+            writer.writerow([point.timestamp / 1e9, point.measurement] +
+                            [point.tags.get(x, "") for x in ["mac", "name", "type", "outlet"]] +
+                            [point.fields.get(x, "") for x in self.fields])
+        await aio.get_event_loop().run_in_executor(None, _append, self.path, out.getvalue(), header)
+
+
+class HTTPLineProtocol(Sink):
+    """POST the batches, in line protocol, to an InfluxDB style /write endpoint,
+    e.g. "http://127.0.0.1:8086/write?db=tplink&precision=ns". Any 2xx status
+    is a success."""
+
+    def __init__(self, url, timeout=HTTPTIMEOUT, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = headers or {}
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("Only http URLs are supported")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = (parts.path or "/") + (parts.query and "?" + parts.query or "")
+
+    async def _post(self, body):
+        reader, writer = await aio.open_connection(self.host, self.port)
+        try:
+            head = "POST {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: text/plain; charset=utf-8\r\n".format(
+                self.path, self.host, self.port)
+            for key, val in self.headers.items():
+                head += "{}: {}\r\n".format(key, val)
+            head += "Content-Length: {}\r\nConnection: close\r\n\r\n".format(len(body))
+            writer.write(head.encode("latin-1") + body)
+            await writer.drain()
+            status = await reader.readline()
+            parts = status.split()
+            if len(parts) < 2 or not parts[1].startswith(b"2"):
+                raise IOError("Write to {} failed: {}".format(self.url, status.decode("latin-1").strip()))
+        finally:
+            writer.close()
+
+    async def write(self, points):
+        body = "".join(line_protocol(x) + "\n" for x in points).encode("utf-8")
+        await aio.wait_for(self._post(body), self.timeout)
+
+
+class _SinkWorker(object):
+    """Feed one sink, in order. Batches wait in memory, up to max_pending if
+    there is a spill directory, then in spill files, up to spill_max bytes, the
+    oldest being dropped beyond that. Spill files are written and read in an
+    executor, the batches waiting for that are held in to_spill.
+    A failed write is retried, with an increasing delay, until it succeeds."""
+
+    def __init__(self, exporter, sink, index, max_pending, spill_dir, spill_max):
+        self.exporter = exporter
+        self.sink = sink
+        self.max_pending = max_pending
+        self.spill_max = spill_max
+        self.spill_dir = spill_dir and os.path.join(spill_dir, "sink{}".format(index))
+        self.queue = deque()
+        self.to_spill = deque()
+        self.spilled = deque() # (path, size, points), oldest first
+        self.spill_size = 0
+        self.spill_seq = SPILLBASE
+        self.sending = None # The spilled entry being written to the sink
+        self.written = 0
+        self.dropped = 0
+        self.task = None
+        self.stopping = False # No new write is started, see Exporter.stop
+        self._waiter = None
+        self._recovery = None
+        self._spiller = None
+
+    def _recovered(self):
+        """Spill files left by a previous run are sent first. Return the task looking for them."""
+        if self._recovery is None:
+            self._recovery = aio.ensure_future(self._recover())
+        return self._recovery
+
+    async def _recover(self):
+        found, seq = await aio.get_event_loop().run_in_executor(None, _scan_spills, self.spill_dir)
+        self.spilled.extendleft(reversed(found))
+        self.spill_size += sum(x[1] for x in found)
+        self.spill_seq = max(self.spill_seq, seq)
+
+    @property
+    def pending(self):
+        return sum(len(x) for x in self.queue) + sum(len(x) for x in self.to_spill)
+
+    def submit(self, batch):
+        if self.spill_dir and (len(self.queue) >= self.max_pending or self.spilled or self.to_spill or
+                               not (self._recovery and self._recovery.done())):
+            self.to_spill.append(batch)
+            if self._spiller is None or self._spiller.done():
+                self._spiller = aio.ensure_future(self._spill_all())
+        else:
+            #Without spill files, the exporter holds back new points instead
+            self.queue.append(batch)
+        self._wakeup()
+
+    async def _spill_all(self):
+        await self._recovered()
+        while self.to_spill:
+            try:
+                await self._spill(self.to_spill[0])
+            except Exception as e:
+                logging.debug("Could not spill for {}: {}".format(self.sink, e))
+                self.dropped += len(self.to_spill[0])
+            self.to_spill.popleft()
+            self.exporter._released()
+            self._wakeup()
+
+    async def _spill(self, batch, front=False):
+        """Write a batch to a spill file, after the others or, when front, before"""
+        if front and self.spilled:
+            seq = int(os.path.basename(self.spilled[0][0]).split(".")[0]) - 1
+        else:
+            seq = self.spill_seq
+            self.spill_seq += 1
+        path = os.path.join(self.spill_dir, "{:012d}.spill".format(seq))
+        loop = aio.get_event_loop()
+        size = await loop.run_in_executor(None, _write_spill, path, batch)
+        if front:
+            self.spilled.appendleft((path, size, len(batch)))
+        else:
+            self.spilled.append((path, size, len(batch)))
+        self.spill_size += size
+        old = []
+        while self.spill_size > self.spill_max and len(self.spilled) > 1:
+            #Not the one being sent, it is about to go anyway
+            idx = int(self.spilled[0] is self.sending)
+            if idx >= len(self.spilled) - 1:
+                break
+            entry = self.spilled[idx]
+            del(self.spilled[idx])
+            self.spill_size -= entry[1]
+            self.dropped += entry[2]
+            old.append(entry[0])
+        if old:
+            await loop.run_in_executor(None, _remove, old)
+        logging.debug("Export sink {} is slow, {} bytes spilled".format(self.sink, self.spill_size))
+
+    async def _done_spill(self, entry):
+        if entry in self.spilled:
+            self.spilled.remove(entry)
+            self.spill_size -= entry[1]
+        await aio.get_event_loop().run_in_executor(None, _remove, [entry[0]])
+
+    async def spilling_done(self):
+        """Wait for the batches in to_spill to be in spill files"""
+        await self._recovered()
+        if self._spiller and not self._spiller.done():
+            await self._spiller
+
+    def _wakeup(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(True)
+
+    def idle(self):
+        return not self.queue and not self.to_spill and not self.spilled
+
+    async def run(self):
+        retry = RETRYMIN
+        loop = aio.get_event_loop()
+        if self.spill_dir:
+            await self._recovered()
+        while not self.stopping:
+            self.sending = None
+            if self.queue:
+                batch = self.queue[0]
+            elif self.spilled:
+                self.sending = self.spilled[0]
+                try:
+                    batch = await loop.run_in_executor(None, _read_spill, self.sending[0])
+                except Exception as e:
+                    logging.debug("Could not read spill file {}: {}".format(self.sending[0], e))
+                    if self.sending in self.spilled:
+                        self.spilled.remove(self.sending)
+                        self.spill_size -= self.sending[1]
+                        self.dropped += self.sending[2]
+                    continue
+            else:
+                self._waiter = loop.create_future()
+                await self._waiter
+                self._waiter = None
+                continue
+            try:
+                await self.sink.write(batch)
+            except aio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug("Export to {} failed: {}".format(self.sink, e))
+                if self.stopping:
+                    break
+                await aio.sleep(retry)
+                retry = min(RETRYMAX, retry * 2)
+                continue
+            retry = RETRYMIN
+            self.written += len(batch)
+            if self.sending:
+                await self._done_spill(self.sending)
+            elif self.queue and self.queue[0] is batch:
+                self.queue.popleft()
+            self.exporter._released()
+
+
+class Exporter(object):
+    """Buffer points and write them, in batches, to sinks.
+
+    Points are written when batch_size of them are buffered or, at the latest,
+    flush_interval secs after they arrived, so a large fleet means few large
+    writes. Each sink is fed on its own, a slow sink does not hold the others
+    back. Its batches wait in memory, max_pending of them, then, if spill_dir
+    is given, in files there, up to spill_max bytes per sink. Beyond that, the
+    oldest batches are dropped. Spill files left over are sent on the next run.
+
+    add() never waits and drops the point when max_buffer points are held in
+    memory, buffered or waiting for a sink, put() waits for room instead. attach() exports the change events
+    published on an events.EventBus, e.g. every emeter reading of the heartbeat.
+    """
+
+    def __init__(self, sinks, batch_size=DFLTBATCH, flush_interval=DFLTFLUSH, max_buffer=DFLTBUFFER,
+                 max_pending=DFLTPENDING, spill_dir=None, spill_max=DFLTSPILL, measurement=DFLTMEASUREMENT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.measurement = measurement
+        self.buffer = []
+        self.dropped = 0
+        self.workers = [_SinkWorker(self, x, i, max_pending, spill_dir, spill_max) for i, x in enumerate(sinks)]
+        self.subscription = None
+        self.tasks = []
+        self._room = None
+
+    @property
+    def held(self):
+        """Points in memory, buffered or waiting for a sink"""
+        return len(self.buffer) + max([x.pending for x in self.workers] + [0])
+
+    def add(self, point):
+        if point is None:
+            return True
+        if self.held >= self.max_buffer:
+            self.dropped += 1
+            return False
+        self.buffer.append(point)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return True
+
+    async def put(self, point):
+        while self.held >= self.max_buffer:
+            self._room = self._room or aio.get_event_loop().create_future()
+            await aio.shield(self._room)
+        return self.add(point)
+
+    def add_event(self, event):
+        return self.add(point_from_event(event, self.measurement))
+
+    def _released(self):
+        if self._room and not self._room.done() and self.held < self.max_buffer:
+            self._room.set_result(True)
+            self._room = None
+
+    def flush(self):
+        """Hand the buffered points to the sinks now"""
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        for worker in self.workers:
+            worker.submit(batch)
+        self._released()
+
+    async def _ticker(self):
+        while True:
+            await aio.sleep(self.flush_interval)
+            self.flush()
+
+    async def _consume(self):
+        async for event in self.subscription:
+            self.add_event(event)
+
+    def start(self):
+        if not self.tasks:
+            for worker in self.workers:
+                worker.task = aio.ensure_future(worker.run())
+            self.tasks = [x.task for x in self.workers]
+            self.tasks.append(aio.ensure_future(self._ticker()))
+        return self
+
+    def attach(self, bus=FLEET_BUS, maxsize=DFLTQUEUE):
+        """Export the events published on bus"""
+        self.start()
+        self.subscription = bus.subscribe(maxsize=maxsize)
+        self.tasks.append(aio.ensure_future(self._consume()))
+        return self
+
+    async def stop(self, timeout=HTTPTIMEOUT):
+        """Flush and give the sinks up to timeout secs to catch up. What is
+        left stays in the spill files, if any, or is lost. A write still going
+        on then gets up to timeout secs more. If it does not end, it is
+        cancelled and its batch is kept, it may then be written twice."""
+        if self.subscription:
+            self.subscription.close()
+            self.subscription = None
+        self.flush()
+        loop = aio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not all(x.idle() for x in self.workers) and loop.time() < deadline:
+            await aio.sleep(0.05)
+        #A batch is only kept once its worker stopped writing, else it could be both written and spilled
+        for worker in self.workers:
+            worker.stopping = True
+            worker._wakeup()
+        running = [x.task for x in self.workers if x.task]
+        if running:
+            await aio.wait(running, timeout=timeout)
+        for task in self.tasks:
+            task.cancel()
+        await aio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for worker in self.workers:
+            if worker.spill_dir:
+                await worker.spilling_done()
+                #Keep the unwritten batches for the next run, they are older than the spilled ones
+                while worker.queue:
+                    await worker._spill(worker.queue.pop(), front=True)
+        for worker in self.workers:
+            worker.task = None
+            worker.stopping = False
+            await worker.sink.close()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we shard a large fleet of devices across several worker processes.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, logging, os, zlib
+import multiprocessing as mp
+
+from struct import pack, unpack_from
+from .devices import GetDevice, HBTIMEOUT
+
+# IPC message types. Every message is a single pipe frame:
+#    1 byte type | 6 bytes MAC | JSON payload (may be empty)
+MSG_REGISTER = 1
+MSG_UNREGISTER = 2
+MSG_COMMAND = 3
+MSG_CHANGE = 4
+MSG_STOP = 5
+
+HEADER = '>B6s'
+HEADER_SIZE = 7
+
+# The only device methods a parent may trigger in a worker
+ALLOWED_COMMANDS = ["on", "off", "led_on", "led_off", "set_name",
+                    "set_brightness", "set_temperature", "set_colour"]
+
+
+def mac_to_bytes(mac):
+    """Turn "50:C7:BF:01:02:03" into 6 raw bytes"""
+    return bytes.fromhex(mac.replace(":","").replace("-",""))
+
+def bytes_to_mac(raw):
+    return ":".join("{:02x}".format(x) for x in raw)
+
+def shard_of(mac, nbshards):
+    """Stable shard index for a MAC address, the same in every process"""
+    return zlib.crc32(mac_to_bytes(mac)) % nbshards
+
+def encode_msg(mtype, mac, payload=None):
+    if payload is None:
+        body = b""
+    else:
+        body = json.dumps(payload, separators=(',',':')).encode()
+    return pack(HEADER, mtype, mac_to_bytes(mac)) + body
+
+def decode_msg(data):
+    mtype, rawmac = unpack_from(HEADER, data)
+    if len(data) > HEADER_SIZE:
+        payload = json.loads(data[HEADER_SIZE:].decode())
+    else:
+        payload = None
+    return mtype, bytes_to_mac(rawmac), payload
+
+
+class _Worker(object):
+    """Runs in the worker process. Owns the TPDevice objects of one shard."""
+
+    def __init__(self, loop, conn, hb):
+        self.loop = loop
+        self.conn = conn
+        self.hb = hb
+        self.devices = {}
+        self.done = loop.create_future()
+
+    def _on_change(self, mac, changes):
+        try:
+            self.conn.send_bytes(encode_msg(MSG_CHANGE, mac, changes))
+        except (BrokenPipeError, OSError):
+            logging.debug("Worker {} lost its parent".format(os.getpid()))
+            self.stop()
+
+    def readin(self):
+        try:
+            while self.conn.poll():
+                msg = decode_msg(self.conn.recv_bytes())
+                try:
+                    self.dispatch(*msg)
+                except Exception as e:
+                    #e.g. an unknown model, do not lose the messages queued after it
+                    logging.debug("Could not handle message {} for {}: {}".format(msg[0], msg[1], e))
+        except (EOFError, OSError):
+            self.stop()
+
+    def dispatch(self, mtype, mac, payload):
+        if mtype == MSG_REGISTER:
+            info, addr = payload
+            addr = tuple(addr)
+            if mac in self.devices:
+                self.devices[mac].addr = addr[0]
+                return
+            dev = GetDevice(addr, info, hb=self.hb,
+                            on_change=lambda x, mac=mac: self._on_change(mac, x))
+            if dev:
+                self.devices[mac] = dev
+        elif mtype == MSG_UNREGISTER:
+            if mac in self.devices:
+                self.devices[mac].stop()
+                del(self.devices[mac])
+        elif mtype == MSG_COMMAND:
+            method, args = payload
+            if mac in self.devices and method in ALLOWED_COMMANDS:
+                try:
+                    getattr(self.devices[mac], method)(*args)
+                except Exception as e:
+                    logging.debug("Command {} failed for {}: {}".format(method, mac, e))
+        elif mtype == MSG_STOP:
+            self.stop()
+
+    def stop(self):
+        for dev in self.devices.values():
+            dev.stop()
+        self.devices = {}
+        if not self.done.done():
+            self.done.set_result(True)
+
+
+def _worker_main(conn, hb):
+    """Entry point of a worker process"""
+    loop = aio.new_event_loop()
+    aio.set_event_loop(loop)
+    worker = _Worker(loop, conn, hb)
+    loop.add_reader(conn.fileno(), worker.readin)
+    try:
+        loop.run_until_complete(worker.done)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.remove_reader(conn.fileno())
+        conn.close()
+        #Heartbeats may still be sleeping, do not leave them dangling
+        pending = [x for x in aio.all_tasks(loop) if not x.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(aio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+class TPFleet(object):
+    """Shard TP-Link devices across worker processes.
+
+    Each worker owns the TPDevice objects, and their heartbeat, for the MAC
+    addresses hashed to it. The fleet has "register" and "unregister" methods
+    so it can be used as the registrar of a TPLinkDiscovery. State changes from
+    the workers are passed to on_change(mac, changes) in the parent.
+    """
+
+    def __init__(self, loop, workers=None, hb=HBTIMEOUT, on_change=None):
+        self.loop = loop
+        self.nbworkers = workers or os.cpu_count() or 1
+        self.hb = hb
+        self.on_change = on_change
+        self.known_devices = set()
+        self.workers = []
+        self.conns = []
+
+    def start(self):
+        """Start the worker processes."""
+        ctx = mp.get_context("spawn")
+        for x in range(self.nbworkers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker_main, args=(child, self.hb), daemon=True)
+            proc.start()
+            child.close()
+            self.workers.append(proc)
+            self.conns.append(parent)
+            self.loop.add_reader(parent.fileno(), self._readin, parent)
+
+    def _readin(self, conn):
+        try:
+            while conn.poll():
+                mtype, mac, payload = decode_msg(conn.recv_bytes())
+                if mtype == MSG_CHANGE and self.on_change:
+                    self.on_change(mac, payload)
+        except (EOFError, OSError):
+            logging.debug("Lost connection to a fleet worker")
+            self.loop.remove_reader(conn.fileno())
+
+    def _send(self, mtype, mac, payload=None):
+        conn = self.conns[shard_of(mac, self.nbworkers)]
+        try:
+            conn.send_bytes(encode_msg(mtype, mac, payload))
+        except (BrokenPipeError, OSError) as e:
+            logging.debug("Could not reach the worker for {}: {}".format(mac, e))
+
+    def register(self, info, addr):
+        if "mac" not in info:
+            return
+        mac = info["mac"].lower()
+        self.known_devices.add(mac)
+        self._send(MSG_REGISTER, mac, [info, addr])
+
+    def unregister(self, mac):
+        mac = mac.lower()
+        if mac in self.known_devices:
+            self.known_devices.discard(mac)
+            self._send(MSG_UNREGISTER, mac)
+
+    def send(self, mac, method, *args):
+        """Ask the worker owning mac to call method(*args) on the device"""
+        if method not in ALLOWED_COMMANDS:
+            raise ValueError("Unknown fleet command {}".format(method))
+        mac = mac.lower()
+        if mac not in self.known_devices:
+            raise KeyError("Unknown device {}".format(mac))
+        self._send(MSG_COMMAND, mac, [method, args])
+
+    def stop(self):
+        """Ask the workers to stop. Return a task that waits for them to end,
+        joining them does not block the loop."""
+        for conn in self.conns:
+            try:
+                self.loop.remove_reader(conn.fileno())
+                conn.send_bytes(encode_msg(MSG_STOP, "00:00:00:00:00:00"))
+            except (OSError, ValueError):
+                pass
+        workers, conns = self.workers, self.conns
+        self.workers = []
+        self.conns = []
+        if not self.loop.is_running():
+            #Nothing else to run meanwhile
+            for proc in workers:
+                _join(proc)
+            for conn in conns:
+                conn.close()
+            return None
+        return self.loop.create_task(self._join(workers, conns))
+
+    async def _join(self, workers, conns):
+        await aio.gather(*[self.loop.run_in_executor(None, _join, proc) for proc in workers])
+        for conn in conns:
+            conn.close()
+
+
+def _join(proc, timeout=5):
+    proc.join(timeout=timeout)
+    if proc.is_alive():
+        proc.terminate()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we serve firmware images to the devices over HTTP.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import hashlib, logging, os, re, socket
+from urllib.parse import quote, unquote
+from . import commands
+
+DFLTPORT = 8080
+DFLTCLIENTS = 32 # Concurrent downloads, the others wait their turn
+HEADERTIMEOUT = 10
+RATESLICE = 0.1 # secs, bandwidth is limited by sending rate*RATESLICE bytes per slice
+CHUNK = 65536
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+_checksums = {} # (path, size, mtime) -> sha256 hex digest
+
+def checksum(path):
+    """The sha256 of a file, computed once per file version"""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if key not in _checksums:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(CHUNK * 16), b""):
+                digest.update(block)
+        _checksums[key] = digest.hexdigest()
+    return _checksums[key]
+
+def local_address(peer):
+    """Our address on the network used to reach peer"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((peer, 9))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+class _Image(object):
+
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+
+class FirmwareServer(object):
+    """A small HTTP server for firmware images, so devices can be upgraded offline.
+
+    Images are sent with loop.sendfile, the kernel copies the file to the
+    socket when it can. Single range requests are supported, so interrupted
+    downloads can resume. At most max_clients downloads run at once, the
+    other clients wait. rate, in bytes per sec, limits each download.
+
+    add() checks an image against its expected sha256 once, the checksum is
+    cached until the file changes. url_for() returns the URL to give a device,
+    and set_url_cmd() a ready FWSetUrlCmd.
+    """
+
+    def __init__(self, host="0.0.0.0", port=DFLTPORT, max_clients=DFLTCLIENTS, rate=None, advertise=None):
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self.rate = rate
+        self.advertise = advertise # Host name or address put in URLs, found out if None
+        self.images = {}
+        self.server = None
+        self.active = 0
+        self.served = 0
+        self._slots = None
+
+    async def add(self, path, name=None, sha256=None):
+        """Serve the file at path as name, by default its file name. If sha256
+        is given, the file must match it. Return the sha256 of the file."""
+        name = name or os.path.basename(path)
+        digest = await aio.get_event_loop().run_in_executor(None, checksum, path)
+        if sha256 and digest != sha256.lower():
+            raise ValueError("Checksum mismatch for {}".format(path))
+        self.images[name] = _Image(path, os.path.getsize(path), digest)
+        return digest
+
+    def remove(self, name):
+        self.images.pop(name, None)
+
+    def url_for(self, name, device_addr=None):
+        """The URL a device at device_addr should download name from"""
+        if name not in self.images:
+            raise KeyError("Unknown firmware {}".format(name))
+        host = self.advertise
+        if host is None:
+            if self.host not in ["0.0.0.0", ""]:
+                host = self.host
+            elif device_addr:
+                host = local_address(device_addr)
+            else:
+                host = socket.gethostbyname(socket.gethostname())
+        return "http://{}:{}/{}".format(host, self.port, quote(name))
+
+    def set_url_cmd(self, name, device):
+        cmd = commands.FWSetUrlCmd()
+        cmd.value = self.url_for(name, device.addr)
+        return cmd
+
+    async def start(self):
+        self._slots = aio.Semaphore(self.max_clients)
+        self.server = await aio.start_server(self._handle, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _read_request(self, reader):
+        lines = []
+        while True:
+            line = await reader.readline()
+            if not line or line in [b"\r\n", b"\n"]:
+                break
+            lines.append(line.decode("latin-1").rstrip("\r\n"))
+            if len(lines) > 100:
+                break
+        if not lines:
+            return None, None, {}
+        parts = lines[0].split()
+        if len(parts) < 2:
+            return None, None, {}
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, val = line.split(":", 1)
+                headers[key.strip().lower()] = val.strip()
+        return parts[0].upper(), unquote(parts[1].split("?")[0].lstrip("/")), headers
+
+    def _head(self, writer, status, headers):
+        text = "HTTP/1.1 {}\r\n".format(status)
+        for key, val in headers.items():
+            text += "{}: {}\r\n".format(key, val)
+        writer.write((text + "Connection: close\r\n\r\n").encode("latin-1"))
+
+    def _range(self, header, size):
+        """Return (start, end) inclusive, None for the whole file, or False if unsatisfiable"""
+        if not header:
+            return None
+        match = _RANGE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            return None # Not something we support, send everything
+        first, last = match.groups()
+        if first == "":
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return False
+        return start, end
+
+    async def _send(self, writer, image, offset, count):
+        loop = aio.get_event_loop()
+        with open(image.path, "rb") as f:
+            if not self.rate:
+                await loop.sendfile(writer.transport, f, offset, count)
+                return
+            slice_size = max(1, int(self.rate * RATESLICE))
+            while count > 0:
+                start = loop.time()
+                size = min(slice_size, count)
+                await loop.sendfile(writer.transport, f, offset, size)
+                await writer.drain()
+                offset += size
+                count -= size
+                delay = RATESLICE * size / slice_size - (loop.time() - start)
+                if delay > 0 and count > 0:
+                    await aio.sleep(delay)
+
+    async def _handle(self, reader, writer):
+        try:
+            method, name, headers = await aio.wait_for(self._read_request(reader), HEADERTIMEOUT)
+            if method is None:
+                return
+            if method not in ["GET", "HEAD"]:
+                self._head(writer, "405 Method Not Allowed", {"Allow": "GET, HEAD", "Content-Length": 0})
+                return
+            image = self.images.get(name)
+            if image is None:
+                self._head(writer, "404 Not Found", {"Content-Length": 0})
+                return
+            rng = self._range(headers.get("range"), image.size)
+            common = {"Content-Type": "application/octet-stream", "Accept-Ranges": "bytes",
+                      "ETag": '"{}"'.format(image.digest)}
+            if rng is False:
+                self._head(writer, "416 Range Not Satisfiable",
+                           {"Content-Range": "bytes */{}".format(image.size), "Content-Length": 0})
+                return
+            if method == "HEAD":
+                self._head(writer, "200 OK", dict(common, **{"Content-Length": image.size}))
+                return
+            async with self._slots:
+                self.active += 1
+                try:
+                    if rng is None:
+                        offset, count = 0, image.size
+                        self._head(writer, "200 OK", dict(common, **{"Content-Length": count}))
+                    else:
+                        offset, count = rng[0], rng[1] - rng[0] + 1
+                        self._head(writer, "206 Partial Content", dict(common, **{
+                            "Content-Length": count,
+                            "Content-Range": "bytes {}-{}/{}".format(rng[0], rng[1], image.size)}))
+                    await writer.drain()
+                    await self._send(writer, image, offset, count)
+                    self.served += 1
+                finally:
+                    self.active -= 1
+        except (aio.TimeoutError, ConnectionError) as e:
+            logging.debug("Firmware download interrupted: {}".format(e))
+        except Exception as e:
+            logging.debug("Firmware server error: {}".format(e))
+        finally:
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we serve the state of the devices, and take commands, over HTTP and WebSocket.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import argparse, base64, hashlib, json, logging, struct, time
+from urllib.parse import urlsplit, parse_qs, unquote
+from .devices import GetDevice, HBTIMEOUT
+from .events import FLEET_BUS, COALESCE
+from .fleet import ALLOWED_COMMANDS
+
+DFLTPORT = 8765
+HEADERTIMEOUT = 30 # secs an idle keep-alive connection is kept
+CMDTIMEOUT = 5 # secs a command may take before we answer 202 Accepted
+MAXBODY = 65536
+WSQUEUE = 1024 # Events waiting for a WebSocket client, coalesced per device beyond that
+WSGUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTLET_COMMANDS = ["on", "off", "set_name"]
+
+STATUS = {200: "OK", 202: "Accepted", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+          405: "Method Not Allowed", 413: "Payload Too Large", 502: "Bad Gateway"}
+
+
+def device_state(dev):
+    """What the gateway tells about a device, from memory"""
+    resu = {"mac": dev.mac, "name": dev.name, "model": dev.model, "type": dev.__class__.__name__,
+            "addr": dev.addr, "online": dev.online, "state": dev.state, "led": dev.led,
+            "power": dev.power, "caps": dev.caps}
+    if dev.is_light:
+        resu["colour"] = dev.colour
+    if getattr(dev, "outlets", None):
+        resu["outlets"] = [{"index": x.index, "name": x.name, "state": x.state, "power": x.power,
+                            "meter": x.meter} for x in dev.outlets]
+    return resu
+
+
+def _ws_frame(opcode, payload):
+    head = bytes([0x80 | opcode])
+    size = len(payload)
+    if size < 126:
+        head += bytes([size])
+    elif size < 65536:
+        head += bytes([126]) + struct.pack(">H", size)
+    else:
+        head += bytes([127]) + struct.pack(">Q", size)
+    return head + payload
+
+async def _ws_read(reader):
+    """Return (opcode, payload) of the next client frame"""
+    b1, b2 = await reader.readexactly(2)
+    size = b2 & 0x7f
+    if size == 126:
+        size = struct.unpack(">H", await reader.readexactly(2))[0]
+    elif size == 127:
+        size = struct.unpack(">Q", await reader.readexactly(8))[0]
+    if size > MAXBODY:
+        raise ValueError("WebSocket frame too large")
+    mask = await reader.readexactly(4) if b2 & 0x80 else None
+    payload = await reader.readexactly(size)
+    if mask:
+        payload = bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
+    return b1 & 0x0f, payload
+
+
+class _HTTPError(Exception):
+    """A request that cannot be read, answered with status"""
+
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+
+class _Request(object):
+
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = [unquote(x) for x in parts.path.split("/") if x]
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+
+class Gateway(object):
+    """Own the devices and share them with other processes.
+
+    The gateway is a registrar, give it to a discovery object. The device
+    state is served from memory, GET requests carry an ETag and a matching
+    If-None-Match is answered with 304 Not Modified. Replies are rendered
+    once per change, not once per request.
+
+        GET  /devices                      all the devices
+        GET  /devices/<mac>                one device
+        POST /devices/<mac>/<command>      body: JSON list of arguments, e.g. ["on"]
+        POST /devices/<mac>/outlets/<index>/<command>
+        GET  /events                       WebSocket of change events, ?mac=..&field=..
+
+    Commands go through the device, one at a time per device as usual. The
+    reply waits for the device, up to command_timeout secs, then is 202.
+    """
+
+    def __init__(self, host="127.0.0.1", port=DFLTPORT, hb=HBTIMEOUT, bus=FLEET_BUS, command_timeout=CMDTIMEOUT):
+        self.host = host
+        self.port = port
+        self.hb = hb
+        self.bus = bus
+        self.command_timeout = command_timeout
+        self.devices = {}
+        self.epoch = "{:x}".format(int(time.time())) # So ETags differ across restarts
+        self.version = 0
+        self.versions = {} # mac -> version of its last change
+        self._rendered = {} # key -> (version, etag, body)
+        self.server = None
+        self.subscription = None
+        self.clients = set() # WebSocket subscriptions
+        self.connections = set()
+        self.tasks = []
+
+    #Registrar
+    def register(self, info, addr):
+        if "mac" not in info:
+            return
+        mac = info["mac"].lower()
+        if mac in self.devices:
+            self._moved(mac, addr)
+            return
+        try:
+            dev = GetDevice(addr, info, hb=self.hb, on_change=None)
+        except KeyError:
+            logging.debug("Unsupported model {} for {}, skipped".format(info.get("model"), mac))
+            return
+        if dev:
+            dev.event_bus = self.bus
+            dev.mac = dev.mac or mac
+            self.devices[mac] = dev
+            self._changed(mac)
+
+    def update(self, info, addr):
+        if "mac" in info and info["mac"].lower() in self.devices:
+            self._moved(info["mac"].lower(), addr)
+
+    def _moved(self, mac, addr):
+        dev = self.devices[mac]
+        if dev.addr != addr[0]:
+            dev.addr = addr[0]
+            self._changed(mac) # The address is part of the state we serve
+
+    def unregister(self, mac):
+        dev = self.devices.pop(mac.lower(), None)
+        if dev:
+            dev.stop()
+            self.versions.pop(mac.lower(), None)
+            self._rendered.pop(mac.lower(), None)
+            self._changed(mac.lower())
+
+    def _changed(self, mac):
+        self.version += 1
+        self.versions[mac] = self.version
+
+    async def _track(self):
+        async for event in self.subscription:
+            if event.mac in self.devices:
+                self._changed(event.mac)
+
+    def _render(self, key, version, build):
+        cached = self._rendered.get(key)
+        if cached is None or cached[0] != version:
+            body = json.dumps(build(), separators=(',',':')).encode()
+            cached = self._rendered[key] = (version, '"{}-{}"'.format(self.epoch, version), body)
+        return cached[1], cached[2]
+
+    async def start(self):
+        self.subscription = self.bus.subscribe(maxsize=WSQUEUE, overflow=COALESCE)
+        self.tasks.append(aio.ensure_future(self._track()))
+        self.server = await aio.start_server(self._handle, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+        for sub in list(self.clients):
+            sub.close()
+        for writer in list(self.connections):
+            writer.close() # Idle keep-alive connections
+        if self.subscription:
+            self.subscription.close()
+            self.subscription = None
+        for task in self.tasks:
+            task.cancel()
+        await aio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.server:
+            await self.server.wait_closed()
+            self.server = None
+        for dev in self.devices.values():
+            dev.stop()
+
+    #HTTP
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) < 2:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in [b"\r\n", b"\n"]:
+                break
+            if ":" in line.decode("latin-1") and len(headers) < 100:
+                key, val = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = val.strip()
+        try:
+            size = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise _HTTPError(400, "Invalid Content-Length")
+        if size > MAXBODY:
+            raise _HTTPError(413, "Request body too large")
+        body = await reader.readexactly(size) if size else b""
+        return _Request(parts[0].upper(), parts[1], headers, body)
+
+    def _reply(self, writer, status, body=b"", headers=None, keep=True):
+        text = "HTTP/1.1 {} {}\r\n".format(status, STATUS.get(status, ""))
+        if status != 304:
+            text += "Content-Type: application/json\r\nContent-Length: {}\r\n".format(len(body))
+        for key, val in (headers or {}).items():
+            text += "{}: {}\r\n".format(key, val)
+        text += "Connection: {}\r\n\r\n".format((keep and "keep-alive") or "close")
+        writer.write(text.encode("latin-1") + (body if status != 304 else b""))
+
+    def _error(self, writer, status, msg, keep=True):
+        self._reply(writer, status, json.dumps({"error": msg}).encode(), keep=keep)
+
+    async def _handle(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    req = await aio.wait_for(self._read_request(reader), HEADERTIMEOUT)
+                except _HTTPError as e:
+                    self._error(writer, e.status, str(e), keep=False)
+                    break
+                if req is None:
+                    break
+                keep = req.headers.get("connection", "").lower() != "close"
+                if req.path == ["events"] and req.headers.get("upgrade", "").lower() == "websocket":
+                    await self._websocket(req, reader, writer)
+                    break
+                await self._route(req, writer, keep)
+                await writer.drain()
+                if not keep:
+                    break
+        except (aio.TimeoutError, aio.IncompleteReadError, ConnectionError) as e:
+            logging.debug("Gateway connection closed: {}".format(e))
+        except Exception as e:
+            logging.debug("Gateway error: {}".format(e))
+        finally:
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
+            self.connections.discard(writer)
+
+    async def _route(self, req, writer, keep):
+        path = req.path
+        if not path or path[0] != "devices":
+            self._error(writer, 404, "Not found", keep)
+        elif req.method == "GET" and len(path) <= 2:
+            self._get(req, writer, keep)
+        elif req.method == "POST" and len(path) in [3, 5]:
+            await self._command(req, writer, keep)
+        else:
+            self._error(writer, 405, "Method not allowed", keep)
+
+    def _get(self, req, writer, keep):
+        path = req.path
+        if len(path) == 1:
+            etag, body = self._render("*", self.version,
+                                      lambda: {"devices": [device_state(x) for x in self.devices.values()]})
+        else:
+            mac = path[1].lower()
+            if mac not in self.devices:
+                self._error(writer, 404, "Unknown device {}".format(mac), keep)
+                return
+            etag, body = self._render(mac, self.versions.get(mac, 0), lambda: device_state(self.devices[mac]))
+        if etag in [x.strip() for x in req.headers.get("if-none-match", "").split(",")]:
+            self._reply(writer, 304, headers={"ETag": etag}, keep=keep)
+        else:
+            self._reply(writer, 200, body, {"ETag": etag, "Cache-Control": "no-cache"}, keep)
+
+    async def _command(self, req, writer, keep):
+        path = req.path
+        mac = path[1].lower()
+        dev = self.devices.get(mac)
+        if dev is None:
+            self._error(writer, 404, "Unknown device {}".format(mac), keep)
+            return
+        target, allowed = dev, ALLOWED_COMMANDS
+        if len(path) == 5:
+            if path[2] != "outlets":
+                self._error(writer, 404, "Not found", keep)
+                return
+            try:
+                target = [x for x in getattr(dev, "outlets", []) if x.index == int(path[3])][0]
+            except (IndexError, ValueError):
+                self._error(writer, 404, "Unknown outlet {}".format(path[3]), keep)
+                return
+            allowed = OUTLET_COMMANDS
+        method = path[-1]
+        if method not in allowed or not hasattr(target, method):
+            self._error(writer, 404, "Unknown command {}".format(method), keep)
+            return
+        try:
+            args = json.loads(req.body.decode() or "[]")
+            if not isinstance(args, list):
+                raise ValueError("Arguments must be a JSON list")
+            task = getattr(target, method)(*args)
+        except (ValueError, TypeError) as e:
+            self._error(writer, 400, str(e), keep)
+            return
+        status = 200
+        if task is not None:
+            try:
+                await aio.wait_for(aio.shield(task), self.command_timeout)
+            except aio.TimeoutError:
+                status = 202 # Still queued or running
+            except Exception as e:
+                self._error(writer, 502, "Device {} failed: {}".format(mac, e), keep)
+                return
+        self._reply(writer, status, json.dumps(device_state(dev), separators=(',',':')).encode(), keep=keep)
+
+    #WebSocket
+    async def _websocket(self, req, reader, writer):
+        key = req.headers.get("sec-websocket-key")
+        if not key:
+            self._error(writer, 400, "Missing Sec-WebSocket-Key", False)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WSGUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Accept: {}\r\n\r\n").format(accept).encode("latin-1"))
+        macs = [x.lower() for x in req.query.get("mac", [])] or None
+        fields = req.query.get("field") or None
+        sub = self.bus.subscribe(macs=macs, fields=fields, maxsize=WSQUEUE, overflow=COALESCE)
+        self.clients.add(sub)
+        listener = aio.ensure_future(self._ws_listen(reader, writer, sub))
+        try:
+            async for event in sub:
+                data = json.dumps(event._asdict(), separators=(',',':')).encode()
+                writer.write(_ws_frame(0x1, data))
+                await writer.drain()
+        finally:
+            sub.close()
+            self.clients.discard(sub)
+            listener.cancel()
+            await aio.gather(listener, return_exceptions=True)
+
+    async def _ws_listen(self, reader, writer, sub):
+        """Answer pings, and end the subscription when the client goes away"""
+        try:
+            while True:
+                opcode, payload = await _ws_read(reader)
+                if opcode == 0x8:
+                    writer.write(_ws_frame(0x8, payload[:2]))
+                    break
+                if opcode == 0x9:
+                    writer.write(_ws_frame(0xA, payload))
+        except (aio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            sub.close()
+
+
+def main():
+    from .discover import TPLinkDiscovery
+    parser = argparse.ArgumentParser(description="Serve TP-Link devices over HTTP and WebSocket.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=DFLTPORT, help="Port to listen on (default: %(default)s)")
+    parser.add_argument("--hb", type=int, default=HBTIMEOUT, help="Heartbeat, in secs (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=60, help="Discovery period, in secs (default: %(default)s)")
+    parser.add_argument("-d", "--debug", action="store_true", default=False, help="Print debug messages")
+    opts = parser.parse_args()
+    if opts.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    loop = aio.get_event_loop()
+    gateway = Gateway(opts.host, opts.port, opts.hb)
+    discovery = TPLinkDiscovery(loop, gateway, repeat=opts.repeat)
+    try:
+        loop.run_until_complete(gateway.start())
+        discovery.start()
+        print("Serving on http://{}:{}/devices".format(opts.host, gateway.port))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("Exiting at user's request.")
+    finally:
+        discovery.cleanup()
+        loop.run_until_complete(gateway.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
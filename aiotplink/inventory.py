@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we keep a persistent inventory of known devices for a fast start.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, logging, os, time
+
+from .devices import GetDevice, HBTIMEOUT
+from .discover import AsyncRegistrar, REGISTER, UPDATE, UNREGISTER
+
+INVENTORY_VERSION = 1
+
+
+class TPInventory(object):
+    """A small on-disk cache of the known devices, keyed by MAC address.
+
+    Each entry remembers the address, model, capabilities, name and last known
+    state of a device, so that devices can be created at startup without waiting
+    for discovery.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+    def load(self):
+        """Read the inventory file. A missing or broken file is an empty inventory"""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == INVENTORY_VERSION:
+                self.entries = data["devices"]
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            logging.debug("Could not load inventory {}: {}".format(self.path, e))
+            self.entries = {}
+        return self.entries
+
+    def dumps(self):
+        return json.dumps({"version": INVENTORY_VERSION, "devices": self.entries}, separators=(',',':'))
+
+    def write(self, data):
+        """Atomically write data to the inventory file"""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def save(self):
+        self.write(self.dumps())
+
+    def remember_info(self, info, addr):
+        """Record what discovery told us about a device"""
+        if "mac" not in info or "model" not in info:
+            return
+        entry = self.entries.setdefault(info["mac"].lower(), {})
+        entry["addr"] = list(addr)
+        entry["model"] = info["model"]
+        entry["name"] = info.get("name")
+        entry["seen"] = int(time.time())
+        for key in ["state", "led"]:
+            if key in info:
+                entry[key] = info[key]
+
+    def remember_device(self, mac, dev):
+        """Record the current state of a device object"""
+        entry = self.entries.setdefault(mac.lower(), {})
+        entry["addr"] = [dev.addr, dev.port]
+        entry["model"] = dev.model or entry.get("model")
+        entry["name"] = dev.name
+        entry["caps"] = dev.caps
+        #An offline device has no state, keep the last known one
+        if dev.state is not None:
+            entry["state"] = dev.state
+        if dev.led is not None:
+            entry["led"] = dev.led
+        if dev.is_light:
+            entry["colour"] = dev.colour
+        if dev.last_heartbeat is not None:
+            entry["seen"] = int(time.time())
+
+    def forget(self, mac):
+        self.entries.pop(mac.lower(), None)
+
+    def create_device(self, mac, hb=HBTIMEOUT, on_change=None):
+        """Create a device object from an inventory entry.
+
+        The device heartbeat will confirm, or not, that it is still there.
+        """
+        entry = self.entries.get(mac.lower())
+        if not entry or not entry.get("model"):
+            return None
+        info = {"mac": mac, "model": entry["model"], "name": entry.get("name")}
+        try:
+            dev = GetDevice(tuple(entry["addr"]), info, hb, on_change)
+        except KeyError:
+            logging.debug("Unsupported model {} for {}, skipped".format(entry["model"], mac))
+            return None
+        if dev is None:
+            return None
+        if entry.get("caps"):
+            dev.caps.update(entry["caps"])
+        dev.state = entry.get("state")
+        dev.led = entry.get("led")
+        if dev.is_light and entry.get("colour"):
+            dev.colour.update(entry["colour"])
+        return dev
+
+
+class InventoryRegistrar(AsyncRegistrar):
+    """A registrar that starts from the inventory and reconciles it with discovery.
+
+    Call preload() at startup, devices are available right away in the
+    "devices" attribute. Discovery then confirms, moves or adds devices, and
+    the inventory is saved after each batch.
+    """
+
+    def __init__(self, inventory, hb=HBTIMEOUT, on_change=None):
+        self.inventory = inventory
+        self.hb = hb
+        self.on_change = on_change
+        self.devices = {}
+
+    def preload(self):
+        self.inventory.load()
+        for mac in list(self.inventory.entries):
+            try:
+                dev = self.inventory.create_device(mac, self.hb, self._change_cb(mac))
+            except Exception as e:
+                logging.debug("Could not create {} from the inventory: {}".format(mac, e))
+                continue
+            if dev:
+                self.devices[mac] = dev
+        return self.devices
+
+    def _change_cb(self, mac):
+        if self.on_change is None:
+            return None
+        return lambda x: self.on_change(mac, x)
+
+    async def process(self, events):
+        for event in events:
+            try:
+                self._process(event)
+            except Exception as e:
+                #One bad event must not cost the rest of the batch, nor the save
+                logging.debug("Could not process {} for {}: {}".format(event.kind, event.mac, e))
+        await self.save()
+
+    def _process(self, event):
+        if event.kind in [REGISTER, UPDATE]:
+            self.inventory.remember_info(event.info, event.addr)
+            dev = self.devices.get(event.mac)
+            if dev:
+                dev.addr, dev.port = event.addr
+            else:
+                dev = self.inventory.create_device(event.mac, self.hb, self._change_cb(event.mac))
+                if dev:
+                    self.devices[event.mac] = dev
+        elif event.kind == UNREGISTER:
+            #Stays in the inventory, it may come back.
+            dev = self.devices.pop(event.mac, None)
+            if dev:
+                self.inventory.remember_device(event.mac, dev)
+                dev.stop()
+
+    async def save(self):
+        for mac, dev in self.devices.items():
+            self.inventory.remember_device(mac, dev)
+        try:
+            data = self.inventory.dumps()
+            await aio.get_event_loop().run_in_executor(None, self.inventory.write, data)
+        except Exception as e:
+            logging.debug("Could not save inventory {}: {}".format(self.inventory.path, e))
+
+    def stop(self):
+        for mac, dev in self.devices.items():
+            self.inventory.remember_device(mac, dev)
+            dev.stop()
+        self.inventory.save()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we adapt how often devices are polled to how often they change.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+
+DFLTFLOOR = 5 #Never poll faster than every 5 secs
+DFLTCEILING = 300 #Never poll slower than every 5 mins
+DFLTPOWERDELTA = 0.05 #A 5% power change counts as a change
+
+
+class PollBudget(object):
+    """A fleet-wide limit on the number of polls per sec, as a token bucket.
+
+    Every device sharing the budget waits for a token before polling.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = None
+
+    def _refill(self, now):
+        if self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self):
+        """Take a token if there is one, never waits"""
+        self._refill(aio.get_event_loop().time())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        loop = aio.get_event_loop()
+        while True:
+            self._refill(loop.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await aio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptivePoll(object):
+    """Adapt the heartbeat interval of devices to how much they change.
+
+    After a poll where the state, the LED or the power (by more than
+    power_delta, relative) changed, the interval is divided by speedup, down to
+    floor. After a quiet poll, it is multiplied by slowdown, up to ceiling. A
+    successful set command pushes the next poll back by the current interval.
+    If budget, a PollBudget, is given, it caps the polls of every device
+    using this policy.
+
+    Assign the policy to the "poll_policy" attribute of the devices.
+    """
+
+    def __init__(self, floor=DFLTFLOOR, ceiling=DFLTCEILING, speedup=2, slowdown=1.5,
+                 power_delta=DFLTPOWERDELTA, budget=None):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.speedup = speedup
+        self.slowdown = slowdown
+        self.power_delta = power_delta
+        self.budget = budget
+
+    def power_changed(self, old, new):
+        if old is None or new is None:
+            return old != new
+        return abs(new - old) > self.power_delta * max(abs(old), 1)
+
+    def next_interval(self, device, changed):
+        interval = device.poll_interval or device.hbto
+        if changed:
+            interval = max(self.floor, interval / self.speedup)
+        else:
+            interval = min(self.ceiling, interval * self.slowdown)
+        device.poll_interval = interval
+        return interval
+
+    def hold_off(self, device):
+        """How long after a successful set command the device need not be polled"""
+        return device.poll_interval or device.hbto
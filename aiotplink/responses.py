@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we have typed records for the replies of the devices.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+class field(object):
+    """A record field, decoded from the raw reply only when it is read.
+
+    keys are tried in order, the first one present wins. Keys listed in milli are
+    values in thousandths (e.g. power_mw), they are divided by 1000. conv, if
+    given, is applied to the value found.
+    """
+
+    __slots__ = ("keys", "milli", "conv")
+
+    def __init__(self, *keys, milli=(), conv=None):
+        self.keys = keys
+        self.milli = milli
+        self.conv = conv
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        raw = obj._raw
+        for key in self.keys:
+            if key in raw:
+                return self.conv(raw[key]) if self.conv else raw[key]
+        for key in self.milli:
+            if key in raw:
+                val = raw[key] / 1000
+                return self.conv(val) if self.conv else val
+        return None
+
+
+def _onoff(val):
+    return (val and "on") or "off"
+
+def _offon(val):
+    return (val and "off") or "on"
+
+
+class TPRecord(object):
+    """The reply to one command, kept as the raw decoded JSON.
+
+    Typed subclasses decode their fields lazily. as_dict() returns the flat,
+    translated dictionary that BasicCommand.response has always returned.
+    """
+
+    __slots__ = ("_raw", "_schema")
+
+    def __init__(self, raw, schema=None):
+        self._raw = raw if isinstance(raw, dict) else {}
+        self._schema = schema
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def err_code(self):
+        return self._raw.get("err_code", 0)
+
+    @property
+    def err_msg(self):
+        return self._raw.get("err_msg")
+
+    def get(self, key, default=None):
+        return self._raw.get(key, default)
+
+    def as_dict(self, ignore=None):
+        """The old dictionary form. ignore, if given, replaces the ignored keys
+        of the schema"""
+        if self._schema is None:
+            return dict(self._raw)
+        resu = {}
+        translation = self._schema.translation
+        vtranslation = self._schema.vtranslation
+        if ignore is None:
+            ignore = self._schema.ignore
+        for skey, val in self._raw.items():
+            if skey not in ignore:
+                if skey in vtranslation:
+                    val = vtranslation[skey][val]
+                resu[translation.get(skey, skey)] = val
+        return resu
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self._raw)
+
+
+class SysInfo(TPRecord):
+    """Reply to get_sysinfo"""
+
+    __slots__ = ()
+
+    mac = field("mac", "mic_mac")
+    name = field("alias")
+    model = field("model")
+    device_type = field("type", "mic_type")
+    device_id = field("deviceId")
+    hw_ver = field("hw_ver")
+    sw_ver = field("sw_ver")
+    rssi = field("rssi")
+    on_time = field("on_time")
+    led = field("led_off", conv=_offon)
+    children = field("children")
+
+    @property
+    def state(self):
+        if "relay_state" in self._raw:
+            return _onoff(self._raw["relay_state"])
+        if "light_state" in self._raw:
+            return _onoff(self._raw["light_state"].get("on_off"))
+        return None
+
+    @property
+    def location(self):
+        if "latitude" in self._raw:
+            return (self._raw["latitude"], self._raw["longitude"])
+        if "latitude_i" in self._raw:
+            return (self._raw["latitude_i"] / 10000, self._raw["longitude_i"] / 10000)
+        return None
+
+    @property
+    def light_state(self):
+        if "light_state" in self._raw:
+            return LightState(self._raw["light_state"])
+        return None
+
+
+class RealtimeEmeter(TPRecord):
+    """Reply to get_realtime. Older devices report A, V, W and kWh, newer ones
+    mA, mV, mW and Wh. Both are returned in A, V, W and kWh."""
+
+    __slots__ = ()
+
+    current = field("current", milli=("current_ma",))
+    voltage = field("voltage", milli=("voltage_mv",))
+    power = field("power", milli=("power_mw",))
+    total = field("total", milli=("total_wh",))
+
+
+class LightState(TPRecord):
+    """Reply to get_light_state. When the light is off, the colour is the one
+    it will have when turned on."""
+
+    __slots__ = ()
+
+    def _colour(self, key):
+        if not self._raw.get("on_off") and "dft_on_state" in self._raw:
+            return self._raw["dft_on_state"].get(key)
+        return self._raw.get(key)
+
+    @property
+    def state(self):
+        return _onoff(self._raw.get("on_off"))
+
+    @property
+    def hue(self):
+        return self._colour("hue")
+
+    @property
+    def saturation(self):
+        return self._colour("saturation")
+
+    @property
+    def brightness(self):
+        return self._colour("brightness")
+
+    @property
+    def temperature(self):
+        return self._colour("color_temp")
+
+    @property
+    def mode(self):
+        return self._colour("mode")
+
+
+class DayStats(TPRecord):
+    """Reply to get_daystat"""
+
+    __slots__ = ()
+
+    @property
+    def days(self):
+        """List of (year, month, day, kWh)"""
+        resu = []
+        for x in self._raw.get("day_list", []):
+            energy = x["energy"] if "energy" in x else x.get("energy_wh", 0) / 1000
+            resu.append((x["year"], x["month"], x["day"], energy))
+        return resu
+
+
+class MonthStats(TPRecord):
+    """Reply to get_monthstat"""
+
+    __slots__ = ()
+
+    @property
+    def months(self):
+        """List of (year, month, kWh)"""
+        resu = []
+        for x in self._raw.get("month_list", []):
+            energy = x["energy"] if "energy" in x else x.get("energy_wh", 0) / 1000
+            resu.append((x["year"], x["month"], energy))
+        return resu
+
+
+class ScanResult(TPRecord):
+    """Reply to get_scaninfo"""
+
+    __slots__ = ()
+
+    @property
+    def access_points(self):
+        """List of (ssid, key_type)"""
+        return [(x.get("ssid"), x.get("key_type")) for x in self._raw.get("ap_list", [])]
+
+
+class DownloadState(TPRecord):
+    """Reply to get_download_state"""
+
+    __slots__ = ()
+
+    status = field("status")
+    ratio = field("ratio")
+    reboot_time = field("reboot_time")
+    flash_time = field("flash_time")
+
+
+class RuleList(TPRecord):
+    """Reply to get_rules of the schedule, count_down and anti_theft modules"""
+
+    __slots__ = ()
+
+    enable = field("enable")
+    version = field("version")
+
+    @property
+    def rules(self):
+        return self._raw.get("rule_list", [])
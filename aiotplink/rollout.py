@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we upgrade the firmware of a whole fleet, in waves.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, logging, os, time
+from . import commands
+
+STATE_VERSION = 1
+DFLTCONCURRENCY = 20 # Devices upgraded at the same time
+DFLTCANARY = 2 # Size of the first wave of each group
+DFLTWAVE = 50
+DFLTFAILRATE = 0.1 # Stop when more than this share of a wave failed
+POLLINTERVAL = 5 # secs between two progress polls
+DOWNLOADTIMEOUT = 900
+STALLTIMEOUT = 120 # No download progress for that long is a failure
+REBOOTTIMEOUT = 240
+QUERYTIMEOUT = 5
+SAVEDELAY = 1 # The state file is written at most once per SAVEDELAY secs
+
+# Device states in the state file
+PENDING = "pending"
+DOWNLOADING = "downloading"
+FLASHING = "flashing"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class RolloutError(commands.TPLException):
+    pass
+
+
+class _Watch(object):
+
+    def __init__(self, device, cmd, check, timeout, stall, future):
+        loop = aio.get_event_loop()
+        self.device = device
+        self.cmd = cmd
+        self.check = check
+        self.stall = stall
+        self.deadline = loop.time() + timeout
+        self.future = future
+        self.progress = None
+        self.last_progress = loop.time()
+
+
+class ProgressPoller(object):
+    """One task polling every device being upgraded.
+
+    watch(device, cmd, check, timeout) returns a future. Every interval secs,
+    cmd() is sent to each watched device, at most concurrency at a time, and
+    check(reply) is called: it returns True when the device is done, a
+    progress value otherwise, and raises if the device failed. Unanswered
+    polls are ignored, a device may be rebooting, until the timeout.
+    A device whose progress does not change for stall secs has failed, unless
+    the watch was started with stall set to 0.
+    """
+
+    def __init__(self, interval=POLLINTERVAL, concurrency=DFLTCONCURRENCY, stall=STALLTIMEOUT):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.stall = stall
+        self.watches = {}
+        self.task = None
+
+    def watch(self, device, cmd, check, timeout, stall=None):
+        future = aio.get_event_loop().create_future()
+        stall = self.stall if stall is None else stall
+        self.watches[device] = _Watch(device, cmd, check, timeout, stall, future)
+        if self.task is None or self.task.done():
+            self.task = aio.ensure_future(self._run())
+        return future
+
+    def _resolve(self, watch, result=None, exc=None):
+        self.watches.pop(watch.device, None)
+        if watch.future.done():
+            return
+        if exc:
+            watch.future.set_exception(exc)
+        else:
+            watch.future.set_result(result)
+
+    async def _poll(self, watch, semaphore):
+        loop = aio.get_event_loop()
+        async with semaphore:
+            try:
+                resu = await watch.device._send_cmd(watch.cmd(), timeout=QUERYTIMEOUT)
+            except Exception as e:
+                resu = None
+                logging.debug("No progress from {}: {}".format(watch.device.name, e))
+        now = loop.time()
+        if resu is not None:
+            try:
+                progress = watch.check(resu)
+            except Exception as e:
+                self._resolve(watch, exc=e)
+                return
+            if progress is True:
+                self._resolve(watch, resu)
+                return
+            if progress != watch.progress:
+                watch.progress = progress
+                watch.last_progress = now
+        if now > watch.deadline:
+            self._resolve(watch, exc=RolloutError("Timeout"))
+        elif watch.stall and now - watch.last_progress > watch.stall:
+            self._resolve(watch, exc=RolloutError("No progress"))
+
+    async def _run(self):
+        while self.watches:
+            await aio.sleep(self.interval)
+            semaphore = aio.Semaphore(self.concurrency)
+            await aio.gather(*[self._poll(x, semaphore) for x in list(self.watches.values())])
+
+    def stop(self):
+        for watch in list(self.watches.values()):
+            if not watch.future.done():
+                watch.future.cancel()
+        self.watches = {}
+        if self.task:
+            self.task.cancel()
+
+
+class FirmwareRollout(object):
+    """Upgrade the firmware of many devices.
+
+    firmwares maps (model, hardware version) to (url, software version).
+    The model may be the full one, e.g. "HS110(EU)", or its first 5 letters.
+    With a fwserver.FirmwareServer as server, url may be the name of an image
+    it serves, each device then gets a URL it can reach.
+    Devices are grouped by model and hardware version. Each group is upgraded
+    in waves, a small canary wave first, then waves of wave_size devices, with
+    at most concurrency devices at the same time. Download and reboot progress
+    is polled for all devices by a single ProgressPoller. If more than
+    max_fail_rate of a wave fails, the wave is stopped and so is the rollout.
+
+    Every device state is kept in the state_path JSON file. Running again with
+    the same file resumes: devices already running the new firmware are left
+    alone, the others are retried.
+    """
+
+    def __init__(self, firmwares, state_path, concurrency=DFLTCONCURRENCY, canary=DFLTCANARY,
+                 wave_size=DFLTWAVE, max_fail_rate=DFLTFAILRATE, poll_interval=POLLINTERVAL,
+                 download_timeout=DOWNLOADTIMEOUT, reboot_timeout=REBOOTTIMEOUT, stall=STALLTIMEOUT,
+                 server=None):
+        self.firmwares = firmwares
+        self.server = server
+        self.state_path = state_path
+        self.concurrency = concurrency
+        self.canary = canary
+        self.wave_size = wave_size
+        self.max_fail_rate = max_fail_rate
+        self.download_timeout = download_timeout
+        self.reboot_timeout = reboot_timeout
+        self.poller = ProgressPoller(poll_interval, concurrency, stall)
+        self.state = {"version": STATE_VERSION, "halted": None, "devices": {}}
+        self.halted = False
+        self._save_handle = None
+        self._save_lock = aio.Lock() # One write at a time, they share the temporary file
+
+    # State file
+
+    def load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == STATE_VERSION:
+                self.state = data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.debug("Could not load rollout state {}: {}".format(self.state_path, e))
+        return self.state
+
+    def write(self, data):
+        """Atomically write data to the state file"""
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.state_path)
+
+    async def save(self):
+        """Write the state as it is now, the file I/O is done in the executor"""
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+        data = json.dumps(self.state, separators=(',',':'))
+        async with self._save_lock:
+            try:
+                await aio.get_event_loop().run_in_executor(None, self.write, data)
+            except Exception as e:
+                logging.debug("Could not save rollout state {}: {}".format(self.state_path, e))
+
+    def _changed(self):
+        if self._save_handle is None:
+            self._save_handle = aio.get_event_loop().call_later(SAVEDELAY, lambda: aio.ensure_future(self.save()))
+
+    def _key(self, device):
+        """Devices are known by MAC address, by address and port when it is not known"""
+        if device.mac:
+            return device.mac.lower()
+        return "{}:{}".format(device.addr, device.port)
+
+    def _set(self, device, status, **kwargs):
+        entry = self.state["devices"].setdefault(self._key(device), {})
+        entry["status"] = status
+        entry["updated"] = int(time.time())
+        entry.update(kwargs)
+        self._changed()
+
+    def status(self, device):
+        return self.state["devices"].get(self._key(device), {}).get("status")
+
+    # Planning
+
+    def firmware_for(self, model, hw_ver):
+        for key in [(model, hw_ver), (model[:5].upper(), hw_ver)]:
+            if key in self.firmwares:
+                return self.firmwares[key]
+        return None
+
+    async def _identify(self, device, semaphore):
+        async with semaphore:
+            info = await device._send_cmd(commands.InfoCmd(), timeout=QUERYTIMEOUT)
+        if device.mac is None:
+            device.mac = info.get("mac") or info.get("mic_mac")
+        return info.get("model", device.model), info.get("hardware version"), info.get("software version", "")
+
+    async def plan(self, devices):
+        """Group the devices that need an upgrade. Return {(model, hw_ver): [devices]}"""
+        semaphore = aio.Semaphore(self.concurrency)
+        infos = await aio.gather(*[self._identify(x, semaphore) for x in devices], return_exceptions=True)
+        groups = {}
+        for device, info in zip(devices, infos):
+            if isinstance(info, Exception):
+                logging.debug("Could not identify {}: {}".format(device.name, info))
+                continue
+            model, hw_ver, sw_ver = info
+            firmware = self.firmware_for(model, hw_ver)
+            if firmware is None:
+                continue
+            if sw_ver.startswith(firmware[1]):
+                if self.status(device) != DONE:
+                    self._set(device, SKIPPED, model=model, hw_ver=hw_ver, target=firmware[1])
+                continue
+            self._set(device, PENDING, model=model, hw_ver=hw_ver, target=firmware[1], error=None)
+            groups.setdefault((model, hw_ver), []).append(device)
+        return groups
+
+    def waves(self, devices):
+        """Split a group in waves, canary first"""
+        resu = []
+        if self.canary:
+            resu.append(devices[:self.canary])
+            devices = devices[self.canary:]
+        for idx in range(0, len(devices), self.wave_size):
+            resu.append(devices[idx:idx + self.wave_size])
+        return [x for x in resu if x]
+
+    # Upgrade
+
+    def _download_check(self, resu):
+        if resu.get("status", 0) < 0:
+            raise RolloutError("Download failed with status {}".format(resu["status"]))
+        if resu.get("ratio", 0) >= 100:
+            return True
+        return resu.get("ratio", 0)
+
+    def _version_check(self, target):
+        def check(resu):
+            return resu.get("software version", "").startswith(target) or None
+        return check
+
+    async def upgrade(self, device, url, version):
+        """Upgrade one device, raise if it fails"""
+        self._set(device, DOWNLOADING)
+        if self.server and not url.startswith("http"):
+            cmd = self.server.set_url_cmd(url, device)
+        else:
+            cmd = commands.FWSetUrlCmd()
+            cmd.value = url
+        await device._send_cmd(cmd, timeout=QUERYTIMEOUT)
+        await self.poller.watch(device, commands.FWDownloadStateCmd, self._download_check, self.download_timeout)
+        self._set(device, FLASHING)
+        await device._send_cmd(commands.FWFlashCmd(), timeout=QUERYTIMEOUT)
+        await self.poller.watch(device, commands.InfoCmd, self._version_check(version),
+                                self.reboot_timeout, stall=0)
+        self._set(device, DONE, error=None)
+
+    async def run_wave(self, wave, url, version):
+        """Upgrade a wave. Return False if too many failed and the wave was stopped."""
+        semaphore = aio.Semaphore(self.concurrency)
+        allowed = int(self.max_fail_rate * len(wave))
+        failures = [0]
+        stopped = aio.Event()
+
+        async def one(device):
+            async with semaphore:
+                if stopped.is_set():
+                    return
+                try:
+                    await self.upgrade(device, url, version)
+                except aio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.debug("Upgrade of {} failed: {}".format(device.name, e))
+                    self._set(device, FAILED, error=str(e) or e.__class__.__name__)
+                    failures[0] += 1
+                    if failures[0] > allowed:
+                        stopped.set()
+
+        await aio.gather(*[one(x) for x in wave])
+        return not stopped.is_set()
+
+    async def run(self, devices):
+        """Upgrade what needs to be. Return the number of devices in each state."""
+        self.load()
+        self.halted = False
+        self.state["halted"] = None
+        try:
+            groups = await self.plan(devices)
+            for key in sorted(groups, key=lambda x: (x[0], x[1] or "")):
+                url, version = self.firmware_for(*key)
+                for wave in self.waves(groups[key]):
+                    if not await self.run_wave(wave, url, version):
+                        self.halted = True
+                        self.state["halted"] = "Too many failures upgrading {} {}".format(*key)
+                        logging.warning(self.state["halted"])
+                        return self.summary()
+            return self.summary()
+        finally:
+            self.poller.stop()
+            await self.save()
+
+    def summary(self):
+        resu = {}
+        for entry in self.state["devices"].values():
+            resu[entry["status"]] = resu.get(entry["status"], 0) + 1
+        return resu
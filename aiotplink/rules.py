@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we keep the schedules, count downs and anti theft rules of devices in sync.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import logging
+from collections import namedtuple
+from . import commands
+
+DAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"] # The order of "wday"
+SUNRISE = "sunrise"
+SUNSET = "sunset"
+DFLTCONCURRENCY = 16 # Devices synced at the same time
+SYNCTIMEOUT = 10
+
+ADD = "add"
+EDIT = "edit"
+DELETE = "delete"
+
+RuleChange = namedtuple("RuleChange", ["kind", "rule"])
+SyncResult = namedtuple("SyncResult", ["added", "edited", "deleted", "unchanged"])
+
+
+def _wday(days):
+    """days is None for every day, or a list of day names ("mon") or numbers, 0 is Sunday"""
+    if days is None:
+        return [1] * 7
+    resu = [0] * 7
+    for day in days:
+        if isinstance(day, str):
+            day = DAYS.index(day[:3].lower())
+        resu[day] = 1
+    return resu
+
+def _when(when):
+    """Turn "HH:MM", "sunrise", "sunset" or (SUNSET, -30) into (time option, minutes)"""
+    if isinstance(when, (tuple, list)):
+        kind, offset = when
+    else:
+        kind, offset = when, 0
+    if kind == SUNRISE:
+        return 1, offset
+    if kind == SUNSET:
+        return 2, offset
+    hours, minutes = kind.split(":")
+    return 0, int(hours) * 60 + int(minutes)
+
+def _act(action):
+    if action not in ["on", "off"]:
+        raise ValueError("Rule action must be \"on\" or \"off\"")
+    return (action == "on" and 1) or 0
+
+def schedule_rule(name, action, when, days=None, enable=True):
+    """A rule switching the device on or off at a given time, e.g.
+    schedule_rule("porch off", "off", (SUNRISE, 15), ["mon", "tue"])"""
+    opt, smin = _when(when)
+    return {"name": name, "enable": (enable and 1) or 0, "wday": _wday(days), "repeat": 1,
+            "stime_opt": opt, "smin": smin, "sact": _act(action),
+            "etime_opt": -1, "emin": 0, "eact": -1, "year": 0, "month": 0, "day": 0}
+
+def count_down_rule(name, action, delay, enable=True):
+    """A rule switching the device on or off delay secs after it is added"""
+    return {"name": name, "enable": (enable and 1) or 0, "delay": int(delay), "act": _act(action)}
+
+def anti_theft_rule(name, start, end, days=None, frequency=5, enable=True):
+    """Switch the device on and off at random between start and end, about
+    frequency times, to make the house look lived in."""
+    sopt, smin = _when(start)
+    eopt, emin = _when(end)
+    return {"name": name, "enable": (enable and 1) or 0, "wday": _wday(days), "repeat": 1,
+            "stime_opt": sopt, "smin": smin, "etime_opt": eopt, "emin": emin,
+            "frequency": frequency, "year": 0, "month": 0, "day": 0}
+
+
+def _same(desired, current):
+    """The device adds its own fields, only compare ours"""
+    return all(current.get(k) == v for k, v in desired.items())
+
+def diff_rules(desired, current):
+    """The changes turning the current rules, as stored on a device, into the
+    desired ones. Rules are matched by name. Deletions come first, devices
+    have a limited number of rules."""
+    names = [x["name"] for x in desired]
+    if len(set(names)) != len(names):
+        raise ValueError("Rule names must be unique")
+    stored = {}
+    changes = []
+    for rule in current:
+        if rule.get("name") in names and rule["name"] not in stored:
+            stored[rule["name"]] = rule
+        else:
+            changes.append(RuleChange(DELETE, rule))
+    for rule in desired:
+        old = stored.get(rule["name"])
+        if old is None:
+            changes.append(RuleChange(ADD, rule))
+        elif not _same(rule, old):
+            changes.append(RuleChange(EDIT, dict(rule, id=old["id"])))
+    return changes
+
+
+class RuleSync(object):
+    """Make the rules stored on devices match the desired ones.
+
+    The desired rules of a device are a dictionary module -> list of rules,
+    modules being "schedule", "count_down" and "anti_theft". Modules left out
+    are not touched. For each device, all rules are read over one connection
+    and all the changes are written over another. Devices are synced
+    concurrently, at most "concurrency" at a time.
+    """
+
+    def __init__(self, concurrency=DFLTCONCURRENCY, timeout=SYNCTIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def read(self, device, modules):
+        """Return module -> stored rules"""
+        cmds = [commands.RULE_MODULES[x].get(None, device.is_light) for x in modules]
+        replies = await device._send_cmds(cmds)
+        return {module: resu.get("rule_list", []) for module, resu in zip(modules, replies)}
+
+    def _commands(self, device, module, changes, current):
+        rcmds = commands.RULE_MODULES[module]
+        deletes = [x for x in changes if x.kind == DELETE]
+        cmds = []
+        if deletes and len(deletes) == len(current) and len(deletes) > 1:
+            #Everything goes, one command will do
+            cmds.append(rcmds.delete_all(None, device.is_light))
+        else:
+            for change in deletes:
+                cmd = rcmds.delete(None, device.is_light)
+                cmd.value = change.rule["id"]
+                cmds.append(cmd)
+        for change in changes:
+            if change.kind == DELETE:
+                continue
+            cmd = (rcmds.add if change.kind == ADD else rcmds.edit)(None, device.is_light)
+            cmd.value = change.rule
+            cmds.append(cmd)
+        return cmds
+
+    async def sync_device(self, device, desired):
+        """Sync one device, return a SyncResult"""
+        modules = list(desired)
+        stored = await self.read(device, modules)
+        cmds = []
+        counts = {ADD: 0, EDIT: 0, DELETE: 0}
+        unchanged = 0
+        for module in modules:
+            changes = diff_rules(desired[module], stored[module])
+            for change in changes:
+                counts[change.kind] += 1
+            unchanged += len(desired[module]) - len([x for x in changes if x.kind != DELETE])
+            cmds += self._commands(device, module, changes, stored[module])
+        if cmds:
+            await device._send_cmds(cmds)
+        return SyncResult(counts[ADD], counts[EDIT], counts[DELETE], unchanged)
+
+    async def sync(self, plan):
+        """plan maps devices to their desired rules. Return a dictionary
+        device -> SyncResult, or the exception if the device could not be synced."""
+        semaphore = aio.Semaphore(self.concurrency)
+
+        async def one(device, desired):
+            async with semaphore:
+                return await aio.wait_for(self.sync_device(device, desired), self.timeout)
+
+        devices = list(plan)
+        results = await aio.gather(*[one(x, plan[x]) for x in devices], return_exceptions=True)
+        for device, resu in zip(devices, results):
+            if isinstance(resu, Exception):
+                logging.debug("Could not sync the rules of {}: {}".format(device.name, resu))
+        return dict(zip(devices, results))
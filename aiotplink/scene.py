@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we apply a scene to many devices at the same time.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import logging
+from collections import namedtuple
+from . import commands
+from .devices import _abort
+
+CONNECTTIMEOUT = 2
+REPLYTIMEOUT = 2
+
+SceneResult = namedtuple("SceneResult", ["acked", "failed", "send_spread", "ack_spread", "latencies"])
+SceneResult.__doc__ = """Outcome of a scene.
+acked and failed are lists of devices, the spreads are the secs between the first and the last
+frame sent, and between the first and the last reply. latencies maps each acked device to the
+secs between the barrier and its reply."""
+
+
+class _Entry(object):
+
+    def __init__(self, device, cmd, pending, callb):
+        self.device = device
+        self.cmd = cmd
+        self.payload = cmd.command
+        self.pending = pending
+        self.callb = callb
+        self.future = None
+        self.transport = None
+        self.protocol = None
+        self.acked = None
+
+
+class Scene(object):
+    """Change many devices at once, with as little visible skew as possible.
+
+    Every command is encoded ahead of time. apply() then takes each device
+    lock, opens all the connections, and only when they are all ready, writes
+    every frame in one go.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, device, cmd, pending=None, callb=None):
+        """Add a command. pending are the values the device will have once it
+        succeeded, callb the device method that records them."""
+        self.entries.append(_Entry(device, cmd, pending or {}, callb))
+        return self
+
+    def set_state(self, device, val):
+        return self.add(device, commands.get_template(device.onCmd)(val), {"state": val}, device._set_state)
+
+    def set_brightness(self, light, val):
+        return self.add(light, light.light_state_cmd({"brightness": val}),
+                        {"brightness": val}, light._set_brightness)
+
+    def set_temperature(self, light, val):
+        return self.add(light, light.light_state_cmd({"temperature": val}),
+                        {"temperature": val}, light._set_temperature)
+
+    def set_colour(self, light, hue, saturation, value):
+        return self.add(light, light.light_state_cmd({"hue": hue, "saturation": saturation, "value": value}),
+                        {"hue": hue, "saturation": saturation, "brightness": value}, light._set_colour)
+
+    async def _connect(self, entry):
+        loop = aio.get_event_loop()
+        entry.future = loop.create_future()
+        #Connections are paced like any other, but the scene holds them all
+        #open at once, so they are not counted against the concurrency caps.
+        await entry.device.shaper.token(entry.device.addr)
+        entry.transport, entry.protocol = await aio.wait_for(
+            entry.device._open(entry.cmd, entry.future, autosend=False), CONNECTTIMEOUT)
+
+    async def apply(self):
+        """Apply the scene and return a SceneResult"""
+        loop = aio.get_event_loop()
+        #Same lock order for everybody, so two scenes cannot deadlock
+        entries = sorted(self.entries, key=lambda x: (x.device.addr, x.device.port, id(x)))
+        locked = []
+        try:
+            for entry in entries:
+                if entry.device._exclusive not in locked:
+                    await entry.device._exclusive.acquire()
+                    locked.append(entry.device._exclusive)
+            ready = []
+            failed = []
+            results = await aio.gather(*[self._connect(x) for x in entries], return_exceptions=True)
+            for entry, res in zip(entries, results):
+                if isinstance(res, BaseException):
+                    logging.debug("Scene could not connect to {}: {}".format(entry.device.name, res))
+                    failed.append(entry)
+                else:
+                    ready.append(entry)
+
+            #The barrier: everything is ready, send all frames back to back.
+            for entry in ready:
+                entry.device._pending_value.update(entry.pending)
+                entry.future.add_done_callback(lambda f, e=entry: setattr(e, "acked", loop.time()))
+            start = loop.time()
+            for entry in ready:
+                entry.protocol.send(entry.payload)
+            send_spread = loop.time() - start
+
+            if ready:
+                await aio.wait([x.future for x in ready], timeout=REPLYTIMEOUT)
+            acked = []
+            for entry in ready:
+                if entry.future.done() and not entry.future.cancelled() and not entry.future.exception():
+                    acked.append(entry)
+                    if entry.callb:
+                        try:
+                            entry.callb(entry.future.result())
+                        except Exception as e:
+                            logging.debug("Scene callback failed for {}: {}".format(entry.device.name, e))
+                else:
+                    if not entry.future.done():
+                        entry.future.cancel()
+                    failed.append(entry)
+                    for key in entry.pending:
+                        entry.device._pending_value.pop(key, None)
+        finally:
+            #Whatever happened, e.g. a failed send or apply() cancelled, close the connections
+            for entry in entries:
+                if entry.transport:
+                    _abort(entry.transport, entry.future)
+            for lock in locked:
+                lock.release()
+
+        if acked:
+            times = [x.acked for x in acked]
+            ack_spread = max(times) - min(times)
+        else:
+            ack_spread = None
+        return SceneResult([x.device for x in acked], [x.device for x in failed], send_spread,
+                           ack_spread, {x.device: x.acked - start for x in acked})
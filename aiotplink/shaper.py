@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we limit the traffic sent to each subnet or access point.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import ipaddress
+from .polling import PollBudget
+
+DFLTPREFIX = 24 # Devices in the same /24 share limits, unless tagged
+BROADCAST = "broadcast" # The group of broadcast datagrams
+
+
+class _Group(object):
+    """The limits of one group: a token bucket for new connections and
+    datagrams, and a cap on open connections."""
+
+    def __init__(self, rate, burst, concurrency):
+        self.budget = PollBudget(rate, burst) if rate else None
+        self.slots = aio.Semaphore(concurrency) if concurrency else None
+        self.active = 0
+
+    async def acquire(self):
+        if self.slots:
+            await self.slots.acquire()
+        self.active += 1
+        if self.budget:
+            try:
+                await self.budget.acquire()
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self):
+        self.active -= 1
+        if self.slots:
+            self.slots.release()
+
+
+class _Slot(object):
+
+    def __init__(self, group):
+        self.group = group
+
+    async def __aenter__(self):
+        await self.group.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.group.release()
+
+
+class TrafficShaper(object):
+    """Limit what we send to each group of devices.
+
+    A group is a user given tag, e.g. the access point a device is behind,
+    or else the subnet of the device (a /prefix). Each group has a token
+    bucket, rate new connections or datagrams per sec with bursts of burst,
+    and a cap, concurrency, on the connections open at the same time. None
+    means no limit. Limits are the defaults given here, unless set_limits
+    was called for the group.
+
+    Devices use slot() around each connection, discovery uses try_send()
+    before each datagram.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, prefix=DFLTPREFIX):
+        self.defaults = (rate, burst, concurrency)
+        self.prefix = prefix
+        self.tags = {} # ip -> tag
+        self.limits = {} # group -> (rate, burst, concurrency)
+        self.groups = {}
+        self.by_ip = {} # ip -> its _Group, so the tag or subnet is not worked out on each connection
+
+    def set_defaults(self, rate=None, burst=None, concurrency=None):
+        """Change the limits of the groups without their own. Existing groups keep theirs."""
+        self.defaults = (rate, burst, concurrency)
+        self.groups = {k: v for k, v in self.groups.items() if k in self.limits}
+        self.by_ip = {}
+
+    def set_limits(self, group, rate=None, burst=None, concurrency=None):
+        """Set the limits of a group, a tag, a subnet like "192.168.1.0/24" or BROADCAST"""
+        self.limits[group] = (rate, burst, concurrency)
+        self.groups.pop(group, None)
+        self.by_ip = {}
+
+    def tag(self, ip, tag):
+        """Put the device at ip in the tag group, None to go back to its subnet"""
+        if tag is None:
+            self.tags.pop(ip, None)
+        else:
+            self.tags[ip] = tag
+        self.by_ip.pop(ip, None)
+
+    def group_of(self, ip):
+        if ip in self.tags:
+            return self.tags[ip]
+        if ip in [BROADCAST, "255.255.255.255", "<broadcast>"]:
+            return BROADCAST
+        try:
+            return str(ipaddress.ip_network("{}/{}".format(ip, self.prefix), strict=False))
+        except ValueError:
+            return ip
+
+    def _group(self, ip):
+        group = self.by_ip.get(ip)
+        if group is None:
+            name = self.group_of(ip)
+            if name not in self.groups:
+                self.groups[name] = _Group(*self.limits.get(name, self.defaults))
+            group = self.by_ip[ip] = self.groups[name]
+        return group
+
+    def slot(self, ip):
+        """An async context manager, held while a connection to ip is open"""
+        return _Slot(self._group(ip))
+
+    async def token(self, ip):
+        """Wait for the right to open a connection or send a datagram to ip,
+        without counting against the concurrency cap"""
+        group = self._group(ip)
+        if group.budget:
+            await group.budget.acquire()
+
+    def try_send(self, ip):
+        """May a datagram be sent to ip now? If so, it is counted."""
+        group = self._group(ip)
+        return group.budget is None or group.budget.try_acquire()
+
+# The shaper devices and discovery use, unless told otherwise. No limits until configured.
+TRAFFIC_SHAPER = TrafficShaper()
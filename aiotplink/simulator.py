@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we simulate TP-Link devices, to try the library without a house full of plugs.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, logging, random, time, uuid
+from struct import unpack
+
+from .commands import TPLCodec
+from .devices import TPLINK_PLUGS, TPLINK_BULBS
+
+LIGHTSERVICE = "smartlife.iot.smartbulb.lightingservice"
+LIGHTEMETER = "smartlife.iot.common.emeter"
+
+ERR_MODULE = {"err_code": -1, "err_msg": "module not support"}
+ERR_METHOD = {"err_code": -2, "err_msg": "member not support"}
+ERR_CHILD = {"err_code": -14, "err_msg": "entry not exist"}
+ERR_ARG = {"err_code": -3, "err_msg": "invalid argument"}
+ERR_FULL = {"err_code": -10, "err_msg": "table is full"}
+ERR_RULE = {"err_code": -14, "err_msg": "entry not exist"}
+
+RULE_MODULES = {"schedule": 32, "count_down": 1, "anti_theft": 1} # module -> max number of rules
+
+
+def _random_mac():
+    return ":".join(["50"] + ["{:02X}".format(random.randint(0, 255)) for x in range(5)])
+
+
+class _Meter(object):
+    """A load drawing a steady power while on"""
+
+    def __init__(self, power):
+        self.power = power
+        self.total = 0.0 # Wh
+        self.stamp = time.time()
+
+    def reading(self, on, milli):
+        now = time.time()
+        power = self.power if on else 0
+        self.total += power * (now - self.stamp) / 3600
+        self.stamp = now
+        voltage = 230.0
+        current = power / voltage
+        if milli:
+            return {"current_ma": int(current * 1000), "voltage_mv": int(voltage * 1000),
+                    "power_mw": int(power * 1000), "total_wh": int(self.total), "err_code": 0}
+        return {"current": round(current, 3), "voltage": voltage, "power": power,
+                "total": round(self.total / 1000, 3), "err_code": 0}
+
+
+class SimulatedDevice(object):
+    """A fake TP-Link plug, strip or bulb, speaking the TCP protocol.
+
+    Like the real devices, it answers any number of requests on a connection,
+    in order, so pipelined requests work. Strips answer the
+    {"context": {"child_ids": [...]}} envelope the way an HS300 does.
+    "requests" counts the requests answered, "connections" the connections.
+    fail_rate and hang_rate make some requests fail, for tests.
+    """
+
+    def __init__(self, model="HS110", mac=None, name=None, power=None):
+        self.model = model
+        self.mac = mac or _random_mac()
+        self.name = name or "Simulated {}".format(model)
+        self.device_id = self.mac.replace(":", "") * 3 + "0000"
+        plug = TPLINK_PLUGS.get(model[:5].upper())
+        self.is_light = plug is None
+        self.caps = plug or TPLINK_BULBS[model[:5].upper()]
+        self.state = 1
+        self.led_off = 0
+        self.light_state = {"on_off": 1, "mode": "normal", "hue": 0, "saturation": 0,
+                            "color_temp": 2700, "brightness": 100}
+        power = power if power is not None else random.uniform(5, 60)
+        self.meter = _Meter(power)
+        self.children = []
+        for idx in range(self.caps.get("outlets", 0)):
+            self.children.append({"id": "{}{:02d}".format(self.device_id, idx),
+                                  "alias": "Outlet {}".format(idx + 1), "state": 1,
+                                  "on_time": 0, "meter": _Meter(power)})
+        self.server = None
+        self.addr = None
+        self.requests = 0
+        self.connections = 0
+        self.delay = 0 # Secs to wait before answering
+        self.fail_rate = 0 # Chance a request gets the connection closed instead of an answer
+        self.hang_rate = 0 # Chance a request is never answered, the client has to give up
+        self.rules = {x: {"rule_list": [], "enable": 1, "version": 2} for x in RULE_MODULES}
+        self.sw_ver = "1.0.0 Build 180101 Rel.000000"
+        self.new_sw_ver = "1.0.1 Build 190101 Rel.000000" # What flashing installs
+        self.download_time = 2 # secs
+        self.reboot_time = 1
+        self.fail_download = False
+        self._download = None # (url, start time)
+        self._rebooting_until = 0
+
+    def sysinfo(self):
+        info = {"err_code": 0, "sw_ver": self.sw_ver, "hw_ver": "1.0",
+                "model": self.model, "deviceId": self.device_id, "alias": self.name,
+                "rssi": -50, "latitude": 0, "longitude": 0}
+        if self.is_light:
+            info["mic_mac"] = self.mac.replace(":", "")
+            info["mic_type"] = "IOT.SMARTBULB"
+            info["light_state"] = dict(self.light_state)
+        else:
+            info["mac"] = self.mac
+            info["type"] = "IOT.SMARTPLUGSWITCH"
+            info["led_off"] = self.led_off
+            if self.children:
+                info["child_num"] = len(self.children)
+                info["children"] = [{k: v for k, v in x.items() if k != "meter"} for x in self.children]
+            else:
+                info["relay_state"] = self.state
+        return info
+
+    def _children(self, context):
+        """The children addressed by a context, or None if one is unknown"""
+        resu = []
+        for cid in context or []:
+            match = [x for x in self.children if x["id"] == cid or x["id"][-2:] == cid]
+            if not match:
+                return None
+            resu += match
+        return resu
+
+    def _get_sysinfo(self, arg, children):
+        return self.sysinfo()
+
+    def _set_relay_state(self, arg, children):
+        if not isinstance(arg, dict) or arg.get("state") not in [0, 1]:
+            return ERR_ARG
+        if children:
+            for child in children:
+                child["state"] = arg["state"]
+        elif self.children:
+            for child in self.children:
+                child["state"] = arg["state"]
+        else:
+            self.state = arg["state"]
+        return {"err_code": 0}
+
+    def _set_led_off(self, arg, children):
+        self.led_off = arg.get("off", 0)
+        return {"err_code": 0}
+
+    def _set_dev_alias(self, arg, children):
+        if children:
+            for child in children:
+                child["alias"] = arg.get("alias")
+        else:
+            self.name = arg.get("alias")
+        return {"err_code": 0}
+
+    def _get_realtime(self, arg, children):
+        if self.children:
+            if not children or len(children) != 1:
+                return ERR_ARG
+            return children[0]["meter"].reading(children[0]["state"], True)
+        if not self.caps.get("emeter", self.is_light):
+            return ERR_METHOD
+        if self.is_light:
+            return self.meter.reading(self.light_state["on_off"], True)
+        return self.meter.reading(self.state, False)
+
+    def _get_light_state(self, arg, children):
+        return dict(self.light_state, err_code=0)
+
+    def _transition_light_state(self, arg, children):
+        for key in ["on_off", "hue", "saturation", "color_temp", "brightness"]:
+            if key in arg:
+                self.light_state[key] = arg[key]
+        return dict(self.light_state, err_code=0)
+
+    def _download_firmware(self, arg, children):
+        if not isinstance(arg, dict) or not arg.get("url"):
+            return ERR_ARG
+        self._download = (arg["url"], time.time())
+        return {"err_code": 0}
+
+    def _get_download_state(self, arg, children):
+        if self._download is None:
+            return {"status": 0, "ratio": 0, "reboot_time": self.reboot_time, "flash_time": 0, "err_code": 0}
+        if self.fail_download:
+            return {"status": -1, "ratio": 0, "reboot_time": self.reboot_time, "flash_time": 0, "err_code": 0}
+        elapsed = time.time() - self._download[1]
+        ratio = min(100, int(100 * elapsed / self.download_time)) if self.download_time else 100
+        return {"status": (ratio < 100 and 1) or 2, "ratio": ratio, "reboot_time": self.reboot_time,
+                "flash_time": 0, "err_code": 0}
+
+    def _flash_firmware(self, arg, children):
+        state = self._get_download_state(arg, children)
+        if state["ratio"] < 100:
+            return {"err_code": -7, "err_msg": "no firmware downloaded"}
+        self._download = None
+        self.sw_ver = self.new_sw_ver
+        self._rebooting_until = time.time() + self.reboot_time
+        return {"err_code": 0}
+
+    def _rules(self, module, method, arg):
+        rules = self.rules[module]
+        if method == "get_rules":
+            return {"rule_list": [dict(x) for x in rules["rule_list"]], "enable": rules["enable"],
+                    "version": rules["version"], "err_code": 0}
+        if method == "add_rule":
+            if not isinstance(arg, dict) or "id" in arg:
+                return ERR_ARG
+            if len(rules["rule_list"]) >= RULE_MODULES[module]:
+                return ERR_FULL
+            rule = dict(arg, id=uuid.uuid4().hex.upper())
+            rules["rule_list"].append(rule)
+            return {"id": rule["id"], "err_code": 0}
+        if method == "delete_all_rules":
+            rules["rule_list"] = []
+            return {"err_code": 0}
+        if method == "set_overall_enable":
+            rules["enable"] = arg.get("enable", 1)
+            return {"err_code": 0}
+        for idx, rule in enumerate(rules["rule_list"]):
+            if isinstance(arg, dict) and rule["id"] == arg.get("id"):
+                if method == "edit_rule":
+                    rules["rule_list"][idx] = dict(arg)
+                else:
+                    del(rules["rule_list"][idx])
+                return {"err_code": 0}
+        return ERR_RULE
+
+    def _rule_handler(module, method):
+        return lambda self, arg, children: self._rules(module, method, arg)
+
+    HANDLERS = {("system", "get_sysinfo"): _get_sysinfo,
+                ("system", "set_relay_state"): _set_relay_state,
+                ("system", "set_led_off"): _set_led_off,
+                ("system", "set_dev_alias"): _set_dev_alias,
+                ("system", "download_firmware"): _download_firmware,
+                ("system", "get_download_state"): _get_download_state,
+                ("system", "flash_firmware"): _flash_firmware,
+                ("emeter", "get_realtime"): _get_realtime,
+                (LIGHTEMETER, "get_realtime"): _get_realtime,
+                (LIGHTSERVICE, "get_light_state"): _get_light_state,
+                (LIGHTSERVICE, "transition_light_state"): _transition_light_state}
+    for module in RULE_MODULES:
+        for method in ["get_rules", "add_rule", "edit_rule", "delete_rule", "delete_all_rules", "set_overall_enable"]:
+            HANDLERS[(module, method)] = _rule_handler(module, method)
+            HANDLERS[("smartlife.iot.common." + module, method)] = _rule_handler(module, method)
+    del(module, method)
+
+    def handle(self, request):
+        """Answer one decoded request"""
+        self.requests += 1
+        children = None
+        if "context" in request:
+            children = self._children(request["context"].get("child_ids"))
+            if children is None or not self.children:
+                return {k: ERR_CHILD for k in request if k != "context"}
+        reply = {}
+        for module, methods in request.items():
+            if module == "context":
+                continue
+            if not isinstance(methods, dict) or not any(x[0] == module for x in self.HANDLERS):
+                reply[module] = ERR_MODULE
+                continue
+            reply[module] = {}
+            for method, arg in methods.items():
+                handler = self.HANDLERS.get((module, method))
+                if handler is None:
+                    reply[module][method] = ERR_METHOD
+                else:
+                    reply[module][method] = handler(self, arg, children)
+        return reply
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        if time.time() < self._rebooting_until:
+            writer.close()
+            return
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                data = await reader.readexactly(unpack('>I', header)[0])
+                if self.fail_rate and random.random() < self.fail_rate:
+                    break
+                if self.hang_rate and random.random() < self.hang_rate:
+                    await reader.read()
+                    break
+                reply = self.handle(json.loads(TPLCodec.decrypt(data)))
+                if self.delay:
+                    await aio.sleep(self.delay)
+                writer.write(TPLCodec.encrypt(json.dumps(reply)))
+                await writer.drain()
+        except (aio.IncompleteReadError, ConnectionError, aio.CancelledError):
+            pass
+        except Exception as e:
+            logging.debug("Simulated {} could not answer: {}".format(self.name, e))
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start listening, return the (host, port) address to reach the device"""
+        self.server = await aio.start_server(self._serve, host, port)
+        self.addr = self.server.sockets[0].getsockname()[:2]
+        return self.addr
+
+    def info(self):
+        """What discovery would report, for GetDevice"""
+        return {"mac": self.mac, "model": self.model, "name": self.name}
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we run many simulated devices for a long time, looking for leaks.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import argparse, gc, logging, os, random, sys, time, tracemalloc
+from collections import namedtuple
+from .devices import GetDevice
+from .simulator import SimulatedDevice
+
+DFLTDEVICES = 1000
+DFLTDURATION = 600 # secs
+DFLTWARMUP = 30 # secs before the baseline is taken
+DFLTSAMPLE = 10 # secs between samples
+DFLTHB = 5
+CHURN = 0.01 # Part of the devices replaced each sec
+FLAP = 0.01 # Part of the devices going offline for a while each sec
+FLAPTIME = (2, 20) # secs a flapping device stays away
+COMMANDS = 0.05 # Commands per device per sec
+FAILRATE = 0.05 # Requests a simulated device drops
+HANGRATE = 0.02 # Requests a simulated device never answers
+MODELS = ["HS100", "HS110", "HS300", "LB130", "KL110"]
+TOPALLOC = 10
+
+Sample = namedtuple("Sample", ["time", "devices", "rss", "tasks", "sockets", "traced"])
+SoakReport = namedtuple("SoakReport", ["passed", "failures", "baseline", "final", "samples", "top"])
+
+
+def rss():
+    """Resident memory of this process, in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Peak, not current
+
+def open_sockets():
+    """Open sockets of this process, None where /proc is not available"""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink("/proc/self/fd/" + fd).startswith("socket:"):
+                count += 1
+        except OSError:
+            pass # Closed meanwhile
+    return count
+
+def _average(samples, field):
+    vals = [getattr(x, field) for x in samples if getattr(x, field) is not None]
+    return (vals and sum(vals) / len(vals)) or 0
+
+
+class SoakBudget(object):
+    """How much may grow between the baseline and the end of a soak run:
+    rss and traced in MB, tasks and sockets as counts. None is no limit."""
+
+    def __init__(self, rss=64, tasks=None, sockets=None, traced=32):
+        self.rss = rss
+        self.tasks = tasks
+        self.sockets = sockets
+        self.traced = traced
+
+    def for_devices(self, count):
+        """Default task and socket limits, some slack for the commands in flight"""
+        if self.tasks is None:
+            self.tasks = count // 10 + 50
+        if self.sockets is None:
+            self.sockets = count // 10 + 50
+        return self
+
+
+class SoakHarness(object):
+    """Drive simulated devices through churn and watch for leaks.
+
+    About "devices" simulated devices are polled every hb secs. Each sec, some
+    are replaced by new ones (churn), some go away for a while (flap) and
+    random setters are called on others. The simulated devices drop, or never
+    answer, some requests. The memory (RSS and tracemalloc), the live asyncio
+    tasks and the open sockets are sampled every "sample" secs. After the run,
+    the average of the last samples is compared with the one of the first
+    samples after warmup, the run fails if the growth is beyond budget.
+    """
+
+    def __init__(self, devices=DFLTDEVICES, duration=DFLTDURATION, warmup=DFLTWARMUP, sample=DFLTSAMPLE,
+                 hb=DFLTHB, budget=None, churn=CHURN, flap=FLAP, commands=COMMANDS,
+                 fail_rate=FAILRATE, hang_rate=HANGRATE, seed=None):
+        self.count = devices
+        self.duration = duration
+        self.warmup = warmup
+        self.sample_interval = sample
+        self.hb = hb
+        self.budget = (budget or SoakBudget()).for_devices(devices)
+        self.churn = churn
+        self.flap = flap
+        self.commands = commands
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.random = random.Random(seed)
+        self.devices = {} # mac -> (SimulatedDevice, device)
+        self.away = {} # mac -> loop time it comes back
+        self.samples = []
+        self.stats = {"added": 0, "removed": 0, "flaps": 0, "commands": 0}
+
+    async def _add(self):
+        sim = SimulatedDevice(self.random.choice(MODELS))
+        sim.fail_rate = self.fail_rate
+        sim.hang_rate = self.hang_rate
+        addr = await sim.start()
+        dev = GetDevice(addr, sim.info(), hb=self.hb, on_change=None)
+        self.devices[sim.mac] = (sim, dev)
+        self.stats["added"] += 1
+
+    async def _remove(self, mac):
+        sim, dev = self.devices.pop(mac)
+        self.away.pop(mac, None)
+        dev.stop()
+        await sim.stop()
+        self.stats["removed"] += 1
+
+    async def _flap(self, mac, now):
+        sim, dev = self.devices[mac]
+        await sim.stop()
+        self.away[mac] = now + self.random.uniform(*FLAPTIME)
+        self.stats["flaps"] += 1
+
+    async def _come_back(self, now):
+        for mac, when in list(self.away.items()):
+            if when <= now:
+                del(self.away[mac])
+                sim, dev = self.devices[mac]
+                try:
+                    await sim.start(*sim.addr)
+                except OSError:
+                    #Someone took the port, it is gone for good
+                    await self._remove(mac)
+                    await self._add()
+
+    def _command(self):
+        sim, dev = self.devices[self.random.choice(list(self.devices))]
+        if getattr(dev, "outlets", None) and self.random.random() < 0.5:
+            target = self.random.choice(dev.outlets)
+        else:
+            target = dev
+        choice = self.random.random()
+        if choice < 0.4:
+            target.on()
+        elif choice < 0.8:
+            target.off()
+        elif hasattr(target, "set_brightness"):
+            target.set_brightness(self.random.randint(1, 100))
+        else:
+            target.set_name("soak {}".format(self.random.randint(0, 999)))
+        self.stats["commands"] += 1
+
+    def _rate(self, per_device):
+        """How many events this sec, for a per device per sec rate"""
+        expected = per_device * len(self.devices)
+        return int(expected) + (self.random.random() < expected - int(expected))
+
+    def take_sample(self, now):
+        gc.collect()
+        sample = Sample(now, len(self.devices), rss(), len(aio.all_tasks()), open_sockets(),
+                        tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None)
+        self.samples.append(sample)
+        logging.debug("Soak: {}".format(sample))
+        return sample
+
+    async def _tick(self, now):
+        await self._come_back(now)
+        present = [x for x in self.devices if x not in self.away]
+        for mac in self.random.sample(present, min(len(present), self._rate(self.churn))):
+            await self._remove(mac)
+        while len(self.devices) < self.count:
+            await self._add()
+        present = [x for x in self.devices if x not in self.away]
+        for mac in self.random.sample(present, min(len(present), self._rate(self.flap))):
+            await self._flap(mac, now)
+        for x in range(self._rate(self.commands)):
+            self._command()
+
+    async def run(self):
+        loop = aio.get_event_loop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        start = loop.time()
+        while len(self.devices) < self.count:
+            await self._add()
+        baseline_snapshot = None
+        next_sample = start + self.warmup
+        try:
+            while loop.time() - start < self.duration:
+                now = loop.time()
+                await self._tick(now)
+                if now >= next_sample:
+                    self.take_sample(now - start)
+                    if baseline_snapshot is None:
+                        baseline_snapshot = tracemalloc.take_snapshot()
+                    next_sample = now + self.sample_interval
+                await aio.sleep(max(0, 1 - (loop.time() - now)))
+            final_snapshot = tracemalloc.take_snapshot()
+        finally:
+            for mac in list(self.devices):
+                await self._remove(mac)
+            await aio.sleep(1) # Let the simulated devices see their clients go
+        top = []
+        if baseline_snapshot is not None:
+            top = final_snapshot.compare_to(baseline_snapshot, "lineno")[:TOPALLOC]
+        return self.report(top)
+
+    def report(self, top=()):
+        window = max(1, min(3, len(self.samples) // 3))
+        first, last = self.samples[:window], self.samples[-window:]
+        baseline = {x: _average(first, x) for x in Sample._fields}
+        final = {x: _average(last, x) for x in Sample._fields}
+        failures = []
+        limits = [("rss", self.budget.rss, 1024 * 1024), ("traced", self.budget.traced, 1024 * 1024),
+                  ("tasks", self.budget.tasks, 1), ("sockets", self.budget.sockets, 1)]
+        for field, limit, unit in limits:
+            if limit is None or not self.samples:
+                continue
+            growth = (final[field] - baseline[field]) / unit
+            if growth > limit:
+                failures.append("{} grew by {:.1f}, budget {}".format(field, growth, limit))
+        if len(self.samples) < 2:
+            failures.append("Not enough samples, run longer than warmup + 2 samples")
+        return SoakReport(not failures, failures, baseline, final, self.samples, list(top))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test aiotplink against simulated devices.")
+    parser.add_argument("-n", "--devices", type=int, default=DFLTDEVICES, help="Simulated devices (default: %(default)s)")
+    parser.add_argument("-t", "--duration", type=int, default=DFLTDURATION, help="Secs to run (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=DFLTWARMUP, help="Secs before the baseline (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=DFLTSAMPLE, help="Secs between samples (default: %(default)s)")
+    parser.add_argument("--hb", type=int, default=DFLTHB, help="Device heartbeat, in secs (default: %(default)s)")
+    parser.add_argument("--rss", type=float, default=64, help="RSS growth budget, in MB (default: %(default)s)")
+    parser.add_argument("--traced", type=float, default=32, help="tracemalloc growth budget, in MB (default: %(default)s)")
+    parser.add_argument("--tasks", type=int, default=None, help="Live task growth budget (default: devices/10 + 50)")
+    parser.add_argument("--sockets", type=int, default=None, help="Open socket growth budget (default: devices/10 + 50)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    parser.add_argument("-d", "--debug", action="store_true", default=False, help="Print debug messages")
+    opts = parser.parse_args()
+    if opts.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # Each simulated device listens on a socket
+    except (ImportError, ValueError, OSError):
+        pass
+
+    harness = SoakHarness(opts.devices, opts.duration, opts.warmup, opts.sample, opts.hb,
+                          SoakBudget(opts.rss, opts.tasks, opts.sockets, opts.traced), seed=opts.seed)
+    loop = aio.get_event_loop()
+    report = loop.run_until_complete(harness.run())
+    for sample in report.samples:
+        print("{:7.0f}s  devices {:5d}  rss {:8.1f} MB  tasks {:6d}  sockets {}  traced {:.1f} MB".format(
+            sample.time, sample.devices, sample.rss / 1048576, sample.tasks, sample.sockets,
+            (sample.traced or 0) / 1048576))
+    print("Churn: {}".format(harness.stats))
+    print("Top allocation growth:")
+    for stat in report.top:
+        print("    {}".format(stat))
+    if report.passed:
+        print("PASSED")
+    else:
+        for failure in report.failures:
+            print("FAILED: {}".format(failure))
+    #Simulated devices may still be waiting for the last clients
+    pending = [x for x in aio.all_tasks(loop) if not x.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(aio.gather(*pending, return_exceptions=True))
+    loop.close()
+    sys.exit((report.passed and 0) or 1)
+
+
+if __name__ == "__main__":
+    main()
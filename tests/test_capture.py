@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check that captured traffic replays as it was recorded.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import os, shutil, tempfile, unittest
+from aiotplink import commands
+from aiotplink.capture import CAPTURE, read_capture, ReplayServer, OPEN, DATA, CLOSE, OUT, IN
+from aiotplink.devices import GetDevice
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "traffic.cap")
+        self.sims = [SimulatedDevice("HS110"), SimulatedDevice("HS300")]
+
+    def tearDown(self):
+        CAPTURE.stop()
+        for sim in self.sims:
+            self.run_async(sim.stop())
+        self.run_async(aio.sleep(0))
+        shutil.rmtree(self.dir)
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _read_all(self, addrs, info_first=False):
+        devices = [GetDevice(addr, sim.info(), hb=0, on_change=None) for addr, sim in zip(addrs, self.sims)]
+        try:
+            while any(dev.last_heartbeat is None for dev in devices):
+                await aio.sleep(0.01) # The heartbeat finds the outlets of the strip
+            resu = []
+            for dev in devices:
+                #A single sysinfo request, before or after the pipelined one that starts the same
+                if info_first:
+                    info = await dev._send_cmd(commands.InfoCmd())
+                status = await dev._fetch_status()
+                if not info_first:
+                    info = await dev._send_cmd(commands.InfoCmd())
+                resu.append((dev.__class__.__name__, info.get("state"), status.get("state"), status.get("power"),
+                             sorted(status.get("emeters", {}).items())))
+            return resu
+        finally:
+            for dev in devices:
+                dev.stop()
+
+    async def _record(self):
+        self.addrs = [await x.start() for x in self.sims]
+        CAPTURE.start(self.path)
+        try:
+            return await self._read_all(self.addrs)
+        finally:
+            CAPTURE.stop()
+
+    def test_replay(self):
+        recorded = self.run_async(self._record())
+        #The HS300 status is a pipelined read, one sysinfo and one emeter frame per outlet
+        self.assertEqual(len(recorded[1][4]), 6)
+        records = list(read_capture(self.path))
+        self.assertEqual(set(x.kind for x in records), {OPEN, DATA, CLOSE})
+        self.assertEqual(set(x.direction for x in records if x.kind == DATA), {OUT, IN})
+
+        async def replay():
+            server = await ReplayServer(self.path, speed=0).start()
+            try:
+                resu = await self._read_all([server.addr_for(x) for x in self.addrs], True)
+                return resu, server.served
+            finally:
+                await server.stop()
+
+        for sim in self.sims:
+            self.run_async(sim.stop()) # Only the replay answers now
+        replayed, served = self.run_async(replay())
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(served, 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the command encodings against those of the original commands.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import json, unittest
+from aiotplink import commands
+from aiotplink.commands import TPLCodec
+from aiotplink.responses import LightState, RealtimeEmeter, SysInfo
+
+#What the original dictionary based commands sent, as JSON text
+BASELINE = [
+    (lambda: commands.InfoCmd(), '{"system": {"get_sysinfo": {}}}'),
+    (lambda: commands.SetCmd("on"), '{"system": {"set_relay_state": {"state": 1}}}'),
+    (lambda: commands.SetCmd(0), '{"system": {"set_relay_state": {"state": 0}}}'),
+    (lambda: commands.SetLedCmd("off"), '{"system": {"set_led_off": {"off": 1}}}'),
+    (lambda: commands.SetNameCmd("Kitchen"), '{"system": {"set_dev_alias": {"alias": "Kitchen"}}}'),
+    (lambda: commands.GetPowerCmd(), '{"emeter": {"get_realtime": {}}}'),
+    (lambda: commands.GetPowerCmd(True), '{"smartlife.iot.common.emeter": {"get_realtime": {}}}'),
+    (lambda: commands.InfoCmd() + commands.GetPowerCmd(),
+     '{"system": {"get_sysinfo": {}}, "emeter": {"get_realtime": {}}}'),
+    (lambda: commands.GetLigthStateCmd(),
+     '{"smartlife.iot.smartbulb.lightingservice": {"get_light_state": {}}}'),
+    (lambda: commands.RebootCmd(), '{"system": {"reboot": {"delay": 1}}}'),
+    (lambda: commands.ScanCmd(), '{"netif": {"get_scaninfo": {"refresh": 1}}}'),
+    (lambda: commands.GetTimeCmd(), '{"time": {"get_time": {}}}'),
+    (lambda: commands.FWDownloadStateCmd(), '{"system": {"get_download_state": {}}}'),
+]
+
+SYSINFO = {"err_code": 0, "sw_ver": "1.2.5 Build 171206 Rel.085954", "hw_ver": "1.0",
+           "type": "IOT.SMARTPLUGSWITCH", "model": "HS110(EU)", "mac": "50:C7:BF:01:02:03",
+           "deviceId": "8006", "alias": "Kitchen", "relay_state": 1, "on_time": 3600, "led_off": 0,
+           "feature": "TIM:ENE", "latitude": 50.1, "longitude": 4.2, "rssi": -60, "icon_hash": ""}
+REALTIME = {"current": 0.2, "voltage": 230.1, "power": 42.5, "total": 1.25, "err_code": 0}
+
+#What the original commands returned for those replies
+INFO_RESPONSE = {"err_code": 0, "software version": "1.2.5 Build 171206 Rel.085954",
+                 "hardware version": "1.0", "type": "IOT.SMARTPLUGSWITCH", "model": "HS110(EU)",
+                 "mac": "50:C7:BF:01:02:03", "deviceId": "8006", "name": "Kitchen", "state": "on",
+                 "on_time": 3600, "led": "on", "latitude": 50.1, "longitude": 4.2, "rssi": -60,
+                 "icon hash": ""}
+
+
+def reply(value):
+    return TPLCodec.encrypt(json.dumps(value))
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_baseline_bytes(self):
+        for build, text in BASELINE:
+            cmd = build()
+            self.assertEqual(cmd.command, TPLCodec.encrypt(text), text)
+
+    def test_info_keeps_err_code(self):
+        resu = commands.InfoCmd().response(reply({"system": {"get_sysinfo": SYSINFO}}))
+        self.assertEqual(resu, INFO_RESPONSE)
+
+    def test_merged_ignore(self):
+        #Keys ignored by one command are ignored in the whole reply
+        cmd = commands.InfoCmd() + commands.GetPowerCmd()
+        resu = cmd.response(reply({"system": {"get_sysinfo": SYSINFO}, "emeter": {"get_realtime": REALTIME}}))
+        expected = dict(INFO_RESPONSE, current=0.2, voltage=230.1, power=42.5, total=1.25)
+        del expected["err_code"]
+        self.assertEqual(resu, expected)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_same_bytes(self):
+        for cmdclass, values in [(commands.SetCmd, ["on", "off", 1, 0, True, False]),
+                                 (commands.SetLedCmd, ["on", "off"]),
+                                 (commands.SetNameCmd, ["Kitchen", "", "Salle à manger", 'A "quoted" name', "x" * 300]),
+                                 (commands.SetLightCmd, ["on", "off"])]:
+            template = commands.get_template(cmdclass)
+            for val in values:
+                self.assertEqual(template(val).command, cmdclass(val).command, (cmdclass, val))
+
+    def test_baseline_bytes(self):
+        self.assertEqual(commands.get_template(commands.SetCmd)("on").command,
+                         TPLCodec.encrypt('{"system": {"set_relay_state": {"state": 1}}}'))
+        self.assertEqual(commands.get_template(commands.SetNameCmd)("Kitchen").command,
+                         TPLCodec.encrypt('{"system": {"set_dev_alias": {"alias": "Kitchen"}}}'))
+
+    def test_key(self):
+        template = commands.get_template(commands.SetLightStateCmd, "brightness")
+        for val in [0, 50, 100]:
+            self.assertEqual(template(val).command, commands.SetLightStateCmd({"brightness": val}).command)
+
+    def test_validated(self):
+        with self.assertRaises(ValueError):
+            commands.get_template(commands.SetCmd)("maybe")
+
+    def test_shared(self):
+        self.assertIs(commands.get_template(commands.SetCmd), commands.get_template(commands.SetCmd))
+
+    def test_response(self):
+        bound = commands.get_template(commands.SetCmd)("on")
+        self.assertEqual(bound.response(reply({"system": {"set_relay_state": {"err_code": 0}}})), {"err_code": 0})
+        with self.assertRaises(commands.TPLException):
+            bound.response(reply({"system": {"set_relay_state": {"err_code": -3}}}))
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_records(self):
+        cmd = commands.InfoCmd() + commands.GetPowerCmd()
+        info, meter = cmd.records(reply({"system": {"get_sysinfo": SYSINFO}, "emeter": {"get_realtime": REALTIME}}))
+        self.assertIsInstance(info, SysInfo)
+        self.assertIsInstance(meter, RealtimeEmeter)
+        self.assertEqual((info.mac, info.name, info.state, info.led), ("50:C7:BF:01:02:03", "Kitchen", "on", "on"))
+        self.assertEqual(info.location, (50.1, 4.2))
+        self.assertEqual((meter.power, meter.total), (42.5, 1.25))
+        self.assertFalse(hasattr(info, "__dict__"))
+
+    def test_milli(self):
+        meter = RealtimeEmeter({"current_ma": 200, "voltage_mv": 230100, "power_mw": 42500, "total_wh": 1250})
+        self.assertEqual((meter.current, meter.voltage, meter.power, meter.total), (0.2, 230.1, 42.5, 1.25))
+
+    def test_light_off(self):
+        light = LightState({"on_off": 0, "dft_on_state": {"hue": 120, "saturation": 50, "brightness": 80, "color_temp": 0}})
+        self.assertEqual((light.state, light.hue, light.saturation, light.brightness), ("off", 120, 50, 80))
+        light = LightState({"on_off": 1, "hue": 10, "saturation": 20, "brightness": 30, "color_temp": 0})
+        self.assertEqual((light.state, light.hue, light.brightness), ("on", 10, 30))
+
+    def test_error(self):
+        with self.assertRaises(commands.TPLException):
+            commands.InfoCmd().records(reply({"system": {"get_sysinfo": {"err_code": -1, "err_msg": "module not support"}}}))
+        rec, = commands.InfoCmd().records(reply({"system": {"get_sysinfo": {"err_code": -1}}}), ignore=True)
+        self.assertEqual(rec.err_code, -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check where replies are decoded.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import json, threading, unittest
+from concurrent.futures import ThreadPoolExecutor
+from aiotplink import commands
+from aiotplink.devices import GetDevice
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class CountingExecutor(ThreadPoolExecutor):
+
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def payload(value):
+    return commands.TPLCodec.encrypt(json.dumps(value))[4:]
+
+
+class DecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.executor = CountingExecutor()
+        self.saved = commands.DECODE_POLICY
+
+    def tearDown(self):
+        commands.DECODE_POLICY = self.saved
+        self.executor.shutdown()
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def decode(self, policy, data):
+        fut = self.loop.create_future()
+        policy.decode(data, lambda resp: fut.set_result((resp, threading.current_thread())),
+                      fut.set_exception)
+        return await fut
+
+    def test_small_inline(self):
+        policy = commands.DecodePolicy(threshold=1000, executor=self.executor)
+        resp, thread = self.run_async(self.decode(policy, payload({"a": 1})))
+        self.assertEqual(resp, {"a": 1})
+        self.assertEqual(self.executor.submitted, 0)
+
+    def test_large_offloaded(self):
+        value = {"list": list(range(500))}
+        policy = commands.DecodePolicy(threshold=100, executor=self.executor)
+        resp, thread = self.run_async(self.decode(policy, payload(value)))
+        self.assertEqual(resp, value)
+        self.assertEqual(self.executor.submitted, 1)
+        #The handler is still called on the loop
+        self.assertIs(thread, threading.current_thread())
+
+    def test_errors(self):
+        for threshold in [None, 0]:
+            policy = commands.DecodePolicy(threshold=threshold, executor=self.executor)
+            with self.assertRaises(ValueError):
+                self.run_async(self.decode(policy, b"\x00not json"))
+
+    def test_device_offloaded(self):
+        #A whole device read with every reply above the threshold
+        commands.DECODE_POLICY = commands.DecodePolicy(threshold=0, executor=self.executor)
+
+        async def read():
+            sim = SimulatedDevice("HS110")
+            addr = await sim.start()
+            dev = GetDevice(addr, sim.info(), hb=60, on_change=None)
+            try:
+                return await dev._fetch_status()
+            finally:
+                dev.stop()
+                await sim.stop()
+
+        resu = self.run_async(read())
+        self.assertEqual(resu["state"], "on")
+        self.assertIsNotNone(resu["power"])
+        self.assertGreater(self.executor.submitted, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
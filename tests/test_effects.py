@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the light effects against the protocol simulator.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import unittest
+from aiotplink import effects
+from aiotplink.devices import GetDevice
+from aiotplink.effects import Effect, Fade, Candle
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class EffectTest(unittest.TestCase):
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Effect()
+
+    def test_fade(self):
+        fade = Fade({"hue": 350, "brightness": 0}, {"hue": 10, "brightness": 100}, 2)
+        self.assertEqual(fade.frame(0), {"hue": 350, "brightness": 0})
+        self.assertEqual(fade.frame(1), {"hue": 0, "brightness": 50}) #The short way round
+        self.assertEqual(fade.frame(5), {"hue": 10, "brightness": 100})
+
+    def test_candle_copy(self):
+        candle = Candle(seed=1)
+        first, second = candle.copy(), candle.copy()
+        frames = [[x.frame(t)["brightness"] for t in range(20)] for x in [first, second]]
+        self.assertNotEqual(frames[0], frames[1])
+        #Still reproducible with a seed
+        again = Candle(seed=1).copy()
+        self.assertEqual([again.frame(t)["brightness"] for t in range(20)], frames[0])
+
+
+class PlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.sims = []
+        self.lights = self.run_async(self._start(2))
+
+    def tearDown(self):
+        for light in self.lights:
+            light.stop()
+        for sim in self.sims:
+            self.run_async(sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self, count):
+        lights = []
+        for x in range(count):
+            sim = SimulatedDevice("LB130")
+            self.sims.append(sim)
+            addr = await sim.start()
+            lights.append(GetDevice(addr, sim.info(), hb=60, on_change=None))
+        return lights
+
+    def test_one_effect_per_light(self):
+        candle = Candle(seed=1, duration=0.3)
+        runners = effects.play(candle, self.lights, max_rate=20)
+        self.assertEqual(len(set(id(x.effect) for x in runners)), 2)
+        self.assertNotIn(candle, [x.effect for x in runners])
+        self.run_async(aio.gather(*[x.task for x in runners]))
+        for runner in runners:
+            self.assertGreater(runner.sent, 1)
+
+    def test_fade_ends(self):
+        fade = Fade({"brightness": 10}, {"brightness": 90}, 0.3)
+        runners = effects.play(fade, self.lights, max_rate=20)
+        self.run_async(aio.gather(*[x.task for x in runners]))
+        for sim, light in zip(self.sims, self.lights):
+            self.assertEqual(sim.light_state["brightness"], 90)
+            self.assertEqual(light.colour["brightness"], 90)
+            self.assertEqual(light.state, "on")
+
+
+if __name__ == "__main__":
+    unittest.main()
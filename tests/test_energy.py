@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the energy sums and rollups.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import random, time, unittest
+from aiotplink import energy
+from aiotplink.energy import EnergyAggregator, meter_key, rollup
+from aiotplink.events import ChangeEvent
+
+DAY = 86400
+#Noon, local time, so a few hours either way stay on the same day
+NOON = time.mktime((2026, 3, 10, 12, 0, 0, 0, 0, -1))
+
+
+class AggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agg = EnergyAggregator()
+        self.agg.assign("a", "building", "tenant1")
+        self.agg.assign("b", "building", "tenant2")
+        self.agg.assign(("c", 0), "building", "tenant2")
+        self.agg.assign(("c", 1), "building")
+
+    def test_power(self):
+        self.agg.update("a", power=10, timestamp=NOON)
+        self.agg.update("b", power=20, timestamp=NOON)
+        self.agg.update(("c", 0), power=5, timestamp=NOON)
+        self.agg.update("a", power=15, timestamp=NOON)
+        self.assertEqual(self.agg.power("building"), 40)
+        self.assertEqual(self.agg.power("tenant1"), 15)
+        self.assertEqual(self.agg.power("tenant2"), 25)
+        self.assertEqual(self.agg.online("tenant2"), 2)
+
+    def test_offline(self):
+        self.agg.update("a", power=10, total=1.0, timestamp=NOON)
+        self.agg.update("b", power=20, timestamp=NOON)
+        self.agg.offline("a")
+        self.agg.offline("a")
+        self.assertEqual(self.agg.power("building"), 20)
+        #Back online with only a total, the last power counts again
+        self.agg.update("a", total=1.5, timestamp=NOON)
+        self.assertEqual(self.agg.power("building"), 30)
+        self.assertEqual(self.agg.power("tenant1"), 10)
+        self.assertEqual(self.agg.energy("tenant1"), 0.5)
+
+    def test_energy(self):
+        self.agg.update("a", total=1.0, timestamp=NOON)
+        self.agg.update("a", total=1.25, timestamp=NOON + 60)
+        self.agg.update("b", total=3.0, timestamp=NOON)
+        self.agg.update("b", total=0.5, timestamp=NOON + 60) #Reset
+        self.assertEqual(self.agg.energy("tenant1"), 0.25)
+        self.assertEqual(self.agg.energy("tenant2"), 0.5)
+        self.assertEqual(self.agg.energy("building"), 0.75)
+
+    def test_rollover(self):
+        self.agg.update("a", total=1.0, timestamp=NOON)
+        self.agg.update("a", total=2.0, timestamp=NOON + 60)
+        self.agg.update("a", total=2.5, timestamp=NOON + DAY)
+        self.assertEqual(len(self.agg.history), 1)
+        self.assertEqual(self.agg.history[0][1]["tenant1"], 1.0)
+        self.assertEqual(self.agg.energy("tenant1"), 0.5)
+
+    def test_recompute(self):
+        rnd = random.Random(1)
+        keys = ["a", "b", ("c", 0), ("c", 1)]
+        for x in range(1000):
+            key = rnd.choice(keys)
+            if rnd.random() < 0.1:
+                self.agg.offline(key)
+            else:
+                self.agg.update(key, power=rnd.uniform(0, 100), timestamp=NOON)
+        power = {x: self.agg.power(x) for x in ["building", "tenant1", "tenant2"]}
+        self.agg.recompute()
+        for group, val in power.items():
+            self.assertAlmostEqual(self.agg.power(group), val)
+
+    def test_unassign(self):
+        self.agg.update("a", power=10, timestamp=NOON)
+        self.agg.unassign("a")
+        self.assertEqual(self.agg.power("building"), 0)
+        self.agg.update("a", power=10, timestamp=NOON) #Unknown now, ignored
+        self.assertEqual(self.agg.power("building"), 0)
+
+    def test_feed(self):
+        def event(mac, **changes):
+            return ChangeEvent(mac, mac, "TPStrip", changes, NOON)
+
+        self.agg.feed(event("c", outlet=0, power=5, total=1.0))
+        self.agg.feed(event("c", outlet=1, power_mw=7000, total_wh=2000))
+        self.agg.feed(event("a", power=10))
+        self.assertEqual(self.agg.power("building"), 22)
+        self.agg.feed(event("c", outlet=1, online=False))
+        self.assertEqual(self.agg.power("building"), 15)
+        self.agg.feed(event("c", online=False)) #The whole strip
+        self.assertEqual(self.agg.power("building"), 10)
+        self.assertEqual(self.agg.power("tenant2"), 0)
+
+
+READINGS = [(0, "a", 1.0), (1800, "a", 1.5), (3600, "a", 2.0), (5400, "a", 0.25),
+            (100, "b", 5.0), (4000, "b", 6.0), (200, ("c", 0), 1.0)]
+MEMBERSHIP = {"a": ["building", "tenant1"], "b": ["building"], ("c", 0): ["building"]}
+EXPECTED = {"building": {0: 0.5, 3600: 1.75}, "tenant1": {0: 0.5, 3600: 0.75}}
+
+
+class RollupTest(unittest.TestCase):
+
+    def test_python(self):
+        self.assertEqual(energy._rollup_python(*zip(*READINGS), 3600, MEMBERSHIP), EXPECTED)
+
+    @unittest.skipIf(energy.np is None, "numpy is not installed")
+    def test_numpy(self):
+        self.assertEqual(energy._rollup_numpy(*zip(*READINGS), 3600, MEMBERSHIP), EXPECTED)
+
+    @unittest.skipIf(energy.np is None, "numpy is not installed")
+    def test_same_results(self):
+        rnd = random.Random(1)
+        keys = ["a", "b", ("c", 0), ("c", 1), "d"]
+        totals = {k: 0.0 for k in keys}
+        readings = []
+        for x in range(2000):
+            key = rnd.choice(keys)
+            totals[key] = 0.0 if rnd.random() < 0.01 else totals[key] + rnd.uniform(0, 0.1)
+            readings.append((rnd.uniform(0, 5 * DAY), key, totals[key]))
+        membership = dict(MEMBERSHIP, d=["tenant1", "tenant2"])
+        args = list(zip(*readings)) + [900, membership]
+        py, vec = energy._rollup_python(*args), energy._rollup_numpy(*args)
+        self.assertEqual(set(py), set(vec))
+        for group in py:
+            self.assertEqual(set(py[group]), set(vec[group]))
+            for bucket in py[group]:
+                self.assertAlmostEqual(py[group][bucket], vec[group][bucket])
+
+    def test_empty(self):
+        self.assertEqual(rollup([], MEMBERSHIP), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
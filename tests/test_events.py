@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the event bus queues and their overflow policies.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import unittest
+from aiotplink.events import EventBus, DROP_OLDEST, COALESCE
+
+TIMEOUT = 5
+
+
+class FakeDevice(object):
+
+    def __init__(self, mac, name=None):
+        self.mac = mac
+        self.name = name or mac
+
+
+class FakePlug(FakeDevice):
+    pass
+
+
+class EventBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.bus = EventBus()
+        self.devs = [FakeDevice("AA:00:00:00:00:0{}".format(x)) for x in range(3)]
+
+    def tearDown(self):
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def drain(self, sub):
+        resu = []
+        while sub.queue:
+            resu.append(await sub.get())
+        return resu
+
+    def test_drop_oldest(self):
+        sub = self.bus.subscribe(maxsize=3, overflow=DROP_OLDEST)
+        for x in range(5):
+            self.bus.publish(self.devs[0], {"power": x})
+        events = self.run_async(self.drain(sub))
+        self.assertEqual([x.changes["power"] for x in events], [2, 3, 4])
+        self.assertEqual(sub.dropped, 2)
+
+    def test_coalesce(self):
+        sub = self.bus.subscribe(maxsize=2, overflow=COALESCE)
+        self.bus.publish(self.devs[0], {"state": "on"})
+        self.bus.publish(self.devs[1], {"power": 1})
+        self.bus.publish(self.devs[0], {"power": 5})
+        self.assertEqual(len(sub.queue), 2)
+        self.assertEqual(sub.dropped, 1)
+        #A third device does not fit, the oldest queued one is lost
+        self.bus.publish(self.devs[2], {"power": 2})
+        events = self.run_async(self.drain(sub))
+        self.assertEqual([(x.mac, x.changes) for x in events],
+                         [("aa:00:00:00:00:01", {"power": 1}), ("aa:00:00:00:00:02", {"power": 2})])
+        self.assertEqual(sub.dropped, 2)
+
+    def test_coalesce_merges(self):
+        sub = self.bus.subscribe(overflow=COALESCE)
+        self.bus.publish(self.devs[0], {"state": "on", "power": 1})
+        self.bus.publish(self.devs[0], {"power": 5})
+        events = self.run_async(self.drain(sub))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].changes, {"state": "on", "power": 5})
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            self.bus.subscribe(overflow="drop_newest")
+
+    def test_filters(self):
+        plug = FakePlug("BB:00:00:00:00:01")
+        bymac = self.bus.subscribe(macs=["AA:00:00:00:00:01"])
+        byfield = self.bus.subscribe(fields=["state"])
+        bytype = self.bus.subscribe(types=[FakeDevice])
+        byname = self.bus.subscribe(types=["FakePlug"])
+        self.bus.publish(self.devs[1], {"state": "on", "power": 1})
+        self.bus.publish(self.devs[2], {"power": 2})
+        self.bus.publish(plug, {"power": 3})
+        self.assertEqual([x.mac for x in self.run_async(self.drain(bymac))], ["aa:00:00:00:00:01"])
+        self.assertEqual([x.changes for x in self.run_async(self.drain(byfield))], [{"state": "on"}])
+        self.assertEqual(len(self.run_async(self.drain(bytype))), 3) #Subclasses match
+        self.assertEqual([x.mac for x in self.run_async(self.drain(byname))], ["bb:00:00:00:00:01"])
+
+    def test_async_for(self):
+        sub = self.bus.subscribe()
+
+        async def consume():
+            resu = []
+            async for event in sub:
+                resu.append(event.changes["power"])
+            return resu
+
+        task = self.loop.create_task(consume())
+        self.run_async(aio.sleep(0))
+        for x in range(3):
+            self.bus.publish(self.devs[0], {"power": x})
+        self.run_async(aio.sleep(0))
+        sub.close()
+        self.assertEqual(self.run_async(task), [0, 1, 2])
+        self.assertNotIn(sub, self.bus.subscriptions)
+
+
+if __name__ == "__main__":
+    unittest.main()
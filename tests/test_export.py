@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the export pipeline.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import shutil, tempfile, unittest
+from aiotplink.events import ChangeEvent
+from aiotplink.export import Exporter, Point, Sink, line_protocol, point_from_event
+
+TIMEOUT = 10
+
+
+class MemorySink(Sink):
+    """Keep the points written, each write takes delay secs"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.points = []
+        self.fail = False
+
+    async def write(self, points):
+        await aio.sleep(self.delay)
+        if self.fail:
+            raise IOError("Sink is down")
+        self.points += points
+
+
+def points(count, start=0):
+    return [Point("tplink", {"mac": "aa:bb"}, {"power": float(x)}, x) for x in range(start, start + count)]
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Sink()
+
+    def test_line_protocol(self):
+        event = ChangeEvent("aa:bb", "my plug, 1", "TPStrip",
+                            {"outlet": 1, "power": 1.5, "state": "on", "on_time": 3, "relay": True}, 2.0)
+        self.assertEqual(line_protocol(point_from_event(event)),
+                         'tplink,mac=aa:bb,name=my\\ plug\\,\\ 1,outlet=1,type=TPStrip '
+                         'power=1.5,state="on",on_time=3i,relay=true 2000000000')
+        self.assertIsNone(point_from_event(event._replace(changes={"outlet": 1})))
+
+    def test_batches(self):
+        sink = MemorySink()
+
+        async def run():
+            exporter = Exporter([sink], batch_size=10, flush_interval=0.05).start()
+            for point in points(25):
+                exporter.add(point)
+            await aio.sleep(0.2)
+            await exporter.stop()
+
+        self.run_async(run())
+        self.assertEqual([x.timestamp for x in sink.points], list(range(25)))
+
+    def test_stop_during_write(self):
+        #The batch being written when stop gives up waiting is written, not also spilled
+        slow = MemorySink(delay=0.3)
+
+        async def first_run():
+            exporter = Exporter([slow], batch_size=10, spill_dir=self.dir).start()
+            for point in points(30):
+                exporter.add(point)
+            await aio.sleep(0.1)
+            await exporter.stop(timeout=0.2)
+
+        self.run_async(first_run())
+        self.assertTrue(slow.points)
+        self.assertLess(len(slow.points), 30)
+        sink = MemorySink()
+
+        async def second_run():
+            exporter = Exporter([sink], batch_size=10, spill_dir=self.dir).start()
+            await aio.sleep(0.2)
+            await exporter.stop()
+
+        self.run_async(second_run())
+        self.assertEqual(sorted(x.timestamp for x in slow.points + sink.points), list(range(30)))
+
+    def test_spill_recovered(self):
+        down = MemorySink()
+        down.fail = True
+
+        async def first_run():
+            exporter = Exporter([down], batch_size=10, max_pending=1, spill_dir=self.dir).start()
+            for point in points(50):
+                exporter.add(point)
+            await exporter.stop(timeout=0.1)
+
+        self.run_async(first_run())
+        sink = MemorySink()
+
+        async def second_run():
+            exporter = Exporter([sink], batch_size=10, spill_dir=self.dir).start()
+            for point in points(10, 50):
+                exporter.add(point)
+            await exporter.stop()
+
+        self.run_async(second_run())
+        self.assertEqual([x.timestamp for x in sink.points], list(range(60)))
+
+
+if __name__ == "__main__":
+    unittest.main()
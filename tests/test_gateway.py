@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the gateway against the protocol simulator.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import json, unittest
+from aiotplink.events import EventBus
+from aiotplink.gateway import Gateway
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+async def http(port, method, path, headers=None, body=b"", raw=None):
+    """One request, return (status, headers, body)"""
+    reader, writer = await aio.open_connection("127.0.0.1", port)
+    if raw is None:
+        raw = "{} {} HTTP/1.1\r\nConnection: close\r\nContent-Length: {}\r\n".format(method, path, len(body))
+        for key, val in (headers or {}).items():
+            raw += "{}: {}\r\n".format(key, val)
+        raw = raw.encode("latin-1") + b"\r\n" + body
+    writer.write(raw)
+    data = await reader.read()
+    writer.close()
+    head, _, body = data.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    resp_headers = dict(x.split(": ", 1) for x in lines[1:])
+    return int(lines[0].split()[1]), resp_headers, body
+
+
+class GatewayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.sim = SimulatedDevice("HS110")
+        self.gateway = Gateway(port=0, hb=60, bus=EventBus())
+        self.run_async(self._start())
+
+    def tearDown(self):
+        self.run_async(self.gateway.stop())
+        self.run_async(self.sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self):
+        self.addr = await self.sim.start()
+        await self.gateway.start()
+        self.gateway.register(self.sim.info(), self.addr)
+        self.dev = self.gateway.devices[self.sim.mac.lower()]
+        while self.dev.state is None:
+            await aio.sleep(0.01) # The first heartbeat reads the device
+
+    def get(self, path, headers=None):
+        return self.run_async(http(self.gateway.port, "GET", path, headers))
+
+    def test_etag(self):
+        status, headers, body = self.get("/devices")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())["devices"][0]["mac"], self.sim.mac)
+        etag = headers["ETag"]
+        status, headers, body = self.get("/devices", {"If-None-Match": etag})
+        self.assertEqual((status, headers["ETag"], body), (304, etag, b""))
+        #A change makes a new one
+        self.run_async(self.dev.off())
+        self.run_async(aio.sleep(0))
+        status, headers, body = self.get("/devices", {"If-None-Match": etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers["ETag"], etag)
+        self.assertEqual(json.loads(body.decode())["devices"][0]["state"], "off")
+
+    def test_device_etag(self):
+        path = "/devices/" + self.sim.mac
+        status, headers, body = self.get(path)
+        self.assertEqual(json.loads(body.decode())["mac"], self.sim.mac)
+        status, headers, body = self.get(path, {"If-None-Match": 'W/"x", ' + headers["ETag"]})
+        self.assertEqual(status, 304)
+        self.assertEqual(self.get("/devices/00:00:00:00:00:00")[0], 404)
+
+    def test_moved(self):
+        etag = self.get("/devices")[1]["ETag"]
+        self.gateway.update(self.sim.info(), self.addr)
+        self.assertEqual(self.get("/devices", {"If-None-Match": etag})[0], 304)
+        self.gateway.register(self.sim.info(), ("10.0.0.99", 9999))
+        status, headers, body = self.get("/devices", {"If-None-Match": etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())["devices"][0]["addr"], "10.0.0.99")
+
+    def test_unsupported_model(self):
+        self.gateway.register({"mac": "AA:BB:CC:00:00:01", "model": "HS200", "name": "Wall"}, ("10.0.0.2", 9999))
+        self.assertEqual(list(self.gateway.devices), [self.sim.mac.lower()])
+
+    def test_command(self):
+        status, headers, body = self.run_async(http(self.gateway.port, "POST",
+                                                     "/devices/{}/off".format(self.sim.mac), body=b"[]"))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())["state"], "off")
+        self.assertEqual(self.sim.state, 0)
+        status, headers, body = self.run_async(http(self.gateway.port, "POST",
+                                                    "/devices/{}/reboot".format(self.sim.mac)))
+        self.assertEqual(status, 404)
+
+    def test_bad_requests(self):
+        raw = "POST /devices/{}/off HTTP/1.1\r\nContent-Length: {}\r\n\r\n"
+        for length, expected in [("abc", 400), ("-3", 400), ("1000000", 413)]:
+            status, headers, body = self.run_async(http(self.gateway.port, None, None,
+                                                        raw=raw.format(self.sim.mac, length).encode()))
+            self.assertEqual(status, expected, length)
+        self.assertEqual(self.sim.state, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check that the inventory survives a save and a preload.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, os, shutil, tempfile, unittest
+from aiotplink.discover import RegistrarEvent, REGISTER, UNREGISTER
+from aiotplink.inventory import TPInventory, InventoryRegistrar
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "inventory.json")
+        self.sims = [SimulatedDevice("HS110"), SimulatedDevice("LB130")]
+        self.addrs = [self.run_async(x.start()) for x in self.sims]
+        self.registrars = []
+
+    def tearDown(self):
+        for reg in self.registrars:
+            for dev in reg.devices.values():
+                dev.stop()
+        for sim in self.sims:
+            self.run_async(sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    def registrar(self, **kwargs):
+        reg = InventoryRegistrar(TPInventory(self.path), hb=60, **kwargs)
+        self.registrars.append(reg)
+        return reg
+
+    def events(self):
+        resu = [RegistrarEvent(REGISTER, x.mac.lower(), dict(x.info(), state="on"), addr)
+                for x, addr in zip(self.sims, self.addrs)]
+        #Not in the device tables, it must be skipped, not stop the batch
+        resu.insert(1, RegistrarEvent(REGISTER, "50:c7:bf:00:00:01",
+                                      {"mac": "50:c7:bf:00:00:01", "model": "HS200(US)", "name": "wall"},
+                                      ("127.0.0.1", 9)))
+        return resu
+
+    def test_round_trip(self):
+        reg = self.registrar()
+        self.run_async(reg.process(self.events()))
+        self.assertEqual(set(reg.devices), set(x.mac.lower() for x in self.sims))
+        with open(self.path) as f:
+            saved = json.load(f)["devices"]
+        self.assertEqual(len(saved), 3)
+        for sim, addr in zip(self.sims, self.addrs):
+            entry = saved[sim.mac.lower()]
+            self.assertEqual(tuple(entry["addr"]), tuple(addr))
+            self.assertEqual(entry["model"], sim.model)
+            self.assertEqual(entry["name"], sim.name)
+
+        again = self.registrar().preload()
+        self.assertEqual(set(again), set(x.mac.lower() for x in self.sims))
+        for sim, addr in zip(self.sims, self.addrs):
+            dev = again[sim.mac.lower()]
+            self.assertEqual((dev.addr, dev.port), tuple(addr))
+            self.assertEqual(dev.model, sim.model)
+            self.assertEqual(dev.is_light, sim.is_light)
+            self.assertEqual(dev.state, "on")
+            self.assertIsNone(dev.on_change)
+
+    def test_unregister_kept(self):
+        reg = self.registrar()
+        self.run_async(reg.process(self.events()))
+        mac = self.sims[0].mac.lower()
+        self.run_async(reg.process([RegistrarEvent(UNREGISTER, mac, None, None)]))
+        self.assertNotIn(mac, reg.devices)
+        self.assertIn(mac, self.registrar().preload())
+
+    def test_on_change(self):
+        changes = []
+        reg = self.registrar(on_change=lambda mac, x: changes.append((mac, x)))
+        self.run_async(reg.process(self.events()))
+        dev = reg.devices[self.sims[0].mac.lower()]
+        self.run_async(dev.off())
+        self.assertIn((self.sims[0].mac.lower(), {"state": "off"}), changes)
+
+
+if __name__ == "__main__":
+    unittest.main()
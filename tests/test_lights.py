@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the light commands, and the lights against the protocol simulator.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import json, unittest
+from aiotplink import commands
+from aiotplink.devices import GetDevice
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+LIGHTSERVICE = "smartlife.iot.smartbulb.lightingservice"
+
+
+def sent(cmd):
+    return json.loads(commands.TPLCodec.decrypt(cmd.command[4:]))[LIGHTSERVICE]["transition_light_state"]
+
+
+class LightCommandTest(unittest.TestCase):
+
+    def test_combinations(self):
+        for val, expected in [
+                ({"brightness": 50}, {"brightness": 50}),
+                ({"temperature": 2700}, {"color_temp": 2700}),
+                ({"hue": 120, "saturation": 50, "value": 80},
+                 {"color_temp": 0, "hue": 120, "saturation": 50, "brightness": 80}),
+                ({"hue": 120, "saturation": 50}, {"color_temp": 0, "hue": 120, "saturation": 50}),
+                ({"state": "off"}, {"on_off": 0}),
+                ({"state": True}, {"on_off": 1}),
+                ({"brightness": 30, "state": "on", "transition_period": 500},
+                 {"brightness": 30, "on_off": 1, "transition_period": 500})]:
+            self.assertEqual(sent(commands.SetLightStateCmd(val)), expected, val)
+
+    def test_rejected(self):
+        for val in [{"hue": 120}, {"hue": 120, "saturation": 50, "temperature": 2700},
+                    {"value": 10, "brightness": 10}, {"brightness": 101}, {"brightness": True},
+                    {"temperature": 2000}, {"state": "dim"}, {"colour": 1}, "on"]:
+            with self.assertRaises(ValueError, msg=val):
+                commands.SetLightStateCmd(val)
+
+    def test_no_value(self):
+        #The original constructor always failed
+        self.assertEqual(sent(commands.SetLightStateCmd()), {})
+
+    def test_on_off(self):
+        self.assertEqual(sent(commands.SetLightCmd("on")), {"on_off": 1})
+        self.assertEqual(sent(commands.SetLightCmd(False)), {"on_off": 0})
+
+
+class LightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.sim = SimulatedDevice("LB130")
+        self.light = self.run_async(self._start())
+
+    def tearDown(self):
+        self.light.stop()
+        self.run_async(self.sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self):
+        addr = await self.sim.start()
+        light = GetDevice(addr, self.sim.info(), hb=60, on_change=None)
+        while light.last_heartbeat is None:
+            await aio.sleep(0.01) # The first heartbeat reads the light
+        return light
+
+    def test_set_colour(self):
+        self.run_async(self.light.set_colour(240, 60, 70))
+        self.assertEqual([self.sim.light_state[x] for x in ["hue", "saturation", "brightness", "color_temp"]],
+                         [240, 60, 70, 0])
+        self.assertEqual(self.light.colour["hue"], 240)
+        self.assertEqual(self.light._pending_value, {})
+
+    def test_off_on(self):
+        self.run_async(self.light.off())
+        self.assertEqual((self.sim.light_state["on_off"], self.light.state), (0, "off"))
+        self.run_async(self.light.on())
+        self.assertEqual((self.sim.light_state["on_off"], self.light.state), (1, "on"))
+
+    def test_transition_period(self):
+        self.light.transition_period = 250
+        self.assertEqual(sent(self.light.light_state_cmd({"brightness": 40})),
+                         {"brightness": 40, "transition_period": 250})
+
+
+if __name__ == "__main__":
+    unittest.main()
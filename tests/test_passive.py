@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check that discovery replies update monitored devices.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import unittest
+from aiotplink.devices import GetDevice
+from aiotplink.discover import TPLinkDiscovery, DISCOVERY_CMD
+from aiotplink.events import EventBus
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class PassiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.bus = EventBus()
+        self.sims = []
+        self.devices = []
+
+    def tearDown(self):
+        for dev in self.devices:
+            dev.stop()
+        for sim in self.sims:
+            self.run_async(sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self, model):
+        sim = SimulatedDevice(model)
+        self.sims.append(sim)
+        addr = await sim.start()
+        dev = GetDevice(addr, sim.info(), hb=60, on_change=None)
+        dev.event_bus = self.bus
+        self.devices.append(dev)
+        while dev.last_heartbeat is None:
+            await aio.sleep(0.01) # The first heartbeat reads the device
+        return sim, dev
+
+    def discovery_reply(self, sim):
+        return DISCOVERY_CMD.process(sim.handle(DISCOVERY_CMD.value), ignore=True)
+
+    def events(self, sub):
+        return [sub._pop().changes for x in range(len(sub.queue))]
+
+    def test_reply_updates(self):
+        sim, dev = self.run_async(self._start("HS110"))
+        discovery = TPLinkDiscovery(self.loop)
+        discovery.monitor(dev)
+        self.assertTrue(dev.passive)
+        sub = self.bus.subscribe()
+        requests = sim.requests
+        sim.handle({"system": {"set_relay_state": {"state": 0}}})
+        discovery.handle_reply(self.discovery_reply(sim), sim.addr)
+        self.assertEqual(dev.state, "off")
+        changes = self.events(sub)
+        self.assertEqual(changes[0]["state"], "off")
+        self.assertIn("power", changes[0])
+        self.assertTrue(dev._passive_fresh())
+        self.assertEqual(sim.requests, requests + 2) #Only ours, the device did not poll
+
+    def test_back_online_once(self):
+        sim, dev = self.run_async(self._start("HS110"))
+        sub = self.bus.subscribe(fields=["online"])
+        #What a failed heartbeat leaves
+        dev.online = False
+        dev._offline_sent = True
+        dev.passive_update(self.discovery_reply(sim))
+        dev.passive_update(self.discovery_reply(sim))
+        self.assertTrue(dev.online)
+        self.assertEqual(self.events(sub), [{"online": True}])
+
+    def test_light(self):
+        sim, dev = self.run_async(self._start("LB130"))
+        sub = self.bus.subscribe(fields=["state"])
+        sim.handle({"smartlife.iot.smartbulb.lightingservice": {"transition_light_state": {"on_off": 0}}})
+        dev.passive_update(self.discovery_reply(sim))
+        self.assertEqual(dev.state, "off")
+        self.assertEqual(self.events(sub), [{"state": "off"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the rollout state file.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import json, os, shutil, tempfile, threading, unittest
+from aiotplink import rollout
+from aiotplink.rollout import FirmwareRollout
+
+TIMEOUT = 5
+
+
+class FakeDevice(object):
+
+    def __init__(self, mac, addr="10.0.0.1", port=9999):
+        self.mac = mac
+        self.addr = addr
+        self.port = port
+
+
+class ThreadRecordingRollout(FirmwareRollout):
+
+    def write(self, data):
+        self.writer = threading.current_thread()
+        super().write(data)
+
+
+class StateFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "rollout.json")
+        self.savedelay = rollout.SAVEDELAY
+        rollout.SAVEDELAY = 0.05
+
+    def tearDown(self):
+        rollout.SAVEDELAY = self.savedelay
+        shutil.rmtree(self.dir)
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    def test_save_in_executor(self):
+        fwr = ThreadRecordingRollout({}, self.path)
+        fwr._set(FakeDevice("AA:BB:CC:00:00:01"), rollout.DONE)
+        self.run_async(fwr.save())
+        self.assertIsNot(fwr.writer, threading.current_thread())
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)["devices"]["aa:bb:cc:00:00:01"]["status"], rollout.DONE)
+
+    def test_changes_saved_later(self):
+        fwr = FirmwareRollout({}, self.path)
+        fwr._set(FakeDevice(None, "10.0.0.2"), rollout.PENDING)
+        fwr._set(FakeDevice("AA:BB:CC:00:00:01"), rollout.DONE)
+        self.assertFalse(os.path.exists(self.path))
+        self.run_async(aio.sleep(rollout.SAVEDELAY + 0.2))
+        resumed = FirmwareRollout({}, self.path)
+        resumed.load()
+        self.assertEqual(resumed.status(FakeDevice(None, "10.0.0.2")), rollout.PENDING)
+        self.assertEqual(resumed.status(FakeDevice("AA:BB:CC:00:00:01")), rollout.DONE)
+
+
+if __name__ == "__main__":
+    unittest.main()
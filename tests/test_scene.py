@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check scenes against the protocol simulator.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import socket, unittest
+from aiotplink import scene
+from aiotplink.devices import GetDevice
+from aiotplink.scene import Scene
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class BarrierDevice(SimulatedDevice):
+    """A simulated device noting how many scene devices were connected when it got its request"""
+
+    def __init__(self, group, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.group = group
+        self.seen_connected = None
+
+    def handle(self, request):
+        if self.seen_connected is None:
+            self.seen_connected = sum(x.connections for x in self.group)
+        return super().handle(request)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class SceneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.replytimeout = scene.REPLYTIMEOUT
+        scene.REPLYTIMEOUT = 0.5
+        self.sims = []
+        self.devices = self.run_async(self._start(4))
+
+    def tearDown(self):
+        scene.REPLYTIMEOUT = self.replytimeout
+        for dev in self.devices:
+            dev.stop()
+        for sim in self.sims:
+            self.run_async(sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self, count):
+        devices = []
+        for x in range(count):
+            sim = BarrierDevice(self.sims, "HS110")
+            self.sims.append(sim)
+            addr = await sim.start()
+            devices.append(GetDevice(addr, sim.info(), hb=60, on_change=None))
+        while any(dev.last_heartbeat is None for dev in devices):
+            await aio.sleep(0.01) # The first heartbeat reads the devices
+        for sim in self.sims:
+            sim.seen_connected = None
+        return devices
+
+    def off_scene(self):
+        scn = Scene()
+        for dev in self.devices:
+            scn.set_state(dev, "off")
+        return scn
+
+    def test_barrier(self):
+        before = sum(x.connections for x in self.sims)
+        resu = self.run_async(self.off_scene().apply())
+        for sim in self.sims:
+            self.assertEqual(sim.seen_connected, before + len(self.sims))
+        self.assertEqual(set(resu.acked), set(self.devices))
+        self.assertEqual(resu.failed, [])
+        self.assertEqual([x.state for x in self.sims], [0] * 4)
+        self.assertEqual([x.state for x in self.devices], ["off"] * 4)
+        self.assertGreaterEqual(resu.ack_spread, 0)
+        self.assertGreaterEqual(resu.send_spread, 0)
+        self.assertEqual(set(resu.latencies), set(self.devices))
+
+    def test_no_reply(self):
+        self.sims[1].hang_rate = 1
+        resu = self.run_async(self.off_scene().apply())
+        self.assertEqual(resu.failed, [self.devices[1]])
+        self.assertEqual(len(resu.acked), 3)
+        self.assertEqual(self.devices[1].state, "on")
+        self.assertEqual(self.devices[1]._pending_value, {})
+
+    def test_no_connection(self):
+        self.devices[2].port = free_port()
+        resu = self.run_async(self.off_scene().apply())
+        self.assertEqual(resu.failed, [self.devices[2]])
+        self.assertEqual(len(resu.acked), 3)
+        self.assertEqual(self.sims[2].state, 1)
+
+    def test_locks_released(self):
+        self.sims[0].hang_rate = 1
+        self.run_async(self.off_scene().apply())
+        self.assertFalse(any(dev._exclusive.locked() for dev in self.devices))
+        self.sims[0].hang_rate = 0
+        self.assertEqual(self.run_async(self.devices[0]._send_cmd(self.off_scene().entries[0].cmd)), {"err_code": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
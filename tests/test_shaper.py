@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the traffic shaper.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+
+import asyncio as aio
+import unittest
+from aiotplink.devices import GetDevice
+from aiotplink.shaper import TrafficShaper, BROADCAST
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class ShaperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    def test_groups(self):
+        shaper = TrafficShaper()
+        self.assertEqual(shaper.group_of("192.168.1.20"), "192.168.1.0/24")
+        self.assertEqual(shaper.group_of("255.255.255.255"), BROADCAST)
+        self.assertIs(shaper._group("192.168.1.20"), shaper._group("192.168.1.21"))
+        self.assertIsNot(shaper._group("192.168.1.20"), shaper._group("192.168.2.20"))
+        shaper.tag("192.168.1.20", "ap1")
+        shaper.tag("192.168.2.20", "ap1")
+        self.assertIs(shaper._group("192.168.1.20"), shaper._group("192.168.2.20"))
+        self.assertIsNot(shaper._group("192.168.1.20"), shaper._group("192.168.1.21"))
+        shaper.tag("192.168.1.20", None)
+        self.assertIs(shaper._group("192.168.1.20"), shaper._group("192.168.1.21"))
+
+    def test_limits_change(self):
+        shaper = TrafficShaper(rate=5)
+        old = shaper._group("10.0.0.1")
+        shaper.set_limits("10.0.0.0/24", rate=1, burst=1)
+        group = shaper._group("10.0.0.1")
+        self.assertIsNot(group, old)
+        self.assertEqual(group.budget.rate, 1)
+        self.assertTrue(shaper.try_send("10.0.0.1"))
+        self.assertFalse(shaper.try_send("10.0.0.2"))
+        self.assertTrue(shaper.try_send("10.0.1.1")) #Another subnet, default limits
+
+    def test_concurrency(self):
+        shaper = TrafficShaper(concurrency=2)
+        active = []
+
+        async def connection(ip):
+            async with shaper.slot(ip):
+                active.append(shaper._group(ip).active)
+                await aio.sleep(0.02)
+
+        self.run_async(aio.gather(*[connection("10.0.0.{}".format(x)) for x in range(6)]))
+        self.assertEqual(max(active), 2)
+        self.assertEqual(shaper._group("10.0.0.1").active, 0)
+
+    def test_rate(self):
+        shaper = TrafficShaper(rate=20, burst=1)
+
+        async def tokens(count):
+            start = self.loop.time()
+            for x in range(count):
+                await shaper.token("10.0.0.1")
+            return self.loop.time() - start
+
+        self.assertGreaterEqual(self.run_async(tokens(5)), 4 / 20 * 0.9)
+
+
+class DeviceTimeoutTest(unittest.TestCase):
+    """Waiting for the shaper is not waiting for the device"""
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.sim = SimulatedDevice("HS110")
+
+    def tearDown(self):
+        self.dev.stop()
+        self.run_async(self.sim.stop())
+        self.run_async(aio.sleep(0))
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self):
+        addr = await self.sim.start()
+        self.dev = GetDevice(addr, self.sim.info(), hb=0, on_change=None)
+        self.dev.shaper = TrafficShaper(concurrency=1)
+        await aio.sleep(0.1) # The one heartbeat
+        return self.dev
+
+    def test_queued_not_timed_out(self):
+        dev = self.run_async(self._start())
+        self.sim.delay = 0.1
+        #Each waits for the ones before it in the shaper, longer than its own timeout
+        cmds = [dev._fetch_status(timeout=0.3) for x in range(5)]
+        results = self.run_async(aio.gather(*cmds, return_exceptions=True))
+        self.assertFalse([x for x in results if isinstance(x, BaseException)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+#
+# This library is an asyncio library to communicate with TP-Link devices
+# Here we check the strip requests against the protocol simulator.
+#
+# Copyright (c) 2018 François Wautier
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies
+# or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
+# IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
+
+import asyncio as aio
+import json, unittest
+from aiotplink import commands
+from aiotplink.devices import GetDevice
+from aiotplink.simulator import SimulatedDevice
+
+TIMEOUT = 5
+
+
+class RecordingDevice(SimulatedDevice):
+    """A simulated device keeping its requests, with the connection they came on"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = [] # (connection number, request)
+
+    def handle(self, request):
+        self.log.append((self.connections, request))
+        return super().handle(request)
+
+
+def decoded(cmd):
+    return json.loads(commands.TPLCodec.decrypt(cmd.command[4:]))
+
+
+class StripTest(unittest.TestCase):
+    """Each test gets an HS300 simulator and a TPStrip that read it once"""
+
+    def setUp(self):
+        self.loop = aio.new_event_loop()
+        aio.set_event_loop(self.loop)
+        self.sim = RecordingDevice("HS300")
+        self.strip = self.run_async(self._start())
+
+    def tearDown(self):
+        self.strip.stop()
+        self.run_async(self.sim.stop())
+        self.run_async(aio.sleep(0)) # Let the cancelled tasks end
+        aio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(aio.wait_for(coro, TIMEOUT))
+
+    async def _start(self):
+        addr = await self.sim.start()
+        strip = GetDevice(addr, self.sim.info(), hb=60, on_change=None)
+        while not strip.outlets:
+            await aio.sleep(0.01) # The first heartbeat creates the outlets
+        self.sim.log = []
+        return strip
+
+    def test_child_context(self):
+        cid = self.sim.children[1]["id"]
+        cmd = commands.SetCmd("off").for_children([cid])
+        self.assertEqual(decoded(cmd), {"context": {"child_ids": [cid]},
+                                        "system": {"set_relay_state": {"state": 0}}})
+        self.run_async(self.strip._send_cmd(cmd))
+        self.assertEqual([x["state"] for x in self.sim.children], [1, 0, 1, 1, 1, 1])
+        self.assertEqual(self.sim.log[0][1]["context"], {"child_ids": [cid]})
+
+    def test_unknown_child(self):
+        cmd = commands.SetCmd("off").for_children(["nosuchoutlet"])
+        with self.assertRaises(commands.TPLException):
+            self.run_async(self.strip._send_cmd(cmd))
+        self.assertEqual([x["state"] for x in self.sim.children], [1] * 6)
+
+    def test_fetch_status_pipelined(self):
+        connections = self.sim.connections
+        resu = self.run_async(self.strip._fetch_status())
+        self.assertEqual(self.sim.connections, connections + 1)
+        self.assertEqual(len(self.sim.log), 1 + len(self.strip.outlets))
+        self.assertEqual(set(x[0] for x in self.sim.log), {connections + 1})
+        self.assertEqual(self.sim.log[0][1], {"system": {"get_sysinfo": {}}})
+        for (conn, request), outlet in zip(self.sim.log[1:], self.strip.outlets):
+            self.assertEqual(request["context"], {"child_ids": [outlet.child_id]})
+            self.assertIn("get_realtime", request["emeter"])
+        self.assertEqual(len(resu["children"]), 6)
+        self.assertEqual(set(resu["emeters"]), set(x.child_id for x in self.strip.outlets))
+        for reading in resu["emeters"].values():
+            self.assertIsNotNone(reading["power"])
+
+    def test_switch_merged(self):
+        outlets = self.strip.outlets
+        connections = self.sim.connections
+        task = outlets[0].off()
+        self.assertIs(outlets[2].off(), task)
+        self.assertIs(outlets[4].on(), task)
+        self.run_async(task)
+        self.assertEqual(self.sim.connections, connections + 1)
+        contexts = {}
+        for conn, request in self.sim.log:
+            contexts[request["system"]["set_relay_state"]["state"]] = request["context"]["child_ids"]
+        self.assertEqual(contexts, {0: [outlets[0].child_id, outlets[2].child_id],
+                                    1: [outlets[4].child_id]})
+        self.assertEqual([x["state"] for x in self.sim.children], [0, 1, 0, 1, 1, 1])
+        self.assertEqual([x.state for x in outlets], ["off", "on", "off", "on", "on", "on"])
+
+    def test_switch_next_tick(self):
+        outlets = self.strip.outlets
+        first = outlets[0].off()
+        self.run_async(first)
+        second = outlets[1].off()
+        self.assertIsNot(first, second)
+        self.run_async(second)
+        self.assertEqual(len(self.sim.log), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()